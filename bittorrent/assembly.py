@@ -0,0 +1,55 @@
+"""Memory buffers for pieces that are still being downloaded
+
+Each in-flight piece gets one preallocated bytearray that its blocks are
+copied into as they arrive, so a finished piece can be hashed from memory
+and written to disk in one go. Buffers are only handed out while their
+total size stays under memory_limit; past that the caller writes blocks
+straight to disk and hashes the piece by reading it back.
+
+>>> a = PieceAssembler(10)
+>>> a.add(0, 6, 0, 'abc'), a.add(0, 6, 3, 'def'), a.memory_used
+(True, True, 6)
+>>> a.add(1, 6, 0, 'xyz'), 1 in a
+(False, False)
+>>> a.pop(0), a.memory_used
+(bytearray(b'abcdef'), 0)
+>>> a.add(1, 6, 0, 'xyz'), 1 in a
+(True, True)
+"""
+
+class PieceAssembler(object):
+    def __init__(self, memory_limit):
+        self.memory_limit = memory_limit
+        self.memory_used = 0
+        self.buffers = {}
+
+    def __contains__(self, index):
+        return index in self.buffers
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def add(self, index, piece_size, begin, block):
+        """Copies block into the buffer for piece index, allocating the buffer
+        if there isn't one yet
+
+        Returns False without copying if a new buffer would go over memory_limit.
+        """
+        buff = self.buffers.get(index)
+        if buff is None:
+            if self.memory_used + piece_size > self.memory_limit:
+                return False
+            buff = self.buffers[index] = bytearray(piece_size)
+            self.memory_used += piece_size
+        buff[begin:begin+len(block)] = block
+        return True
+
+    def get(self, index):
+        return self.buffers.get(index)
+
+    def pop(self, index):
+        """Removes and returns the buffer for piece index, or None if there isn't one"""
+        buff = self.buffers.pop(index, None)
+        if buff is not None:
+            self.memory_used -= len(buff)
+        return buff
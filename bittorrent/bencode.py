@@ -1,5 +1,4 @@
 
-
 encodings = {
         dict : lambda x: 'd'+''.join([bencode(str(k))+bencode(v) for k,v in sorted(x.items(), key=lambda kv: kv[0])])+'e',
         list : lambda x: 'l'+''.join([bencode(el) for el in x])+'e',
@@ -18,6 +17,10 @@ def bencode(x):
     """
     return encodings[type(x)](x)
 
+class DecodeError(ValueError): pass
+class Incomplete(DecodeError):
+    """Raised when the data ends partway through a value"""
+
 def bdecode(s):
     """
     >>> bdecode('i3e')
@@ -26,57 +29,262 @@ def bdecode(s):
     >>> new = bdecode(bencode(d))
     >>> d == new
     True
+    >>> bdecode(memoryview('li-1e0:e')), bdecode(bytearray('d1:ai1ee'))
+    ([-1, ''], {'a': 1})
+    >>> bdecode('d1:ai1e')
+    Traceback (most recent call last):
+    Incomplete: data ends at byte 7 inside a value
+    >>> bdecode('i3ejunk')
+    Traceback (most recent call last):
+    DecodeError: 4 bytes of trailing data after byte 3
     """
-#TODO makes this tons more elegant - all in terms of reduce?
-#TODO make this a validating library - more assertions and input checking
-    if not hasattr(s, 'next'):
-        s = (c for c in s)
-
-    def parse_str(first):
-        nums = first
-        for c in s:
-            if c in '0123456789':
-                nums += c
-            elif c == ':':
-                num = int(nums, 10)
-                return ''.join(s.next() for _ in range(num))
-    def parse_int(first):
-        assert first == 'i'
-        nums = ''
-        for c in s:
-            if c in '0123456789':
-                nums += c
-            elif c == 'e':
-                return int(nums)
-    def parse_dict(first):
-        assert first == 'd'
-        d = {}
-        key = None
-        for c in s:
-            if c == 'e':
-                return d
-            x = decode(c)
-            if key is None:
-                key = x
-            else:
-                d[key] = x
-                key = None
-    def parse_list(first):
-        assert first == 'l'
-        l = []
-        for c in s:
-            if c == 'e':
-                return l
-            l.append(decode(c))
+    s = _walkable(s)
+    value, end = decode(s)
+    if end != len(s):
+        raise DecodeError('%d bytes of trailing data after byte %d' % (len(s) - end, end))
+    return value
+
+def _walkable(data):
+    """data as something decode can walk: a str or mmap as it is, a
+    memoryview, bytearray or buffer copied to a str
+
+    Indexing a bytearray gives ints and a memoryview has no find, so the
+    one copy up front is cheaper than walking them in Python.
+    """
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    elif isinstance(data, (bytearray, buffer)):
+        return str(data)
+    return data
+
+def decode(data, pos=0):
+    """Decodes the value starting at data[pos], returns (value, end offset)
+
+    data can be a str or mmap, which are walked by offset and have
+    string values sliced out in one operation, or a memoryview, bytearray
+    or buffer, which is copied to a str once first.
 
-    decoders = {'d': parse_dict, 'l': parse_list, 'i': parse_int}
-    for numeral in '0123456789':
-        decoders[numeral] = parse_str
+    >>> data = 'd3:cow3:moo4:spaml1:a1:bee'
+    >>> decode(data, 17)
+    (['a', 'b'], 25)
+    >>> import mmap, tempfile; f = tempfile.TemporaryFile(); f.write(data); f.flush()
+    >>> decode(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    ({'cow': 'moo', 'spam': ['a', 'b']}, 26)
+    >>> decode(memoryview(data), 17), decode(bytearray(data), 17)
+    ((['a', 'b'], 25), (['a', 'b'], 25))
+    """
+    data = _walkable(data)
+    try:
+        return _decoders[data[pos]](data, pos)
+    except (IndexError, Incomplete):
+        raise Incomplete('data ends at byte %d inside a value' % len(data))
+    except (KeyError, ValueError):
+        raise DecodeError('invalid bencoded data at or after byte %d' % pos)
+
+def _decode_int(data, pos):
+    end = data.find('e', pos)
+    if end == -1:
+        raise Incomplete()
+    return int(data[pos+1:end]), end + 1
+
+def _decode_str(data, pos):
+    colon = data.find(':', pos)
+    if colon == -1:
+        raise Incomplete()
+    start = colon + 1
+    end = start + int(data[pos:colon])
+    if end > len(data):
+        raise Incomplete()
+    return data[start:end], end
+
+def _decode_list(data, pos):
+    pos += 1
+    result = []
+    while data[pos] != 'e':
+        value, pos = _decoders[data[pos]](data, pos)
+        result.append(value)
+    return result, pos + 1
+
+def _decode_dict(data, pos):
+    pos += 1
+    result = {}
+    while data[pos] != 'e':
+        key, pos = _decode_str(data, pos)
+        result[key], pos = _decoders[data[pos]](data, pos)
+    return result, pos + 1
+
+_decoders = {'i': _decode_int, 'l': _decode_list, 'd': _decode_dict}
+for numeral in '0123456789':
+    _decoders[numeral] = _decode_str
+
+def skip(data, pos=0):
+    """Returns the offset just past the value starting at data[pos], without decoding it
+
+    >>> skip('l4:spami42eexyz')
+    12
+    """
+    c = data[pos]
+    if c == 'i':
+        end = data.find('e', pos)
+        if end == -1:
+            raise Incomplete()
+        return end + 1
+    elif c in 'ld':
+        pos += 1
+        while data[pos] != 'e':
+            pos = skip(data, pos)
+        return pos + 1
+    else:
+        start, end = string_span(data, pos)
+        return end
 
-    def decode(c):
-        return decoders[c](c)
+def string_span(data, pos):
+    """Offsets of the payload of the string starting at data[pos]
 
-    return decode(s.next())
+    >>> string_span('l4:spame', 1)
+    (3, 7)
+    """
+    colon = data.find(':', pos)
+    if colon == -1:
+        raise Incomplete()
+    return colon + 1, colon + 1 + int(data[pos:colon])
+
+def key_spans(data, pos=0):
+    """Maps each key of the dict starting at data[pos] to the (start, end)
+    offsets of its still-encoded value
+
+    Lets a caller hash or decode exactly the bytes of one value, like the
+    info dict of a torrent file, without decoding the rest.
+
+    >>> data = 'd3:cow3:moo4:spaml1:a1:bee'
+    >>> spans = key_spans(data); sorted(spans.items())
+    [('cow', (6, 11)), ('spam', (17, 25))]
+    >>> data[17:25], decode(data, spans['spam'][0])
+    ('l1:a1:be', (['a', 'b'], 25))
+    """
+    if data[pos] != 'd':
+        raise DecodeError('no dictionary at byte %d' % pos)
+    spans = {}
+    pos += 1
+    try:
+        while data[pos] != 'e':
+            key_start, key_end = string_span(data, pos)
+            end = skip(data, key_end)
+            spans[data[key_start:key_end]] = (key_end, end)
+            pos = end
+    except (IndexError, ValueError):
+        raise DecodeError('invalid or truncated dictionary at or after byte %d' % pos)
+    return spans
+
+class _DictFrame(object):
+    """A dict being decoded, and the key waiting for its value"""
+    __slots__ = ['d', 'key']
+    def __init__(self):
+        self.d = {}
+        self.key = None
+
+class IncrementalDecoder(object):
+    """Decodes one bencoded value from data that arrives in pieces
+
+    Each feed picks up where the last one stopped, keeping a stack of the
+    containers still being filled, so nothing is parsed twice, except
+    the part of a container that's here when it's first tried: every
+    value is tried whole with the decoders bdecode uses, and only a
+    container that isn't all here yet goes on the stack, to be filled a
+    value at a time. A string still arriving isn't looked at again until
+    all of it has.
+
+    >>> d = IncrementalDecoder()
+    >>> d.feed('d8:intervali18'), d.feed('00e5:peers6:abc'), d.feed('defe')
+    (False, False, True)
+    >>> d.value == {'interval': 1800, 'peers': 'abcdef'}
+    True
+    >>> d = IncrementalDecoder(); d.feed('l'); d.feed('i1'); d.feed('ee'); d.value
+    False
+    False
+    True
+    [1]
+    >>> d = IncrementalDecoder(); d.feed('d3:'); d.feed(memoryview('keyli1e')); d.feed(bytearray('ee')); d.value
+    False
+    False
+    True
+    {'key': [1]}
+    >>> d = IncrementalDecoder(); d.feed('d')
+    False
+    >>> d.feed('li1ee1:ae')
+    Traceback (most recent call last):
+    DecodeError: dictionary key must be a string
+    """
+    def __init__(self):
+        self.buffer = '' # data not yet joined into it is in self.chunks
+        self.chunks = []
+        self.length = 0 # of the buffer and the chunks
+        self.needed = 0 # length the data must reach before it's worth parsing again
+        self.pos = 0 # in the buffer
+        self.stack = [] # lists, and _DictFrames for dicts
+        self.done = False
+        self.value = None
+
+    def feed(self, data):
+        """Adds data, returns True once a whole value has been decoded"""
+        if self.done:
+            return True
+        self.chunks.append(_walkable(data))
+        self.length += len(data)
+        if self.length < self.needed:
+            return False
+        self.buffer = self.buffer[self.pos:] + ''.join(self.chunks)
+        self.chunks = []
+        self.length = len(self.buffer)
+        self.needed = self.pos = 0
+        self._parse()
+        return self.done
+
+    def _finish(self, value):
+        if not self.stack:
+            self.done = True
+            self.value = value
+        elif isinstance(self.stack[-1], list):
+            self.stack[-1].append(value)
+        elif self.stack[-1].key is None:
+            if not isinstance(value, str):
+                raise DecodeError('dictionary key must be a string')
+            self.stack[-1].key = value
+        else:
+            self.stack[-1].d[self.stack[-1].key] = value
+            self.stack[-1].key = None
+
+    def _parse(self):
+        buff = self.buffer
+        pos = self.pos
+        while not self.done and pos < len(buff):
+            c = buff[pos]
+            if c == 'e':
+                if not self.stack:
+                    raise DecodeError('unexpected end of container at byte %d' % pos)
+                container = self.stack.pop()
+                pos += 1
+                self._finish(container if isinstance(container, list) else container.d)
+                continue
+            try:
+                value, pos = _decoders[c](buff, pos)
+            except (IndexError, Incomplete):
+                if c == 'l':
+                    self.stack.append([])
+                    pos += 1
+                    continue
+                elif c == 'd':
+                    self.stack.append(_DictFrame())
+                    pos += 1
+                    continue
+                colon = buff.find(':', pos)
+                if c != 'i' and colon != -1:
+                    self.needed = colon + 1 + int(buff[pos:colon])
+                break
+            except (KeyError, ValueError):
+                raise DecodeError('invalid bencoded data at or after byte %d' % pos)
+            self._finish(value)
+        self.pos = pos
 
 if __name__ == '__main__':
     import doctest
@@ -0,0 +1,110 @@
+"""Compares bencode.bdecode with the generator-based decoder it replaced
+
+python -m bittorrent.bencode_bench [torrent files...]
+
+With no arguments, builds a couple of multi-megabyte .torrent files in
+memory: one dominated by a large pieces string and one with tens of
+thousands of file entries.
+"""
+import sys
+import time
+import random
+
+from . import bencode
+
+def legacy_bdecode(s):
+    """The one-character-at-a-time decoder bencode.bdecode used to be"""
+    if not hasattr(s, 'next'):
+        s = (c for c in s)
+
+    def parse_str(first):
+        nums = first
+        for c in s:
+            if c in '0123456789':
+                nums += c
+            elif c == ':':
+                num = int(nums, 10)
+                return ''.join(s.next() for _ in range(num))
+    def parse_int(first):
+        assert first == 'i'
+        nums = ''
+        for c in s:
+            if c in '0123456789':
+                nums += c
+            elif c == 'e':
+                return int(nums)
+    def parse_dict(first):
+        assert first == 'd'
+        d = {}
+        key = None
+        for c in s:
+            if c == 'e':
+                return d
+            x = decode(c)
+            if key is None:
+                key = x
+            else:
+                d[key] = x
+                key = None
+    def parse_list(first):
+        assert first == 'l'
+        l = []
+        for c in s:
+            if c == 'e':
+                return l
+            l.append(decode(c))
+
+    decoders = {'d': parse_dict, 'l': parse_list, 'i': parse_int}
+    for numeral in '0123456789':
+        decoders[numeral] = parse_str
+
+    def decode(c):
+        return decoders[c](c)
+
+    return decode(s.next())
+
+def synthetic_torrent(num_pieces, num_files):
+    rand = random.Random(num_pieces * num_files)
+    pieces = ''.join(chr(rand.randrange(256)) for _ in range(20 * min(num_pieces, 4096)))
+    pieces = (pieces * (num_pieces // 4096 + 1))[:20 * num_pieces]
+    files = [{'length': rand.randrange(1, 2**30), 'path': ['dir%d' % (i % 97), 'file%d.bin' % i]}
+             for i in range(num_files)]
+    return bencode.bencode({
+        'announce': 'http://tracker.example.com/announce',
+        'creation date': 1234567890,
+        'info': {'name': 'synthetic', 'piece length': 2**18, 'pieces': pieces, 'files': files},
+    })
+
+def timed(f, data, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        f(data)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def incremental(data, chunk=1460):
+    d = bencode.IncrementalDecoder()
+    for i in range(0, len(data), chunk):
+        d.feed(data[i:i+chunk])
+    return d.value
+
+def bench(name, data):
+    assert legacy_bdecode(data) == bencode.bdecode(data) == incremental(data)
+    old = timed(legacy_bdecode, data, repeat=1)
+    new = timed(bencode.bdecode, data)
+    inc = timed(incremental, data)
+    print '%-28s %6.1f MB  legacy %7.3fs  bdecode %7.4fs (%5.0fx)  incremental %7.4fs' % (
+            name, len(data) / 1e6, old, new, old / max(new, 1e-6), inc)
+
+def main(filenames):
+    if filenames:
+        for filename in filenames:
+            bench(filename, open(filename, 'rb').read())
+    else:
+        bench('200k pieces, 10 files', synthetic_torrent(200000, 10))
+        bench('20k pieces, 40k files', synthetic_torrent(20000, 40000))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,136 @@
+"""State of every block of a torrent, one byte per block
+
+Data is requested and arrives in BLOCK_SIZE blocks aligned to the start
+of their piece, so that's the granularity we track it at. Each block is
+MISSING, REQUESTED, RECEIVED or VERIFIED, stored as one byte in a
+bytearray, so finding the next block to ask for in a piece, or whether a
+piece is complete, is a bytearray find or count - a scan in C over a few
+bytes per piece.
+
+>>> b = BlockMap(100000, 2**15)
+>>> b.num_pieces, b.blocks_in_piece(0), b.blocks_in_piece(3), b.block_span(3, 0)
+(4, 2, 1, (0, 1696))
+>>> b.find(1, MISSING), b.set(1, 0, REQUESTED), b.find(1, MISSING)
+(0, None, 1)
+>>> b.set(1, 1, RECEIVED); b.find(1, MISSING), b.complete(1)
+(-1, False)
+>>> b.set(1, 0, RECEIVED); b.complete(1), b.received_bytes(1)
+(True, 32768)
+>>> b.set_piece(1, VERIFIED); b.set_piece(3, VERIFIED); b.bitfield(), b.verified(3)
+('P', True)
+>>> b.runs(2, MISSING), b.runs(1, VERIFIED)
+([(0, 32768)], [(0, 32768)])
+>>> b.bitfield() is b.bitfield(), b.set_piece(0, VERIFIED), b.bitfield()
+(True, None, '\\xd0')
+"""
+import binascii
+
+BLOCK_SIZE = 2**14
+
+MISSING = 0 # not asked for
+REQUESTED = 1 # asked for, not arrived
+RECEIVED = 2 # arrived, piece not verified yet
+VERIFIED = 3 # in a piece whose hash checked out
+
+_STATE_CHARS = [chr(state) for state in range(4)]
+_VERIFIED_BITS = ''.join('1' if chr(i) == _STATE_CHARS[VERIFIED] else '0' for i in range(256))
+
+class BlockMap(object):
+    """self.states: bytearray holding the state of each block, the blocks of
+    piece i starting at i*self.blocks_per_piece
+
+    bitfield() is kept until a piece becomes or stops being verified, since
+    it's asked for far more often than that happens.
+    """
+    def __init__(self, length, piece_length, block_size=BLOCK_SIZE):
+        self.length = length
+        self.piece_length = piece_length
+        self.block_size = block_size
+        self.blocks_per_piece = -(-piece_length // block_size)
+        self.num_pieces = -(-length // piece_length)
+        last_piece = length - (self.num_pieces - 1) * piece_length
+        self.states = bytearray((self.num_pieces - 1) * self.blocks_per_piece + -(-last_piece // block_size))
+        self._bitfield = None
+
+    def piece_size(self, index):
+        return min(self.piece_length, self.length - index * self.piece_length)
+
+    def blocks_in_piece(self, index):
+        return -(-self.piece_size(index) // self.block_size)
+
+    def block_span(self, index, block):
+        """(begin, length) of a block within its piece"""
+        begin = block * self.block_size
+        return begin, min(self.block_size, self.piece_size(index) - begin)
+
+    def _bounds(self, index):
+        first = index * self.blocks_per_piece
+        return first, first + self.blocks_in_piece(index)
+
+    def get(self, index, block):
+        return self.states[index * self.blocks_per_piece + block]
+
+    def set(self, index, block, state):
+        i = index * self.blocks_per_piece + block
+        if state == VERIFIED or self.states[i] == VERIFIED:
+            self._bitfield = None
+        self.states[i] = state
+
+    def set_piece(self, index, state):
+        first, end = self._bounds(index)
+        self.states[first:end] = _STATE_CHARS[state] * (end - first)
+        self._bitfield = None
+
+    def reset(self):
+        self.states[:] = bytearray(len(self.states))
+        self._bitfield = None
+
+    def find(self, index, state, start=0):
+        """First block of piece index at or after block start that's in state, or -1"""
+        first, end = self._bounds(index)
+        found = self.states.find(_STATE_CHARS[state], first + start, end)
+        return found - first if found >= 0 else -1
+
+    def count(self, index, state):
+        first, end = self._bounds(index)
+        return self.states.count(_STATE_CHARS[state], first, end)
+
+    def complete(self, index):
+        """Whether every block of piece index has arrived"""
+        return self.find(index, MISSING) < 0 and self.find(index, REQUESTED) < 0
+
+    def verified(self, index):
+        return self.states[index * self.blocks_per_piece] == VERIFIED
+
+    def received_bytes(self, index):
+        """Bytes of piece index that have arrived, verified or not"""
+        first, end = self._bounds(index)
+        received = end - first - self.count(index, MISSING) - self.count(index, REQUESTED)
+        last = end - first - 1
+        if received and self.states[end - 1] >= RECEIVED:
+            return (received - 1) * self.block_size + self.block_span(index, last)[1]
+        return received * self.block_size
+
+    def runs(self, index, state):
+        """(begin, end) byte ranges within piece index of consecutive blocks in state"""
+        runs = []
+        block = self.find(index, state)
+        while block >= 0:
+            end = block + 1
+            while end < self.blocks_in_piece(index) and self.get(index, end) == state:
+                end += 1
+            begin = self.block_span(index, block)[0]
+            last_begin, last_length = self.block_span(index, end - 1)
+            runs.append((begin, last_begin + last_length))
+            block = self.find(index, state, end)
+        return runs
+
+    def bitfield(self):
+        """Packed bits of which pieces are verified, as sent in a Bitfield message"""
+        if self._bitfield is None:
+            if not self.num_pieces:
+                return ''
+            bits = str(self.states[::self.blocks_per_piece]).translate(_VERIFIED_BITS)
+            bits += '0' * (-len(bits) % 8)
+            self._bitfield = binascii.unhexlify('%0*x' % (len(bits) // 4, int(bits, 2)))
+        return self._bitfield
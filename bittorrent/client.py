@@ -1,10 +1,16 @@
 import time
 import logging
 import weakref
+import select
 from .torrent import ActiveTorrent
-from .reactor_select import Reactor
+if hasattr(select, 'epoll'):
+    from .reactor_epoll import Reactor
+else:
+    from .reactor_select import Reactor
 from .peer import Peer
 from .network import AcceptingConnection
+from .wakeup import Waker
+from .tracker import Resolver
 
 class BittorrentClient(object):
     """
@@ -19,6 +25,8 @@ class BittorrentClient(object):
         self.port = listen_port
         self.torrents = []
         self.reactor = Reactor()
+        self.waker = Waker(self.reactor)
+        self.resolver = Resolver(self.waker)
         self.connection = AcceptingConnection('', self.port, self.reactor, self)
         self.pending_connections = []
 
@@ -36,6 +44,20 @@ class BittorrentClient(object):
         self.torrents.append(t)
         return weakref.proxy(t)
 
+    def shutdown(self):
+        """Finishes every torrent's hashing and disk writes and saves its
+        resume file; call this before exiting"""
+        for torrent in self.torrents:
+            torrent.hasher.close()
+            torrent.disk.close()
+        # hand back what the workers finished; whatever that sets off runs right away now
+        self.waker.read_event()
+        for torrent in self.torrents:
+            torrent.save_resume()
+            torrent.tracker.close()
+            torrent.data.close()
+        self.resolver.close()
+
     def move_to_torrent(self, peer, info_hash):
         for torrent in self.torrents:
             if torrent.info_hash == info_hash:
@@ -1,34 +1,151 @@
-"""Bytearray that immediately writes to disk"""
+"""Bytearray backed by files on disk, with a write-back cache
+
+Writes go into a cache of dirty runs, each a bytearray, merged with any
+run they overlap or touch, so blocks that arrive next to each other in
+any order end up as one run. Runs are written out in WRITE_CHUNK pieces
+aligned to WRITE_CHUNK in the file when flush is called, when dirty
+bytes pass the cache limit, and before any read or FileRegion of the
+bytes they cover, so reads always see what was written.
+
+>>> import tempfile; d = tempfile.mkdtemp()
+>>> a = DiskArray(100, d+'/a', cache_limit=64)
+>>> a[20:30] = 'k'*10; a[0:10] = 'a'*10; a[10:20] = 'b'*10
+>>> a.dirty_starts, a.dirty_bytes, os.path.getsize(d+'/a')
+([0], 30, 0)
+>>> a[5:25]
+'aaaaabbbbbbbbbbkkkkk'
+>>> a.dirty_bytes, os.path.getsize(d+'/a'), a.write_sizes.count
+(0, 30, 1)
+>>> a[40:70] = 'x'*30; a[80:100] = 'y'*20; a[60:85] = 'z'*25; a.dirty_bytes
+60
+>>> a[38:42], a[68:72], a[98:]
+('\\x00\\x00xx', 'zzzz', 'yy')
+>>> a[0:10] = 'q'*10; a[30:35] = 'r'*5; a.dirty_bytes, a.write_sizes.count
+(15, 2)
+>>> a[50:100] = 'w'*50; a.dirty_bytes, a.dirty_sizes.count, a.write_sizes.count
+(0, 1, 5)
+"""
 import logging
 import os
+import mmap
 import bisect
-#TODO make this async? write are moderately fast
-#TODO add a buffer? alternative to async
+import threading
+
+from .stats import Histogram, byte_size
+
+WRITE_CACHE_LIMIT = 16 * 2**20 # dirty bytes to hold before flushing them all
+WRITE_CHUNK = 2**20 # most bytes per write, and the alignment of writes
+
+def _pwrite(fd, data, offset):
+    """Writes all of data at offset in fd"""
+    written = 0
+    while written < len(data):
+        chunk = buffer(data, written)
+        if hasattr(os, 'pwrite'):
+            written += os.pwrite(fd, chunk, offset + written)
+        else:
+            os.lseek(fd, offset + written, os.SEEK_SET)
+            written += os.write(fd, chunk)
+
 class DiskArray(object):
-    def __init__(self, size, filename):
+    """self.dirty_starts: sorted starts of the cached runs not yet on disk
+    self.dirty: start -> bytearray of each of those runs
+    self.write_sizes: Histogram of bytes per write to disk
+    self.dirty_sizes: Histogram of dirty bytes at each flush
+    self.lock: held by every read, write and flush, so a DiskIO worker and
+      the reactor thread can both use the array
+    """
+    def __init__(self, size, filename, cache_limit=WRITE_CACHE_LIMIT):
         try:
             os.makedirs(os.path.dirname(filename))
         except OSError:
             pass
-        self.f = open(filename, 'wb')
-        self.f.write('')
-        self.f.close()
-        self.f = open(filename, 'r+b')
+        open(filename, 'ab').close() # create it if it doesn't exist, keep what's there if it does
+        self.f = open(filename, 'r+b', 0) # unbuffered, so reads see what _pwrite wrote through the fd
         self.length = size
+        self.cache_limit = cache_limit
+        self.lock = threading.RLock()
+        self.dirty_starts = []
+        self.dirty = {}
+        self.dirty_bytes = 0
+        self.write_sizes = Histogram(unit=1, formatter=byte_size)
+        self.dirty_sizes = Histogram(unit=1, formatter=byte_size)
     def __len__(self):
         return self.length
     def __setitem__(self, key, value):
         start, length = self._decode_slice(key)
-        logging.info('%s write start: %d, length: %d', repr(self), start, length)
+        logging.debug('%s write start: %d, length: %d', repr(self), start, length)
         if len(value) != length:
             raise ValueError('bytes to be written do not match section size')
-        self.f.seek(start)
-        self.f.write(value)
-        self.f.flush()
+        with self.lock:
+            self.cache(start, value)
+            if self.cache_limit is not None and self.dirty_bytes > self.cache_limit:
+                self.flush()
+    def cache(self, start, value):
+        """Adds value at start to the dirty runs, merging it with the runs it
+        overlaps or touches"""
+        end = start + len(value)
+        i = bisect.bisect_right(self.dirty_starts, start) - 1
+        if i < 0 or self.dirty_starts[i] + len(self.dirty[self.dirty_starts[i]]) < start:
+            i += 1
+        j = i
+        while j < len(self.dirty_starts) and self.dirty_starts[j] <= end:
+            j += 1
+        merging = self.dirty_starts[i:j]
+        if not merging:
+            self.dirty_starts.insert(i, start)
+            self.dirty[start] = bytearray(value)
+            self.dirty_bytes += len(value)
+            return
+        first = merging[0]
+        run = self.dirty.pop(first)
+        old_bytes = len(run)
+        if start < first:
+            run[0:0] = bytearray(first - start)
+            first = start
+        for other in merging[1:]:
+            other_run = self.dirty.pop(other)
+            old_bytes += len(other_run)
+            if first + len(run) < other:
+                run.extend(bytearray(other - first - len(run)))
+            run[other - first:other - first + len(other_run)] = other_run
+        if first + len(run) < end:
+            run.extend(bytearray(end - first - len(run)))
+        run[start - first:end - first] = value
+        self.dirty_starts[i:j] = [first]
+        self.dirty[first] = run
+        self.dirty_bytes += len(run) - old_bytes
+    def flush(self, start=0, end=None):
+        """Writes the dirty runs that overlap bytes start to end to disk"""
+        with self.lock:
+            self._flush(start, end)
+    def _flush(self, start, end):
+        if end is None:
+            end = self.length
+            if self.dirty_bytes:
+                self.dirty_sizes.add(self.dirty_bytes)
+        i = max(bisect.bisect_right(self.dirty_starts, start) - 1, 0)
+        while i < len(self.dirty_starts) and self.dirty_starts[i] < end:
+            run_start = self.dirty_starts[i]
+            run = self.dirty[run_start]
+            if run_start + len(run) <= start:
+                i += 1
+                continue
+            pos = 0
+            while pos < len(run):
+                length = min(len(run) - pos, WRITE_CHUNK - (run_start + pos) % WRITE_CHUNK)
+                _pwrite(self.f.fileno(), buffer(run, pos, length), run_start + pos)
+                self.write_sizes.add(length)
+                pos += length
+            del self.dirty_starts[i]
+            del self.dirty[run_start]
+            self.dirty_bytes -= len(run)
     def __getitem__(self, key):
         start, length = self._decode_slice(key)
-        self.f.seek(start)
-        return self.f.read(length)
+        with self.lock:
+            self._flush(start, start + length)
+            self.f.seek(start)
+            return self.f.read(length)
     def _decode_slice(self, key):
         if isinstance(key, slice):
             start, step, end = key.start, key.step, key.stop
@@ -40,53 +157,186 @@ class DiskArray(object):
             start = key
             length = 1
         return start, length
+    def segments(self, start, end):
+        """(DiskArray, start, end) of each file's part of bytes start to end"""
+        return [(self, start, end)]
+    def regions(self, start, end):
+        """FileRegions covering bytes start to end, for sending with sendfile"""
+        self.flush(start, end)
+        return [FileRegion(self, start, end - start)]
+    def close(self):
+        """Writes out the cache and closes the file"""
+        self.flush()
+        self.f.close()
+class FileRegion(object):
+    """length bytes at offset in the file behind a DiskArray
+
+    Queued on a MsgConnection in place of a string so the bytes can go
+    from the file to the socket with sendfile.
+    """
+    def __init__(self, diskarray, offset, length):
+        self.diskarray = diskarray
+        self.offset = offset
+        self.length = length
+    def __len__(self):
+        return self.length
+    def __repr__(self):
+        return '<FileRegion %s %d+%d>' % (self.diskarray.f.name, self.offset, self.length)
+    def fileno(self):
+        return self.diskarray.f.fileno()
+    def read(self, skip=0):
+        """The region's bytes, starting skip bytes in"""
+        return bytes(self.diskarray[self.offset+skip:self.offset+self.length])
 class MultiFileDiskArray(DiskArray):
-    def __init__(self, sizes, files):
+    """The files' DiskArrays cache their own dirty runs, and all of them are
+    flushed once there are more than cache_limit dirty bytes between them"""
+    file_array = DiskArray
+    def __init__(self, sizes, files, cache_limit=WRITE_CACHE_LIMIT):
         self.sizes = sizes
         self.files = files
         self.starts = [sum(self.sizes[:(i)]) for i in range(len(self.sizes))]
-        self.diskarrays = [DiskArray(size, fn) for size, fn in zip(sizes, files)]
+        self.diskarrays = [self.file_array(size, fn, cache_limit=None) for size, fn in zip(sizes, files)]
         self.length = sum(sizes)
+        self.cache_limit = cache_limit
+        self.write_sizes = Histogram(unit=1, formatter=byte_size)
+        self.dirty_sizes = Histogram(unit=1, formatter=byte_size)
+        for da in self.diskarrays:
+            da.write_sizes = self.write_sizes
+            da.dirty_sizes = self.dirty_sizes
+    @property
+    def dirty_bytes(self):
+        return sum(da.dirty_bytes for da in self.diskarrays)
+    def flush(self, start=0, end=None):
+        """Writes the dirty runs that overlap bytes start to end to disk"""
+        if end is None:
+            end = self.length
+            dirty = self.dirty_bytes
+            if dirty:
+                self.dirty_sizes.add(dirty)
+        for da, file_start in zip(self.diskarrays, self.starts):
+            if file_start < end and start < file_start + len(da):
+                da.flush(max(start - file_start, 0), min(end - file_start, len(da)))
     def __setitem__(self, key, value):
         start, length = self._decode_slice(key)
         if len(value) != length:
             raise ValueError('bytes to be written do not match section size')
-        logging.info('%s write start: %d, length: %d', repr(self), start, length)
-        start_file_index = bisect.bisect_right(self.starts, start) - 1
-        logging.debug('start file index: %d', start_file_index)
+        logging.debug('%s write start: %d, length: %d', repr(self), start, length)
         written = 0
-        for file_index in range(start_file_index, len(self.files)):
-            file_location = self.starts[file_index]
-            file_size = self.sizes[file_index]
-            da = self.diskarrays[file_index]
-
-            start_in_file = start - file_location + written
-            desired_write_end = start_in_file + length - written
-            file_end_pos = min(desired_write_end, file_size)
-            da[start_in_file:file_end_pos] = value[written:written+(file_end_pos-start_in_file)]
-            written += file_end_pos - start_in_file
-
-            if desired_write_end <= file_size:
-                break
+        for da, s, e in self.segments(start, start + length):
+            da[s:e] = buffer(value, written, e - s)
+            written += e - s
+        if self.cache_limit is not None and self.dirty_bytes > self.cache_limit:
+            self.flush()
     def __getitem__(self, key):
+        """Bytes from a single file come back as that file's array returns
+        them; bytes across files are joined into a string"""
         start, length = self._decode_slice(key)
-        start_file_index = bisect.bisect_right(self.starts, start) - 1
-        data = ''
-        for file_index in range(start_file_index, len(self.files)):
-            file_location = self.starts[file_index]
-            file_size = self.sizes[file_index]
-            da = self.diskarrays[file_index]
-
-            start_in_file = start - file_location + len(data)
-            desired_read_end = start_in_file + length - len(data)
-            file_end_pos = min(desired_read_end, file_size)
-            data += da[start_in_file:file_end_pos]
-
-            if desired_read_end <= file_size:
-                break
-        return data
+        segments = self.segments(start, start + length)
+        if len(segments) == 1:
+            da, s, e = segments[0]
+            return da[s:e]
+        return ''.join(str(da[s:e]) for da, s, e in segments)
+    def segments(self, start, end):
+        """(DiskArray, start, end) of each file's part of bytes start to end
+
+        >>> import tempfile; d = tempfile.mkdtemp()
+        >>> a = MultiFileDiskArray([10, 5, 10], [d+'/a', d+'/b', d+'/c'])
+        >>> [(da.f.name[-1], s, e) for da, s, e in a.segments(8, 18)]
+        [('a', 8, 10), ('b', 0, 5), ('c', 0, 3)]
+        """
+        result = []
+        file_index = bisect.bisect_right(self.starts, start) - 1
+        while start < end:
+            file_start = self.starts[file_index]
+            file_end = file_start + self.sizes[file_index]
+            segment_end = min(end, file_end)
+            if segment_end > start:
+                result.append((self.diskarrays[file_index], start - file_start, segment_end - file_start))
+            start = segment_end
+            file_index += 1
+        return result
+    def regions(self, start, end):
+        """FileRegions covering bytes start to end, split at file boundaries
+
+        >>> import tempfile; d = tempfile.mkdtemp()
+        >>> a = MultiFileDiskArray([10, 5, 10], [d+'/a', d+'/b', d+'/c'])
+        >>> a.regions(8, 18)
+        [<FileRegion .../a 8+2>, <FileRegion .../b 0+5>, <FileRegion .../c 0+3>]
+        >>> a[:] = 'abcdefghijklmnopqrstuvwxy'; [r.read() for r in a.regions(8, 18)]
+        ['ij', 'klmno', 'pqr']
+        """
+        return [da.regions(s, e)[0] for da, s, e in self.segments(start, end)]
+    def close(self):
+        for da in self.diskarrays:
+            da.close()
+
+class MmapDiskArray(DiskArray):
+    """A DiskArray whose file is mapped into memory with mmap
+
+    The file is extended to its full size first, sparsely where the
+    filesystem allows. Reads return buffers into the map instead of copies,
+    and writes are copied straight into it, so there's no cache; the kernel
+    writes the pages out when it likes, or when flush asks it to. A buffer
+    is only good for as long as the map is, so nothing may read one after
+    close.
+
+    >>> import tempfile; d = tempfile.mkdtemp()
+    >>> a = MmapDiskArray(10, d+'/a'); os.path.getsize(d+'/a')
+    10
+    >>> a[2:5] = 'abc'; a[4:7] = bytearray('xyz'); view = a[1:8]; type(view), str(view)
+    (<type 'buffer'>, '\\x00abxyz\\x00')
+    >>> open(d+'/a', 'rb').read(8)
+    '\\x00\\x00abxyz\\x00'
+    >>> a.flush(3, 5); a.close(); a.f.closed
+    True
+    """
+    def __init__(self, size, filename, cache_limit=None):
+        DiskArray.__init__(self, size, filename, cache_limit=None)
+        if os.fstat(self.f.fileno()).st_size < size:
+            self.f.truncate(size)
+        self.map = mmap.mmap(self.f.fileno(), size) if size else None
+    def __setitem__(self, key, value):
+        start, length = self._decode_slice(key)
+        if len(value) != length:
+            raise ValueError('bytes to be written do not match section size')
+        if not length:
+            return
+        with self.lock: # the map's file position is shared
+            self.map.seek(start)
+            self.map.write(buffer(value))
+    def __getitem__(self, key):
+        start, length = self._decode_slice(key)
+        if self.map is None:
+            return ''
+        return buffer(self.map, start, length)
+    def flush(self, start=0, end=None):
+        """Has the kernel write the map's pages that overlap bytes start to
+        end to disk, and waits for it to"""
+        if self.map is None:
+            return
+        if end is None:
+            end = self.length
+        start -= start % mmap.PAGESIZE
+        if end > start:
+            self.map.flush(start, end - start)
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+        self.f.close()
+class MultiFileMmapArray(MultiFileDiskArray):
+    """A MultiFileDiskArray of MmapDiskArrays
+
+    Bytes within one file come back uncopied, so pieces that don't span
+    files are hashed straight out of the page cache.
+    """
+    file_array = MmapDiskArray
+    def __init__(self, sizes, files, cache_limit=None):
+        MultiFileDiskArray.__init__(self, sizes, files, cache_limit=None)
 
 if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
     a = DiskArray(100, '/tmp/somthing')
     a[40:45] = '\x00\x00\x00\x00e'
     a = MultiFileDiskArray([10,10,10], ['a', 'b', 'c'])
@@ -0,0 +1,68 @@
+"""Download, hash and upload access patterns per MultiFileDiskArray backend
+
+python -m bittorrent.diskbytearray_bench [MiB] [files]
+
+Writes a payload split over files 16KiB block by block in random order,
+the way blocks arrive from peers, and flushes it; then reads it back a
+piece at a time and hashes each piece, as verification does; then reads
+random blocks, as uploading does without sendfile. The files are fresh
+each run but stay in the page cache, so this measures the Python side of
+each backend rather than the disk.
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import hashlib
+import tempfile
+
+from .diskbytearray import MultiFileDiskArray, MultiFileMmapArray
+
+BLOCK = 2**14
+PIECE = 2**18
+
+def timed(f, *args):
+    start = time.time()
+    result = f(*args)
+    return time.time() - start, result
+
+def run(cls, payload, sizes, order, uploads):
+    d = tempfile.mkdtemp()
+    try:
+        data = cls(sizes, [os.path.join(d, str(i)) for i in range(len(sizes))])
+        def download():
+            for start in order:
+                data[start:start+BLOCK] = payload[start:start+BLOCK]
+            data.flush()
+        def verify():
+            return [hashlib.sha1(data[start:start+PIECE]).digest() for start in range(0, len(data), PIECE)]
+        def upload():
+            return sum(len(str(data[start:start+BLOCK])) for start in uploads)
+        t_download, _ = timed(download)
+        t_verify, digests = timed(verify)
+        t_upload, _ = timed(upload)
+        return (t_download, t_verify, t_upload), digests
+    finally:
+        shutil.rmtree(d)
+
+def main(mib=256, files=4):
+    random.seed(0)
+    length = mib * 2**20
+    payload = os.urandom(length)
+    # uneven files, so some pieces and blocks span two of them
+    cuts = sorted(random.sample(xrange(1, length), files - 1))
+    sizes = [b - a for a, b in zip([0] + cuts, cuts + [length])]
+    order = range(0, length, BLOCK)
+    random.shuffle(order)
+    uploads = [random.randrange(length // BLOCK) * BLOCK for _ in range(length // BLOCK)]
+    expected = [hashlib.sha1(payload[start:start+PIECE]).digest() for start in range(0, length, PIECE)]
+    print '%d MiB in %d files, %dKiB blocks, %dKiB pieces' % (mib, files, BLOCK // 1024, PIECE // 1024)
+    print '%-20s %9s %9s %9s' % ('', 'download', 'verify', 'upload')
+    for cls in [MultiFileDiskArray, MultiFileMmapArray]:
+        times, digests = run(cls, payload, sizes, order, uploads)
+        assert digests == expected, cls.__name__ + ' read back something else'
+        print '%-20s %8.3fs %8.3fs %8.3fs' % ((cls.__name__,) + times)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,237 @@
+"""Disk reads and writes on worker threads
+
+A DiskIO runs reads, writes and flushes of a DiskArray or
+MultiFileDiskArray on a few worker threads, so a slow disk holds up the
+workers instead of the reactor. Each operation is split at file
+boundaries and every file has its own queue, served by one worker at a
+time and in elevator order: the worker takes the next job at or past
+where the last one in that file started, wrapping around to the lowest
+offset when there's none. Files take turns, a job each. Once every part
+of an operation is done its callback runs on the reactor thread, through
+a Waker, with the bytes read or None first, or the exception if any part
+failed.
+
+Bytes waiting to be written are counted. Once the count passes
+high_water the DiskIO is congested until it falls to half that, when
+on_drain is called, so whoever is filling the queue knows to stop and
+when to start again.
+
+Jobs in a file are reordered, so writes that overlap must not be in a
+queue at the same time, and a read must wait for the writes it covers.
+
+>>> import tempfile
+>>> from .reactor_select import Reactor
+>>> from .wakeup import Waker
+>>> from .diskbytearray import MultiFileDiskArray
+>>> d = tempfile.mkdtemp()
+>>> data = MultiFileDiskArray([5, 6, 2], [d+'/a', d+'/b', d+'/c'])
+>>> r = Reactor(); io = DiskIO(Waker(r), workers=2, high_water=8); done = []
+>>> io.write(data, 0, 'abcdefg', lambda *args: done.append(args), 'first')
+>>> io.congested
+False
+>>> io.write(data, 7, 'hijklm', lambda *args: done.append(args), 'second')
+>>> io.congested, io.queued_bytes
+(True, 13)
+>>> while len(done) < 2: _ = r.poll(1)
+>>> sorted(done), io.congested, io.queued_bytes
+([(None, 'first'), (None, 'second')], False, 0)
+>>> io.read(data, 3, 8, done.append)
+>>> while len(done) < 3: _ = r.poll(1)
+>>> done[2]
+'defghijk'
+>>> data.diskarrays[2].f.close(); io.read(data, 3, 9, done.append)
+>>> while len(done) < 4: _ = r.poll(1)
+>>> done[3]
+ValueError('I/O operation on closed file',)
+>>> io.close()
+"""
+import bisect
+import logging
+import threading
+import collections
+
+DISK_WORKERS = 4
+DISK_HIGH_WATER = 32*2**20 # bytes waiting to be written before the queue is congested
+
+class _FileQueue(object):
+    """Jobs waiting on one file, by offset, and whether a worker is on it"""
+    def __init__(self):
+        self.jobs = [] # sorted (offset, seq, job)
+        self.head = 0 # offset of the last job taken
+        self.busy = False
+
+    def add(self, offset, seq, job):
+        bisect.insort(self.jobs, (offset, seq, job))
+
+    def next(self):
+        """Removes and returns (offset, job) of the next job in elevator order
+
+        >>> q = _FileQueue()
+        >>> for seq, offset in enumerate([50, 10, 30]): q.add(offset, seq, 'job')
+        >>> q.next()[0], q.next()[0]
+        (10, 30)
+        >>> q.add(20, 3, 'job'); q.add(40, 4, 'job')
+        >>> q.next()[0], q.next()[0], q.next()[0]
+        (40, 50, 20)
+        """
+        i = bisect.bisect_left(self.jobs, (self.head,))
+        if i == len(self.jobs):
+            i = 0
+        offset, _, job = self.jobs.pop(i)
+        self.head = offset
+        return offset, job
+
+class _Operation(object):
+    """A read, write or flush, split into a job per file"""
+    def __init__(self, kind, data, parts, write_bytes, callback, args):
+        self.kind = kind
+        self.data = data
+        self.remaining = parts
+        self.results = [None] * parts
+        self.write_bytes = write_bytes
+        self.callback = callback
+        self.args = args
+
+class DiskIO(object):
+    def __init__(self, waker, workers=DISK_WORKERS, high_water=DISK_HIGH_WATER, on_drain=None):
+        """With workers=0, operations run right away on the calling thread"""
+        self.waker = waker
+        self.high_water = high_water
+        self.on_drain = on_drain
+        self.queued_bytes = 0
+        self.congested = False
+        self.seq = 0
+        self.queues = {} # DiskArray -> _FileQueue
+        self.ready = collections.deque() # DiskArrays with jobs waiting and no worker on them
+        self.lock = threading.Lock()
+        self.jobs_waiting = threading.Condition(self.lock)
+        self.closed = False
+        self.threads = []
+        for _ in range(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def write(self, data, start, block, callback=None, *args):
+        """Writes block (a string or bytearray that mustn't change until it's
+        written) at start in data, then calls callback(None, *args) on the
+        reactor thread, or callback(exception, *args) if it failed
+
+        The bytes go into data's write-back cache; see flush.
+        """
+        parts = []
+        done = 0
+        for da, s, e in data.segments(start, start + len(block)):
+            parts.append((da, s, buffer(block, done, e - s)))
+            done += e - s
+        self._submit('write', data, parts, len(block), callback, args)
+
+    def read(self, data, start, length, callback, *args):
+        """Reads length bytes at start in data, then calls callback(bytes, *args)
+        on the reactor thread, or callback(exception, *args) if it failed"""
+        self._submit('read', data, data.segments(start, start + length), 0, callback, args)
+
+    def flush(self, data, start=0, end=None, callback=None, *args):
+        """Writes the cached bytes of data that overlap start to end to disk,
+        then calls callback(None, *args) on the reactor thread, or
+        callback(exception, *args) if it failed"""
+        if end is None:
+            end = len(data)
+        self._submit('flush', data, data.segments(start, end), 0, callback, args)
+
+    def _submit(self, kind, data, parts, write_bytes, callback, args):
+        """parts: (DiskArray, offset, end or bytes to write) of each file of data"""
+        op = _Operation(kind, data, len(parts), write_bytes, callback, args)
+        self.queued_bytes += write_bytes
+        if self.queued_bytes > self.high_water:
+            self.congested = True
+        if not parts:
+            self._done(op, None, None)
+        elif not self.threads:
+            for i, (da, offset, arg) in enumerate(parts):
+                self._done(op, i, self._try(op, da, offset, arg))
+        else:
+            with self.lock:
+                for i, (da, offset, arg) in enumerate(parts):
+                    queue = self.queues.get(da)
+                    if queue is None:
+                        queue = self.queues[da] = _FileQueue()
+                    if not queue.jobs and not queue.busy:
+                        self.ready.append(da)
+                    self.seq += 1
+                    queue.add(offset, self.seq, (op, i, arg))
+                self.jobs_waiting.notify(len(parts))
+
+    def _run(self, op, da, offset, arg):
+        if op.kind == 'write':
+            da[offset:offset+len(arg)] = arg
+            # a MultiFileDiskArray's files don't check its cache limit themselves
+            if op.data.cache_limit is not None and op.data.dirty_bytes > op.data.cache_limit:
+                da.flush()
+        elif op.kind == 'read':
+            return da[offset:arg]
+        else:
+            da.flush(offset, arg)
+
+    def _try(self, op, da, offset, arg):
+        """Runs a job, returning the exception if it raises one"""
+        try:
+            return self._run(op, da, offset, arg)
+        except Exception as e:
+            logging.exception('disk %s of %r at %d failed', op.kind, da, offset)
+            return e
+
+    def _work(self):
+        while True:
+            with self.lock:
+                while not self.ready and not self.closed:
+                    self.jobs_waiting.wait()
+                if not self.ready:
+                    return # closed, and nothing left that another worker isn't on
+                da = self.ready.popleft()
+                queue = self.queues[da]
+                queue.busy = True
+                offset, (op, i, arg) = queue.next()
+            result = self._try(op, da, offset, arg)
+            with self.lock:
+                queue.busy = False
+                if queue.jobs:
+                    self.ready.append(da)
+                    self.jobs_waiting.notify()
+                else:
+                    del self.queues[da]
+            self.waker.post(self._done, op, i, result)
+
+    def _done(self, op, i, result):
+        if i is not None:
+            op.results[i] = result
+            op.remaining -= 1
+        if op.remaining > 0:
+            return
+        self.queued_bytes -= op.write_bytes
+        if op.callback is not None:
+            failed = [result for result in op.results if isinstance(result, Exception)]
+            if failed:
+                op.callback(failed[0], *op.args)
+            elif op.kind == 'read' and len(op.results) == 1:
+                op.callback(op.results[0], *op.args) # uncopied, if the file's array doesn't copy
+            elif op.kind == 'read':
+                op.callback(''.join(str(result) for result in op.results), *op.args)
+            else:
+                op.callback(None, *op.args)
+        if self.congested and self.queued_bytes <= self.high_water // 2:
+            self.congested = False
+            if self.on_drain is not None:
+                self.on_drain()
+
+    def close(self):
+        """Waits for the workers to finish every queued job and stop; the
+        callbacks are handed back the next time the reactor polls, and
+        operations submitted after this run right away"""
+        with self.lock:
+            self.closed = True
+            self.jobs_waiting.notify_all()
+        for t in self.threads:
+            t.join()
+        self.threads = []
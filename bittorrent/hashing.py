@@ -0,0 +1,70 @@
+"""SHA-1 piece verification on worker threads
+
+hashlib releases the GIL while it hashes (when it's built with OpenSSL),
+so pieces submitted to a HashPool are hashed in parallel with each other and with the reactor.
+Each digest is handed back on the reactor thread through a Waker.
+
+>>> from .reactor_select import Reactor
+>>> from .wakeup import Waker
+>>> import hashlib
+>>> r = Reactor(); pool = HashPool(Waker(r), workers=2); results = []
+>>> for i, data in enumerate(['a'*50000, 'b'*70000]):
+...     pool.submit(data, lambda digest, i: results.append((i, digest)), i)
+>>> while pool.pending: _ = r.poll(1)
+>>> sorted(results) == [(0, hashlib.sha1('a'*50000).digest()), (1, hashlib.sha1('b'*70000).digest())]
+True
+>>> pool.close()
+"""
+import hashlib
+import threading
+import multiprocessing
+import Queue
+
+try:
+    HASH_WORKERS = multiprocessing.cpu_count()
+except NotImplementedError:
+    HASH_WORKERS = 1
+
+class HashPool(object):
+    def __init__(self, waker, workers=HASH_WORKERS):
+        """With workers=0, submit hashes right away on the calling thread"""
+        self.waker = waker
+        self.queue = Queue.Queue()
+        self.pending = 0
+        self.threads = []
+        for _ in range(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, data, callback, *args):
+        """Hashes data (a string or buffer that mustn't change until it's hashed),
+        then calls callback(digest, *args) on the reactor thread"""
+        if not self.threads:
+            callback(hashlib.sha1(data).digest(), *args)
+            return
+        self.pending += 1
+        self.queue.put((data, callback, args))
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            data, callback, args = job
+            self.waker.post(self._done, hashlib.sha1(data).digest(), callback, args)
+
+    def _done(self, digest, callback, args):
+        self.pending -= 1
+        callback(digest, *args)
+
+    def close(self):
+        """Waits for the workers to hash what's been submitted and stop; their
+        digests are handed back the next time the reactor polls, and anything
+        submitted after this is hashed right away"""
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
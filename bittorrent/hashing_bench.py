@@ -0,0 +1,48 @@
+"""Piece hashing throughput of HashPool with 1 to N worker threads
+
+python -m bittorrent.hashing_bench [max_workers] [piece_MiB] [num_pieces]
+
+Runs the pool on a real reactor, the way ActiveTorrent uses it, so the
+numbers include handing each digest back through the Waker. workers=0
+is the old behaviour of hashing inline on the reactor thread.
+
+How throughput scales from 1 to N workers hasn't been measured: this was
+written on a machine with one CPU and a hashlib without OpenSSL, whose
+SHA-1 holds the GIL, where more workers made no difference. Run it on
+several cores before relying on the scaling.
+"""
+import os
+import sys
+import time
+
+from .reactor_select import Reactor
+from .wakeup import Waker
+from .hashing import HashPool, HASH_WORKERS
+
+def run(workers, pieces):
+    reactor = Reactor()
+    waker = Waker(reactor)
+    pool = HashPool(waker, workers)
+    done = []
+    start = time.time()
+    for piece in pieces:
+        pool.submit(piece, lambda digest: done.append(digest))
+    while len(done) < len(pieces):
+        reactor.poll(1)
+    elapsed = time.time() - start
+    pool.close()
+    waker.close()
+    return elapsed
+
+def main(max_workers=HASH_WORKERS, piece_mib=4, num_pieces=64):
+    pieces = [os.urandom(piece_mib * 2**20) for _ in range(num_pieces)]
+    total = piece_mib * num_pieces
+    baseline = run(0, pieces)
+    print 'inline    %7.1f MiB/s' % (total / baseline)
+    for workers in range(1, max_workers + 1):
+        elapsed = run(workers, pieces)
+        print '%2d worker%s %7.1f MiB/s  (%.2fx inline)' % (
+                workers, ' ' if workers == 1 else 's', total / elapsed, baseline / elapsed)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -36,6 +36,8 @@ Handshake(pstr='BitTorrent protocol', reserved='\x00\x00\x00\x00\x00\x00\x00\x00
 Bitfield(bitfield='\x00\x01')
 >>> Bitfield('\x00\x01')
 Bitfield(bitfield='\x00\x01')
+>>> Cancel(1, 2, 3), Msg(bytestring=str(Cancel(1, 2, 3)))[0].length
+(Cancel(index=1, begin=2, length=3), 3)
 """
 
 import re
@@ -204,6 +206,69 @@ def parse_messages(buff):
         messages.append(m)
     return messages, buff
 
+def piece_header(index, begin, length):
+    r"""The 13 bytes that precede a block of length bytes in a Piece message
+
+    >>> piece_header(1, 0, 4) + 'asdf' == Piece(index=1, begin=0, block='asdf')
+    True
+    """
+    return struct.pack('!IBII', 9 + length, Piece.msg_id, index, begin)
+
+def parse_messages_from(buff, start=0, end=None):
+    r"""Parses complete messages out of buff[start:end], returns (messages, new_start)
+
+    Piece messages come back as PieceViews whose block is a memoryview into
+    buff rather than a copy, so they're only good until buff is reused.
+    Bytes of an incomplete message at the end are left for the next call.
+
+    >>> buff = bytearray(Have(index=3) + Piece(index=1, begin=2, block='abc') + '\x00\x00')
+    >>> messages, start = parse_messages_from(buff); messages, start
+    ([Have(index=3), Piece(index=1, begin=2, block='abc')], 25)
+    >>> messages[1].block.tobytes()
+    'abc'
+    >>> parse_messages_from(buff, 9, 20)
+    ([], 9)
+    """
+    if end is None:
+        end = len(buff)
+    view = memoryview(buff)
+    messages = []
+    while end - start >= 4:
+        if end - start >= 68 and buff[start:start+20] == '\x13BitTorrent protocol':
+            m, _ = Handshake(bytestring=str(buff[start:start+68]))
+            start += 68
+            messages.append(m)
+            continue
+        (msg_length,) = struct.unpack_from('!I', buff, start)
+        if end - start < msg_length + 4:
+            break
+        if msg_length >= 9 and struct.unpack_from('!B', buff, start+4)[0] == Piece.msg_id:
+            index, begin = struct.unpack_from('!II', buff, start+5)
+            m = PieceView(index, begin, view[start+13:start+4+msg_length])
+        else:
+            m, _ = Msg(bytestring=str(buff[start:start+4+msg_length]))
+        start += 4 + msg_length
+        messages.append(m)
+    return messages, start
+
+class PieceView(object):
+    """Received Piece message with a block that is a view into a receive buffer
+
+    Quacks like a Piece for recv_msg; copy block (block.tobytes()) to keep it
+    around after the message has been processed.
+    """
+    kind = 'piece'
+    def __init__(self, index, begin, block):
+        self.index_ = index
+        self.begin = begin
+        self.block = block
+    def __len__(self):
+        return 13 + len(self.block)
+    def __repr__(self):
+        payload = self.block[:30].tobytes()
+        return 'Piece(index=%d, begin=%d, block=%s)' % (self.index_, self.begin,
+                repr(payload)+('...' if len(self.block) > 30 else ''))
+
 class KeepAlive(Msg):
     msg_id = None
     def __init__(self): pass
@@ -253,6 +318,7 @@ class Piece(Msg):
         return Msg.__new__(cls, index=index, begin=begin, block=block, **kwargs)
 class Cancel(Msg):
     msg_id = 8
+    protocol_args = ['index', 'begin', 'length']
     def __init__(self, index=0, begin=0, length=0, **kwargs): pass
     def __new__(cls, index=0, begin=0, length=0, **kwargs):
         return Msg.__new__(cls, index=index, begin=begin, length=length, **kwargs)
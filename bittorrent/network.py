@@ -1,11 +1,19 @@
 """Trying to approximate what Twisted does"""
 import time
+import errno
 import socket
 import msg
 import logging
+import collections
+
+from diskbytearray import FileRegion
+from syscalls import writev, sendfile
 
 WAIT_TO_CONNECT = 8
 KEEP_ALIVE_TIME = 20
+RECV_BUFFER_SIZE = 256*1024 # initial size of each connection's receive buffer
+MIN_RECV_SPACE = 2**14 + 13 # room for at least one full piece message per recv
+IOV_MAX = 1024 # most segments handed to one writev call
 
 class AcceptingConnection(object):
     def __init__(self, ip, port, reactor, object):
@@ -40,17 +48,62 @@ class MsgConnection(object):
         self.port = port
         self.reactor = reactor
         self.has_received_data = False
-        self.messages_to_send = []
-        self.write_buffer = ''
-        self.read_buffer = ''
-        #TODO don't use strings for buffers
+        self.send_queue = collections.deque() # strings and buffers waiting to be sent
+        self.send_offset = 0 # bytes of send_queue[0] already sent
+        self.read_buffer = bytearray(RECV_BUFFER_SIZE)
+        self.read_view = memoryview(self.read_buffer)
+        self.read_start = 0 # first byte not yet parsed into a message
+        self.read_end = 0 # end of received data
         self.connect(sock=sock)
 
     def send_msg(self, *messages):
         assert isinstance(messages[0], msg.Msg)
-        self.messages_to_send.extend(messages)
+        for m in messages:
+            logging.info('%s scheduling send of message %s', repr(self.object), repr(m))
+        self.send_queue.extend(messages)
+        self.reactor.reg_write(self.s)
+
+    def send_piece(self, index, begin, block):
+        """Queues a piece message without copying block into it
+
+        block can be any string or buffer; it goes out as its own segment
+        after the 13 byte header, so it must not change until it's sent.
+        """
+        logging.info('%s scheduling send of piece(%d, %d, %d)', repr(self.object), index, begin, len(block))
+        self.send_queue.append(msg.piece_header(index, begin, len(block)))
+        self.send_queue.append(block)
         self.reactor.reg_write(self.s)
 
+    def send_piece_from_disk(self, index, begin, regions):
+        """Queues a piece message whose block is read from disk as it's sent
+
+        regions are diskbytearray.FileRegions, whose bytes go from the file
+        to the socket with sendfile without passing through Python; only
+        queue them where there's sendfile.
+        """
+        length = sum(len(r) for r in regions)
+        logging.info('%s scheduling send of piece(%d, %d, %d) from disk', repr(self.object), index, begin, length)
+        self.send_queue.append(msg.piece_header(index, begin, length))
+        self.send_queue.extend(regions)
+        self.reactor.reg_write(self.s)
+
+    def cancel_piece(self, index, begin, length):
+        """Drops a queued piece message that hasn't started going out yet
+
+        Returns whether there was one to drop.
+        """
+        header = msg.piece_header(index, begin, length)
+        for i, segment in enumerate(self.send_queue):
+            if i == 0 and self.send_offset:
+                continue
+            if len(segment) == len(header) and isinstance(segment, str) and segment == header:
+                del self.send_queue[i]
+                while length:
+                    length -= len(self.send_queue[i])
+                    del self.send_queue[i]
+                return True
+        return False
+
     def die(self):
         self.reactor.unreg_write(self.s)
         self.reactor.unreg_read(self.s)
@@ -61,6 +114,7 @@ class MsgConnection(object):
         """Establishes TCP connection to peer and sends handshake and bitfield"""
         if sock: # then we're responding to a peer
             self.s = sock
+            self.s.setblocking(False)
         else:
             self.s = socket.socket()
             logging.info('connecting to %s on port %d...', self.ip, self.port)
@@ -92,39 +146,104 @@ class MsgConnection(object):
         if not self.has_received_data:
             logging.info('%s has connected!', repr(self))
             self.has_received_data = True
-        while self.messages_to_send:
+        if self.send_queue:
             self.last_sent_data = time.time()
-            m = self.messages_to_send.pop(0)
-            logging.info('%s scheduling send of message %s', repr(self.object), repr(m))
-            self.write_buffer += m
-            logging.debug('which translates to %d bytes: %s', len(self.write_buffer), repr(self.write_buffer))
-        if self.write_buffer:
-            sent = self.s.send(self.write_buffer)
+            try:
+                sent = self.send_segments()
+            except socket.error as e:
+                logging.info('%s dieing because send failed: %s', repr(self), e)
+                self.object.die()
+                return
             logging.info('%s sent %d bytes', self, sent)
-            self.write_buffer = self.write_buffer[sent:]
-        if not self.write_buffer:
+        if not self.send_queue:
             self.reactor.unreg_write(self.s)
 
+    def send_segments(self):
+        """Sends as much of the send queue as the socket takes, returns bytes sent
+
+        Uses one writev call for up to IOV_MAX segments where available,
+        otherwise sends segment by segment until the socket is full.
+        FileRegions go out with sendfile. Partially sent segments are
+        tracked with self.send_offset, not sliced.
+        """
+        total = 0
+        while self.send_queue:
+            first = self.send_queue[0]
+            try:
+                if isinstance(first, FileRegion):
+                    wanted = len(first) - self.send_offset
+                    sent = sendfile(self.s.fileno(), first.fileno(), first.offset + self.send_offset, wanted)
+                elif writev is not None:
+                    segments = [buffer(first, self.send_offset) if self.send_offset else first]
+                    for i in range(1, min(IOV_MAX, len(self.send_queue))):
+                        if isinstance(self.send_queue[i], FileRegion):
+                            break
+                        segments.append(self.send_queue[i])
+                    sent = writev(self.s.fileno(), segments)
+                    wanted = sum(len(x) for x in segments)
+                else:
+                    sent = self.s.send(buffer(first, self.send_offset) if self.send_offset else first)
+                    wanted = len(first) - self.send_offset
+            except (socket.error, OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            self.advance_send_queue(sent)
+            total += sent
+            if sent < wanted:
+                break
+        return total
+
+    def advance_send_queue(self, sent):
+        while sent:
+            remaining = len(self.send_queue[0]) - self.send_offset
+            if sent < remaining:
+                self.send_offset += sent
+                return
+            sent -= remaining
+            self.send_queue.popleft()
+            self.send_offset = 0
+
+    def make_room(self):
+        """Moves unparsed bytes to the front of the receive buffer, growing it if
+        they wouldn't leave MIN_RECV_SPACE free"""
+        leftover = self.read_end - self.read_start
+        if leftover + MIN_RECV_SPACE > len(self.read_buffer):
+            new_buffer = bytearray(max(2 * len(self.read_buffer), leftover + MIN_RECV_SPACE))
+            new_buffer[:leftover] = self.read_view[self.read_start:self.read_end]
+            self.read_buffer = new_buffer
+            self.read_view = memoryview(new_buffer)
+        else:
+            self.read_buffer[:leftover] = self.read_buffer[self.read_start:self.read_end]
+        self.read_start = 0
+        self.read_end = leftover
+
     def read_event(self):
-        """Action to take if socket comes up as ready be read from"""
-        #TODO don't hardcode this number
+        """Action to take if socket comes up as ready be read from
+
+        Receives straight into self.read_buffer; piece messages handed to
+        recv_msg hold views into it, which are only valid until the next read.
+        """
+        if len(self.read_buffer) - self.read_end < MIN_RECV_SPACE:
+            self.make_room()
         try:
-            s = self.s.recv(1024*1024)
+            received = self.s.recv_into(self.read_view[self.read_end:])
         except socket.error:
             logging.info('%s dieing because connection refused', repr(self))
             self.object.die() # since reading nothing from a socket means closed
             return
-        if not s:
+        if not received:
             logging.info('%s dieing because received read event but nothing to read on socket', repr(self))
             self.object.die() # since reading nothing from a socket means closed
             return
-        logging.debug('received data: %s', repr(s))
         self.last_received_data = time.time()
-        buff = self.read_buffer + s
-        logging.info('%s received %d bytes', self, len(buff))
-        messages, self.read_buffer = msg.parse_messages(buff)
+        self.read_end += received
+        logging.info('%s received %d bytes', self, received)
+        messages, self.read_start = msg.parse_messages_from(self.read_buffer, self.read_start, self.read_end)
+        if self.read_start == self.read_end:
+            self.read_start = self.read_end = 0
         logging.debug('received messages: %s', repr(messages))
-        logging.debug('with leftover bytes: %s', repr(self.read_buffer))
+        logging.debug('with %d leftover bytes', self.read_end - self.read_start)
         for m in messages:
             logging.info('%s received message: %s', repr(self.object), repr(m))
             self.object.recv_msg(m)
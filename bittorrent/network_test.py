@@ -0,0 +1,125 @@
+"""Sends messages and pieces through a MsgConnection over a socket pair
+
+python -m bittorrent.network_test
+
+The connection's end is the one the reactor watches; the test reads the
+other end itself and checks the bytes that come out, and counts the
+writev and sendfile calls it took to send them.
+"""
+import os
+import socket
+import tempfile
+
+from . import msg
+from . import network
+from .network import MsgConnection
+from .reactor_select import Reactor
+from .diskbytearray import MultiFileDiskArray, FileRegion
+
+class Recorder(object):
+    def __init__(self):
+        self.messages = []
+        self.dead = False
+    def recv_msg(self, m):
+        self.messages.append(m)
+    def die(self):
+        self.dead = True
+
+def connection():
+    ours, theirs = socket.socketpair()
+    c = MsgConnection('127.0.0.1', 0, Reactor(), Recorder(), sock=ours)
+    return c, theirs
+
+def counting_writev():
+    """Swaps network.writev for one that records how many segments each call had"""
+    calls = []
+    real = network.writev
+    def writev(fd, segments):
+        calls.append(len(segments))
+        return real(fd, segments)
+    network.writev = writev
+    return calls, real
+
+def recv_all(s, length):
+    got = []
+    while length:
+        data = s.recv(length)
+        assert data, 'connection closed'
+        got.append(data)
+        length -= len(data)
+    return ''.join(got)
+
+def test_one_writev():
+    """A message and two pieces, each header and block a segment, go out in
+    one writev call"""
+    c, theirs = connection()
+    calls, real = counting_writev()
+    try:
+        block = bytearray(os.urandom(2**14))
+        c.send_msg(msg.Have(index=3))
+        c.send_piece(0, 0, block)
+        c.send_piece(0, 2**14, buffer('x' + str(block), 1))
+        expected = (str(msg.Have(index=3)) + msg.piece_header(0, 0, 2**14) + str(block) +
+                    msg.piece_header(0, 2**14, 2**14) + str(block))
+        c.write_event()
+        assert calls == [5], calls
+        assert not c.send_queue
+        assert recv_all(theirs, len(expected)) == expected
+    finally:
+        network.writev = real
+
+def test_partial_writes():
+    """When the socket only takes part of the queue, what's left goes out from
+    where it stopped, in as many writev calls as it takes"""
+    c, theirs = connection()
+    c.s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    calls, real = counting_writev()
+    try:
+        blocks = [os.urandom(2**14 + i) for i in range(20)]
+        expected = ''
+        for i, block in enumerate(blocks):
+            c.send_piece(i, 0, block)
+            expected += msg.piece_header(i, 0, len(block)) + block
+        got = ''
+        while c.send_queue:
+            c.write_event()
+            got += theirs.recv(2**20)
+        while len(got) < len(expected):
+            got += theirs.recv(2**20)
+        assert got == expected
+        assert len(calls) > 1 and not c.object.dead
+    finally:
+        network.writev = real
+
+def test_sendfile():
+    """A piece from disk goes out with a sendfile call per file it's in, and
+    none of its bytes are read into Python"""
+    c, theirs = connection()
+    d = tempfile.mkdtemp()
+    data = MultiFileDiskArray([2**14 + 100, 2**14], [d+'/a', d+'/b'])
+    payload = os.urandom(len(data))
+    data[:] = payload
+    calls = []
+    real = network.sendfile
+    def sendfile(out_fd, in_fd, offset, count):
+        calls.append((offset, count))
+        return real(out_fd, in_fd, offset, count)
+    network.sendfile = sendfile
+    read = FileRegion.read
+    def no_read(self, skip=0):
+        raise AssertionError('read into Python')
+    FileRegion.read = no_read
+    try:
+        c.send_piece_from_disk(1, 0, data.regions(2**14, 2**15))
+        c.write_event()
+        assert calls == [(2**14, 100), (0, 2**14 - 100)], calls
+        expected = msg.piece_header(1, 0, 2**14) + payload[2**14:2**15]
+        assert recv_all(theirs, len(expected)) == expected
+    finally:
+        network.sendfile = real
+        FileRegion.read = read
+
+if __name__ == '__main__':
+    for test in [test_one_writev, test_partial_writes, test_sendfile]:
+        test()
+        print test.__name__, 'ok'
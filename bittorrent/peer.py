@@ -6,8 +6,18 @@ import bitstring
 import msg
 import peerstrategy
 from network import MsgConnection
+from syscalls import sendfile
+from requesttracker import RequestTracker
 
-REQUEST_MSG_TIMEOUT = 120
+REQUEST_MSG_TIMEOUT = 60 # longest we wait for a block, and how long before we know the peer's RTT
+MIN_REQUEST_TIMEOUT = 5
+REQUEST_TIMEOUT_RTTS = 4 # how many smoothed RTTs a block may take to arrive
+SNUB_AFTER_STALLS = 3 # timeouts in a row without a block before a peer is snubbed
+DEFAULT_REQUEST_QUEUE = 10 # outstanding requests before we've measured anything
+MIN_REQUEST_QUEUE = 2
+MAX_REQUEST_QUEUE = 250
+REQUEST_QUEUE_TIME = 1.0 # seconds of download to keep requested on top of the round trip
+RATE_SMOOTHING = .5 # weight of the latest second in download_rate
 
 class Peer(object):
     """Represents a connection to a peer regarding a specific torrent
@@ -27,9 +37,23 @@ class Peer(object):
         self.dead = False
 
         self.bytes_sent = 0
+        self.bytes_received = 0
 
         #this might depend on the type of peer later
         self.preferred_request_length = 2**14
+
+        # request pipelining: see update_request_queue_depth
+        self.request_queue_depth = DEFAULT_REQUEST_QUEUE
+        self.min_request_queue = MIN_REQUEST_QUEUE
+        self.max_request_queue = MAX_REQUEST_QUEUE
+        self.download_rate = 0.0 # bytes per second, smoothed
+        self.rtt = None # seconds from request to block, smoothed
+        self.min_rtt = None
+        self.last_rate_update = time.time()
+        self.bytes_at_last_update = 0
+
+        self.stalls = 0 # checks in a row that found requests timed out
+        self.snubbed = False
         self.strategy = lambda x: False
 
         if active_torrent is not None:
@@ -48,21 +72,22 @@ class Peer(object):
         self.torrent = active_torrent
         self.reactor = self.torrent.client.reactor
 
-        self.outstanding_requests = {}
+        self.outstanding_requests = RequestTracker(active_torrent.request_copies)
         self.peer_interested = False
         self.interested = False
         self.choked = True
         self.peer_choked = False
         self.peer_bitfield = bitstring.BitArray(len(active_torrent.piece_hashes))
+        self.uploads_reading = set() # requests whose blocks are being read to send
 
         #if we already have a connection, then we are responding to a peer connection
         if self.connection:
             self.send_msg(msg.Handshake(info_hash=self.torrent.info_hash, peer_id=self.torrent.client.client_id))
-            self.send_msg(msg.Bitfield(self.torrent.piece_checked.tobytes()))
+            self.send_msg(msg.Bitfield(self.torrent.blocks.bitfield()))
         else:
             self.connection = MsgConnection(self.ip, self.port, self.reactor, self)
             self.send_msg(msg.Handshake(info_hash=self.torrent.info_hash, peer_id=self.torrent.client.client_id))
-            self.send_msg(msg.Bitfield(self.torrent.piece_checked.tobytes()))
+            self.send_msg(msg.Bitfield(self.torrent.blocks.bitfield()))
             self.send_msg(msg.Unchoke())
 
     def respond(self, s):
@@ -81,12 +106,108 @@ class Peer(object):
     def send_msg(self, *messages):
         for m in messages:
             if m.kind == 'request':
-                self.outstanding_requests[m] = time.time()
+                now = time.time()
+                self.outstanding_requests.add(m, now, now + self.request_timeout())
             if m.kind == 'piece':
                 self.bytes_sent += len(m.block)
         self.connection.send_msg(*messages)
 
+    def request_timeout(self):
+        """Seconds a request sent now has to be answered in
+
+        Until this peer has delivered anything, goes by how long other
+        peers' blocks have been taking.
+        """
+        rtt = self.rtt
+        if rtt is None and self.torrent.request_latency.count:
+            rtt = self.torrent.request_latency.percentile(90)
+        if rtt is None:
+            return REQUEST_MSG_TIMEOUT
+        return max(MIN_REQUEST_TIMEOUT, min(REQUEST_MSG_TIMEOUT, REQUEST_TIMEOUT_RTTS * rtt))
+
+    def cancel_request(self, m):
+        """Takes back request m if it's outstanding, returns whether it was"""
+        if self.outstanding_requests.pop(m, None) is None:
+            return False
+        self.send_msg(msg.Cancel(m.index_, m.begin, m.length))
+        return True
+
+    def send_piece(self, index, begin, block):
+        """Sends a piece message, with block passed through to the connection uncopied"""
+        self.bytes_sent += len(block)
+        self.connection.send_piece(index, begin, block)
+
+    def send_piece_from_disk(self, index, begin, regions):
+        """Sends a piece message whose block is sent straight from FileRegions"""
+        self.bytes_sent += sum(len(r) for r in regions)
+        self.connection.send_piece_from_disk(index, begin, regions)
+
+    def block_read(self, block, m):
+        """Sends the block read from disk for request m, unless the request was
+        canceled or we died while it was being read"""
+        if m not in self.uploads_reading or self.dead:
+            return
+        self.uploads_reading.discard(m)
+        if isinstance(block, Exception):
+            logging.warning('%s couldn\'t read piece(%d, %d, %d) to send: %s', repr(self), m.index_, m.begin, m.length, block)
+            return
+        logging.info('sending piece(%d, %d, %d) to %s', m.index_, m.begin, m.length, self)
+        self.send_piece(m.index_, m.begin, block)
+
+    def record_block(self, length, latency):
+        """Notes a requested block of length bytes arriving latency seconds after we asked"""
+        self.bytes_received += length
+        self.stalls = 0
+        if self.snubbed:
+            logging.info('%s is delivering again, no longer snubbed', self)
+            self.snubbed = False
+            self.request_queue_depth = self.min_request_queue
+        self.rtt = latency if self.rtt is None else .875 * self.rtt + .125 * latency
+        self.min_rtt = latency if self.min_rtt is None else min(self.min_rtt, latency)
+
+    def update_request_queue_depth(self):
+        """Sizes the request queue to the bandwidth-delay product of the link
+
+        Keeps enough requests outstanding to cover download_rate for a round
+        trip (min_rtt, which leaves out time requests spend queued) plus
+        REQUEST_QUEUE_TIME. While the queue is what limits the rate, every
+        update grows it by about (min_rtt + REQUEST_QUEUE_TIME) / rtt until the
+        link is full, where it settles. Clamped to min_request_queue and
+        max_request_queue.
+        """
+        now = time.time()
+        elapsed = now - self.last_rate_update
+        if elapsed <= 0 or self.snubbed:
+            return
+        rate = (self.bytes_received - self.bytes_at_last_update) / elapsed
+        self.download_rate = RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * self.download_rate
+        self.last_rate_update = now
+        self.bytes_at_last_update = self.bytes_received
+        if self.min_rtt is None:
+            return
+        bdp = self.download_rate * (self.min_rtt + REQUEST_QUEUE_TIME)
+        depth = int(bdp / self.preferred_request_length) + 1
+        depth = max(self.min_request_queue, min(self.max_request_queue, depth))
+        if depth != self.request_queue_depth:
+            logging.debug('%s request queue depth %d -> %d', self, self.request_queue_depth, depth)
+            self.request_queue_depth = depth
+
+    def stats(self):
+        return {
+            'download_rate': self.download_rate,
+            'rtt': self.rtt,
+            'min_rtt': self.min_rtt,
+            'request_queue_depth': self.request_queue_depth,
+            'snubbed': self.snubbed,
+            'outstanding_requests': len(getattr(self, 'outstanding_requests', ())),
+            'bytes_received': self.bytes_received,
+            'bytes_sent': self.bytes_sent,
+        }
+
     def timer_event(self):
+        if self.torrent is not None:
+            self.check_outstanding_requests()
+            self.update_request_queue_depth()
         self.run_strategy()
         if not self.dead:
             self.reactor.start_timer(1, self)
@@ -97,26 +218,39 @@ class Peer(object):
             raise Exception("Double Death")
         self.dead = True
         self.connection.die()
-        self.return_outstanding_requests()
         self.reactor.cancel_timers(self)
         if self.torrent is not None:
+            self.return_outstanding_requests()
+            self.torrent.swarm.remove(self)
             self.torrent.kill_peer(self)
         else:
             self.client.kill_peer(self)
 
     def check_outstanding_requests(self):
-        now = time.time()
-        for m, t_sent in list(self.outstanding_requests.iteritems()):
-            t = now - t_sent
-            if t > REQUEST_MSG_TIMEOUT:
-                #print 'canceling message which has been outstanding for over a minute:',
-                logging.info('outstanding request: request(%d, %d, %d) is %d seconds old', m.index_, m.begin, m.length, time.time() - t_sent)
-                #self.send_msg(msg.Cancel(m.index_, m.begin, m.length))
-                #self.torrent.return_outstanding_request(m)
-                #del self.outstanding_requests[msg.Request(m.index_, m.begin, m.length)]
+        """Cancels requests that are past their deadline so other peers can be
+        asked, and snubs the peer if it keeps letting them time out"""
+        expired = self.outstanding_requests.expired(time.time())
+        if not expired:
+            return
+        logging.info('%s let %d requests time out', self, len(expired))
+        for m in expired:
+            self.send_msg(msg.Cancel(m.index_, m.begin, m.length))
+            self.torrent.return_outstanding_request(m)
+        self.stalls += 1
+        if self.stalls >= SNUB_AFTER_STALLS and not self.snubbed:
+            self.snub()
+
+    def snub(self):
+        """Stops asking a peer that keeps stalling for more than one block at a
+        time, until it delivers one"""
+        logging.info('%s snubbed after %d stalls', self, self.stalls)
+        self.snubbed = True
+        self.request_queue_depth = 1
 
     def return_outstanding_requests(self):
-        for m, t_sent in self.outstanding_requests.iteritems():
+        requests = list(self.outstanding_requests)
+        self.outstanding_requests.clear()
+        for m in requests:
             self.torrent.return_outstanding_request(m)
 
     def run_strategy(self):
@@ -153,34 +287,57 @@ class Peer(object):
             temp = bitstring.BitArray(bytes=m.bitfield)
             self.peer_bitfield = temp[:len(self.torrent.piece_hashes)]
             assert len(old_bitfield) == len(self.peer_bitfield)
+            self.torrent.swarm.set_bitfield(self, m.bitfield)
+            self.torrent.update_interest([self])
         elif m.kind == 'unchoke':
             self.choked = False
         elif m.kind == 'choke':
             self.choked = True
+            # a peer drops the requests it has when it chokes us
+            self.return_outstanding_requests()
         elif m.kind == 'interested':
             self.peer_interested = True
         elif m.kind == 'not_interested':
             self.peer_interested = False
         elif m.kind == 'have':
-            self.peer_bitfield[m.index_] = 1
+            if not self.peer_bitfield[m.index_]:
+                self.peer_bitfield[m.index_] = 1
+                self.torrent.swarm.have(self, m.index_)
+                self.torrent.update_interest([self])
         elif m.kind == 'request':
             if self.torrent is None:
                 raise Exception(repr(self)+' can\'t process request when no torrent associated yet')
             if self.peer_interested:
-                data = self.torrent.get_data_if_have(m.index_, m.begin, m.length)
-                if data:
-                    m = msg.Piece(m.index_, m.begin, data)
-                    logging.info('sending %s to %s', repr(m), self)
-                    self.send_msg(m)
+                if sendfile is not None:
+                    regions = self.torrent.get_regions_if_have(m.index_, m.begin, m.length)
+                    if regions:
+                        logging.info('sending piece(%d, %d, %d) to %s', m.index_, m.begin, m.length, self)
+                        self.send_piece_from_disk(m.index_, m.begin, regions)
+                    else:
+                        logging.warning('%s was just asked for piece it didn\'t have', repr(self))
+                elif self.torrent.get_data_if_have(m.index_, m.begin, m.length, self.block_read, m):
+                    logging.info('reading piece(%d, %d, %d) for %s', m.index_, m.begin, m.length, self)
+                    self.uploads_reading.add(m)
                 else:
                     logging.warning('%s was just asked for piece it didn\'t have', repr(self))
             else:
                 logging.warning('peer requesting piece despite not sending interested, so not sending it')
+        elif m.kind == 'cancel':
+            request = msg.Request(m.index_, m.begin, m.length)
+            if request in self.uploads_reading:
+                logging.info('won\'t send piece(%d, %d, %d) canceled by %s', m.index_, m.begin, m.length, self)
+                self.uploads_reading.discard(request)
+            elif self.connection.cancel_piece(m.index_, m.begin, m.length):
+                logging.info('dropped piece(%d, %d, %d) canceled by %s', m.index_, m.begin, m.length, self)
+                self.bytes_sent -= m.length
         elif m.kind == 'piece':
-            try:
-                del self.outstanding_requests[msg.Request(m.index_, m.begin, len(m.block))]
-            except KeyError:
+            t_sent = self.outstanding_requests.pop(msg.Request(m.index_, m.begin, len(m.block)), None)
+            if t_sent is None:
                 logging.warning('got a request back that we had cannot find (canceled?) - oh well!')
+            else:
+                latency = time.time() - t_sent
+                self.record_block(len(m.block), latency)
+                self.torrent.record_latency(latency)
             self.torrent.add_data(m.index_, m.begin, m.block)
         else:
             logging.warning('didn\'t correctly process: %r', m)
@@ -1,20 +1,14 @@
 import logging
-from . import msg
 def keep_asking_strategy(peer):
-    if not peer.interested:
-        logging.info('%s sending interested', peer)
-        peer.send_msg(msg.Interested())
-        peer.interested = True
-
-    if not peer.choked:
-        while len(peer.outstanding_requests) < 10:
+    if peer.interested and not peer.choked:
+        while len(peer.outstanding_requests) < peer.request_queue_depth:
             needed_piece = peer.torrent.get_needed_request(peer)
             if needed_piece:
                 logging.info('torrent needed_piece: %s', repr(needed_piece))
                 peer.send_msg(needed_piece)
             else:
                 break
-    if peer.torrent.piece_checked.count(1) == len(peer.torrent.piece_hashes):
+    if peer.torrent.pieces_checked == len(peer.torrent.piece_hashes):
         for p in peer.torrent.peers:
             p.strategy = cancel_all_strategy
 
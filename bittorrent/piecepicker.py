@@ -0,0 +1,107 @@
+"""Choosing which piece to ask a peer for next
+
+PiecePicker counts how many connected peers have each piece, and keeps
+the pieces we still need to request in buckets by that count, so the
+rarest pieces a peer has are found by looking through the lowest buckets
+instead of every piece.
+
+>>> import bitstring
+>>> p = PiecePicker(4)
+>>> p.add_bitfield(bitstring.BitArray('0b1110')); p.add_bitfield(bitstring.BitArray('0b0110'))
+>>> p.have(2); list(p.availability)
+[1, 2, 3, 0]
+>>> p.pick(bitstring.BitArray('0b0110')), p.pick(bitstring.BitArray('0b0001'))
+(1, None)
+>>> p.set_wanted(1, False); p.pick(bitstring.BitArray('0b0110')), p.num_wanted
+(2, 3)
+>>> p.remove_bitfield(bitstring.BitArray('0b1110')); list(p.availability)
+[0, 1, 2, 0]
+>>> p.pick(), p.pick(bitstring.BitArray('0b1000'))
+(0, None)
+
+A piece that isn't wanted can become more common than any wanted one,
+and still be wanted again:
+
+>>> p.set_wanted(2, False); p.have(2); p.have(2); p.set_wanted(2, True)
+>>> p.pick(bitstring.BitArray('0b0010')), list(p.availability)
+(2, [0, 1, 4, 0])
+"""
+import array
+
+class PiecePicker(object):
+    """Rarest-first choice among pieces we still want
+
+    self.availability: piece-wise count of connected peers that have the piece
+    self.buckets: self.buckets[n] is the set of wanted pieces n peers have
+    self.wanted: piece-wise bool array of whether a piece needs requesting
+    self.num_wanted: how many pieces need requesting
+    """
+    def __init__(self, num_pieces):
+        self.availability = array.array('l', [0]) * num_pieces
+        self.wanted = bytearray('\x01') * num_pieces
+        self.buckets = [set(xrange(num_pieces))]
+        self.num_wanted = num_pieces
+
+    def _bucket(self, count):
+        """The bucket of wanted pieces count peers have, added if there isn't one yet"""
+        while len(self.buckets) <= count:
+            self.buckets.append(set())
+        return self.buckets[count]
+
+    def _move(self, index, old, new):
+        if not self.wanted[index]:
+            return
+        self.buckets[old].discard(index)
+        self._bucket(new).add(index)
+
+    def have(self, index):
+        """A peer told us it has piece index"""
+        count = self.availability[index]
+        self.availability[index] = count + 1
+        self._move(index, count, count + 1)
+
+    def lose(self, index):
+        """A peer that had piece index went away"""
+        count = self.availability[index]
+        self.availability[index] = count - 1
+        self._move(index, count, count - 1)
+
+    def add_bitfield(self, bitfield):
+        for index in bitfield.findall([1]):
+            self.have(index)
+
+    def remove_bitfield(self, bitfield):
+        for index in bitfield.findall([1]):
+            self.lose(index)
+
+    def set_wanted(self, index, wanted):
+        """Whether piece index still has blocks that need requesting"""
+        if bool(self.wanted[index]) == bool(wanted):
+            return
+        self.wanted[index] = bool(wanted)
+        if wanted:
+            self._bucket(self.availability[index]).add(index)
+            self.num_wanted += 1
+        else:
+            self.buckets[self.availability[index]].discard(index)
+            self.num_wanted -= 1
+
+    def pick(self, peer_has=None):
+        """Returns the rarest wanted piece that peer_has (a bitfield) says the
+        peer has, or None if there isn't one
+
+        Without peer_has, returns the rarest wanted piece, including ones no
+        one has. That, and a pick for a peer that has one of the rarest
+        wanted pieces, like a seed, takes constant time; otherwise it takes
+        time in proportion to the wanted pieces rarer than the first one
+        the peer has, which are all looked at.
+        """
+        for count, bucket in enumerate(self.buckets):
+            if peer_has is None:
+                for index in bucket:
+                    return index
+            elif count:
+                for index in bucket:
+                    if peer_has[index]:
+                        return index
+        return None
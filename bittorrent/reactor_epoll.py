@@ -0,0 +1,117 @@
+"""Reactor with select.epoll (Linux only)
+
+Same interface as reactor_select: instantiate a reactor, register a file
+descriptor integer and corresponding object with add_readerwriter, then
+reg_read / reg_write on the integer to have that object's read_event /
+write_event called.
+
+Registrations are persistent - an fd stays in the epoll set until both
+read and write have been unregistered, so poll doesn't rebuild anything.
+
+Every ready event from one epoll.poll call is dispatched in the same poll.
+Because of that, an event for an fd is skipped if an earlier callback in the
+same batch unregistered it (for instance a peer that died and closed its
+socket), so a readerwriter may safely die during its own read_event.
+
+Timers: start_timer(seconds, object-which-implements-timer_event()) returns
+a handle for cancel_timer(handle);
+cancel_timers(objects-which-you-started-one-or-more-timers-for-earlier)
+
+>>> import socket
+>>> class Echo(object):
+...     def __init__(self, s): self.s, self.got = s, ''
+...     def read_event(self): self.got += self.s.recv(10)
+>>> a, b = socket.socketpair()
+>>> r = Reactor(); e = Echo(b)
+>>> r.add_readerwriter(b.fileno(), e); r.reg_read(b)
+>>> a.send('hi')
+2
+>>> r.poll(1)
+1
+>>> e.got
+'hi'
+>>> r.unreg_read(b); r.poll(0) is None
+True
+"""
+
+import select
+import time
+
+from .timers import TimerQueue
+
+READ_MASK = select.EPOLLIN | select.EPOLLPRI
+WRITE_MASK = select.EPOLLOUT
+ERROR_MASK = select.EPOLLERR | select.EPOLLHUP
+
+class Reactor(object):
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.fd_map = {}
+        self.masks = {}
+        self.timers = TimerQueue()
+    def _modify(self, fd, add=0, remove=0):
+        if not isinstance(fd, int): fd = fd.fileno()
+        old = self.masks.get(fd, 0)
+        new = (old | add) & ~remove
+        if new == old:
+            return
+        if not new:
+            del self.masks[fd]
+            self.epoll.unregister(fd)
+        elif not old:
+            self.masks[fd] = new
+            self.epoll.register(fd, new)
+        else:
+            self.masks[fd] = new
+            self.epoll.modify(fd, new)
+    def reg_read(self, fd):
+        self._modify(fd, add=READ_MASK)
+    def reg_write(self, fd):
+        self._modify(fd, add=WRITE_MASK)
+    def unreg_read(self, fd):
+        self._modify(fd, remove=READ_MASK)
+    def unreg_write(self, fd):
+        self._modify(fd, remove=WRITE_MASK)
+    def start_timer(self, delay, dinger):
+        return self.timers.start_timer(delay, dinger)
+    def cancel_timer(self, handle):
+        self.timers.cancel(handle)
+    def cancel_timers(self, dinger):
+        """Takes an object which impements .timer_event()"""
+        self.timers.cancel_timers(dinger)
+    def add_readerwriter(self, fd, readerwriter):
+        self.fd_map[fd] = readerwriter
+    def remove_readerwriter(self, fd):
+        """Stops watching fd and forgets its readerwriter; call before closing it"""
+        self._modify(fd, remove=READ_MASK | WRITE_MASK)
+        self.fd_map.pop(fd, None)
+    def poll(self, timeout=None):
+        """Triggers every timer that is up, then every ready read and write event
+
+        Returns the number of read/write events dispatched, or False if none were
+        Returns None if no events are registered
+        timeout is the longest to wait in epoll, in seconds; epoll returns
+          in time for the next timer regardless, and None means wait for it
+        """
+        if not self.masks and not len(self.timers):
+            return None
+        self.timers.fire_expired()
+        timeout = self.timers.wait_time(timeout)
+        if not self.masks:
+            if timeout:
+                time.sleep(timeout)
+            return False
+
+        try:
+            events = self.epoll.poll(-1 if timeout is None else timeout)
+        except IOError:
+            return False # interrupted by a signal
+        dispatched = 0
+        for fd, event in events:
+            if event & (READ_MASK | ERROR_MASK) and self.masks.get(fd, 0) & READ_MASK:
+                self.fd_map[fd].read_event()
+                dispatched += 1
+            if event & (WRITE_MASK | ERROR_MASK) and self.masks.get(fd, 0) & WRITE_MASK:
+                self.fd_map[fd].write_event()
+                dispatched += 1
+        return dispatched or False
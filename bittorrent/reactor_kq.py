@@ -36,6 +36,14 @@ class Reactor(object):
     def add_readerwriter(self, fd, readerwriter):
         self.fd_map[fd] = readerwriter
         print self.fd_map
+    def remove_readerwriter(self, fd):
+        """Stops watching fd and forgets its readerwriter; call before closing it"""
+        for unreg in (self.unreg_read, self.unreg_write):
+            try:
+                unreg(fd)
+            except (OSError, KeyError):
+                pass # it wasn't registered for that
+        self.fd_map.pop(fd, None)
     def poll(self):
         """Triggers one read or write event"""
         events = self.KQ.poll(0)
@@ -17,27 +17,27 @@ because there could be another event in the queue for it, retrieved in the
 same batch of messages. In this case a reference to that object would
 still be hanging around.
 
-Timers: start_timer(seconds, object-which-implements-timer_event())
+Timers: start_timer(seconds, object-which-implements-timer_event()) returns
+a handle for cancel_timer(handle);
 cancel_timers(objects-which-you-started-one-or-more-timers-for-earlier)
 
 Timer objects, on the other hand, may cause things to dissapear.
-Only one timer event is ever retrieved at a time, so there's still
-time to cancel an object's timers, and therefore possible to destroy it.
+A cancelled timer never fires, even if it was already due in this poll,
+so it's always possible to cancel an object's timers and destroy it.
 
 """
 
 import select
 import time
 
-DEFAULT_TIMEOUT = .03 # how long after a timer comes up it may be delayed
-DEFAULT_TIMER_SLEEP = .01
+from .timers import TimerQueue
 
 class Reactor(object):
     def __init__(self):
         self.fd_map = {}
         self.wait_for_read = set()
         self.wait_for_write = set()
-        self.timers = []
+        self.timers = TimerQueue()
     def reg_read(self, fd):
         if not isinstance(fd, int): fd = fd.fileno()
         self.wait_for_read.add(fd)
@@ -53,45 +53,45 @@ class Reactor(object):
         try: self.wait_for_write.remove(fd)
         except KeyError: pass
     def start_timer(self, delay, dinger):
-        self.timers.append((time.time() + delay, dinger))
+        return self.timers.start_timer(delay, dinger)
+    def cancel_timer(self, handle):
+        self.timers.cancel(handle)
     def cancel_timers(self, dinger):
         """Takes an object which impements .timer_event()"""
-        self.timers = filter(lambda (t, x): x != dinger, self.timers)
+        self.timers.cancel_timers(dinger)
     def add_readerwriter(self, fd, readerwriter):
         self.fd_map[fd] = readerwriter
-    def poll(self, timeout=DEFAULT_TIMEOUT, timer_sleep=DEFAULT_TIMER_SLEEP):
-        """Triggers every timer, and the first read or write event that is up
+    def remove_readerwriter(self, fd):
+        """Stops watching fd and forgets its readerwriter; call before closing it"""
+        self.unreg_read(fd)
+        self.unreg_write(fd)
+        self.fd_map.pop(fd, None)
+    def poll(self, timeout=None):
+        """Triggers every timer that is up, and the first read or write event that is up
 
         Returns False if no events were hit
         Returns None if no events are registered
-        timeout is the timeout passed to select in seconds
-        timer_sleep is the time slept if no select is necessary because we're just
-          using timers, (no io registered) to prevent thrashing the cpu
+        timeout is the longest to wait in select, in seconds; select returns
+          in time for the next timer regardless, and None means wait for it
         """
-        if not any([self.wait_for_read, self.wait_for_write, self.timers]):
+        if not any([self.wait_for_read, self.wait_for_write, len(self.timers)]):
             return None
+        self.timers.fire_expired()
+        timeout = self.timers.wait_time(timeout)
         if not any([self.wait_for_read, self.wait_for_write]):
-            time.sleep(timer_sleep)
+            if timeout:
+                time.sleep(timeout)
             return False
 
-        now = time.time()
-        while True:
-            self.timers.sort(key=lambda x: x[0])
-            timerlist = self.timers[:]
-            for t, dinger in timerlist:
-                if t < now:
-                    self.timers.remove((t, dinger))
-                    dinger.timer_event()
-                    break
-            else:
-                break
         read_fds, write_fds, err_fds = select.select(self.wait_for_read, self.wait_for_write, [], timeout)
         if not any([read_fds, write_fds, err_fds]):
             return False
         for fd in read_fds:
-            self.fd_map[fd].read_event()
-            return self.fd_map[fd]
+            readerwriter = self.fd_map[fd]
+            readerwriter.read_event()
+            return readerwriter
         for fd in write_fds:
-            self.fd_map[fd].write_event()
-            return self.fd_map[fd]
+            readerwriter = self.fd_map[fd]
+            readerwriter.write_event()
+            return readerwriter
         return False
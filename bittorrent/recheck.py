@@ -0,0 +1,98 @@
+"""Checking the pieces of data already on disk against their hashes
+
+Every file behind a MultiFileDiskArray is mmapped once and worker threads
+hash pieces straight out of the maps, a file segment at a time for pieces
+that span files, so nothing is read into Python strings and memory use
+stays flat however large the payload is. hashlib drops the GIL while
+hashing, which lets the threads run in parallel.
+
+>>> import tempfile, hashlib
+>>> from .diskbytearray import MultiFileDiskArray
+>>> d = tempfile.mkdtemp()
+>>> data = MultiFileDiskArray([5, 6, 2], [d+'/a', d+'/b', d+'/c'])
+>>> data[:] = 'abcdefghijklm'
+>>> hashes = [hashlib.sha1(s).digest() for s in ['abcd', 'efgh', 'ijkl', 'm']]
+>>> hashes[2] = hashlib.sha1('wrong').digest()
+>>> recheck_pieces(data, 4, hashes, workers=2)
+[True, True, False, True]
+>>> recheck_pieces(MultiFileDiskArray([5, 6, 2], [d+'/a', d+'/b', d+'/new']), 4, hashes, workers=0)
+[True, True, False, False]
+"""
+import mmap
+import time
+import hashlib
+import threading
+
+from .hashing import HASH_WORKERS
+
+class _Maps(object):
+    """Read-only mmaps of the files behind FileRegions, opened once each"""
+    def __init__(self):
+        self.maps = {}
+    def get(self, diskarray):
+        key = id(diskarray)
+        if key not in self.maps:
+            try:
+                self.maps[key] = mmap.mmap(diskarray.f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError): # empty file
+                self.maps[key] = None
+        return self.maps[key]
+    def close(self):
+        for mapped in self.maps.values():
+            if mapped is not None:
+                mapped.close()
+
+def recheck_pieces(data, piece_length, piece_hashes, workers=HASH_WORKERS, progress=None):
+    """Returns a list saying whether each piece of data (a MultiFileDiskArray)
+    matches its hash; pieces whose files are missing or short don't match
+
+    progress, if given, is called as progress(pieces_done, total) about
+    twice a second and once at the end.
+    """
+    total = len(piece_hashes)
+    results = [False] * total
+    data.flush() # the maps only see what's on disk
+    maps = _Maps()
+    for diskarray in data.diskarrays:
+        maps.get(diskarray)
+    lock = threading.Lock()
+    counter = iter(xrange(total))
+    done = [0]
+
+    def check(i):
+        start = i * piece_length
+        h = hashlib.sha1()
+        for region in data.regions(start, min(start + piece_length, len(data))):
+            mapped = maps.get(region.diskarray)
+            if mapped is None or region.offset + region.length > len(mapped):
+                return False
+            h.update(buffer(mapped, region.offset, region.length))
+        return h.digest() == piece_hashes[i]
+
+    def work():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            results[i] = check(i)
+            with lock:
+                done[0] += 1
+
+    try:
+        if workers:
+            threads = [threading.Thread(target=work) for _ in range(workers)]
+            for t in threads:
+                t.daemon = True
+                t.start()
+            while any(t.is_alive() for t in threads):
+                threads[0].join(.5)
+                if progress:
+                    progress(done[0], total)
+        else:
+            work()
+        if progress:
+            progress(done[0], total)
+    finally:
+        maps.close()
+    return results
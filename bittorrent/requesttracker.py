@@ -0,0 +1,130 @@
+"""Requests outstanding with a peer, indexed by when they should have arrived
+
+>>> t = RequestTracker()
+>>> t.add('a', 0, 5); t.add('b', 1, 3); t.add('c', 2, 10)
+>>> len(t), 'b' in t, t.sent_at('b')
+(3, True, 1)
+>>> t.expired(4)
+['b']
+>>> t.pop('a'), t.pop('a'), t.expired(20)
+(0, None, ['c'])
+>>> len(t), list(t)
+(0, [])
+
+Trackers of the peers of one torrent share a RequestCopies, which counts
+the peers each request is outstanding with:
+
+>>> import collections; Request = collections.namedtuple('Request', 'begin length')
+>>> x, y = Request(0, 10), Request(10, 10)
+>>> copies = RequestCopies()
+>>> a, b = RequestTracker(copies), RequestTracker(copies)
+>>> a.add(x, 0, 5); b.add(x, 2, 5); b.add(y, 3, 5)
+>>> copies.sent[x], copies.duplicate_bytes
+([0, 2], 10)
+>>> a.pop(x), b.expired(5), copies.sent, copies.duplicate_bytes
+(0, [Request(begin=0, length=10), Request(begin=10, length=10)], {}, 0)
+"""
+import heapq
+import itertools
+
+class RequestCopies(object):
+    """The peers each request is outstanding with, across all the peers of
+    a torrent, kept up to date by their RequestTrackers
+
+    self.sent: request -> times it was sent, one per peer it's outstanding with
+    self.duplicate_bytes: bytes of the copies past the first of each request
+    """
+    def __init__(self):
+        self.sent = {}
+        self.duplicate_bytes = 0
+
+    def __contains__(self, m):
+        return m in self.sent
+
+    def add(self, m, t_sent):
+        sent = self.sent.setdefault(m, [])
+        if sent:
+            self.duplicate_bytes += m.length
+        sent.append(t_sent)
+
+    def remove(self, m, t_sent):
+        sent = self.sent[m]
+        sent.remove(t_sent)
+        if sent:
+            self.duplicate_bytes -= m.length
+        else:
+            del self.sent[m]
+
+class RequestTracker(object):
+    """Outstanding requests with the time each was sent and a deadline
+
+    Deadlines are kept in a heap, so finding expired requests only looks
+    at the ones that have expired. Requests that are popped before their
+    deadline are left in the heap and skipped later; the heap is rebuilt
+    when those make up most of it.
+
+    copies, if given, is a RequestCopies shared with other trackers, told
+    about every request that's added or removed.
+    """
+    def __init__(self, copies=None):
+        self.requests = {} # request -> (time sent, deadline)
+        self.deadlines = [] # heap of (deadline, seq, request)
+        self.counter = itertools.count()
+        self.copies = copies
+
+    def __len__(self):
+        return len(self.requests)
+
+    def __contains__(self, m):
+        return m in self.requests
+
+    def __iter__(self):
+        return iter(self.requests)
+
+    def iteritems(self):
+        """(request, time sent) pairs"""
+        for m, (t_sent, _) in self.requests.iteritems():
+            yield m, t_sent
+
+    def sent_at(self, m):
+        return self.requests[m][0]
+
+    def add(self, m, now, deadline):
+        self.pop(m)
+        self.requests[m] = (now, deadline)
+        if self.copies is not None:
+            self.copies.add(m, now)
+        heapq.heappush(self.deadlines, (deadline, next(self.counter), m))
+
+    def pop(self, m, default=None):
+        """Forgets request m, returning when it was sent (or default if it wasn't outstanding)"""
+        entry = self.requests.pop(m, None)
+        if entry is None:
+            return default
+        if self.copies is not None:
+            self.copies.remove(m, entry[0])
+        if len(self.deadlines) > 64 and len(self.deadlines) > 2 * len(self.requests):
+            self.deadlines = [(d, seq, r) for d, seq, r in self.deadlines
+                              if self.requests.get(r, (None, None))[1] == d]
+            heapq.heapify(self.deadlines)
+        return entry[0]
+
+    def clear(self):
+        if self.copies is not None:
+            for m, (t_sent, _) in self.requests.iteritems():
+                self.copies.remove(m, t_sent)
+        self.requests.clear()
+        self.deadlines = []
+
+    def expired(self, now):
+        """Removes and returns the requests whose deadline is now or earlier, oldest deadline first"""
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, _, m = heapq.heappop(self.deadlines)
+            entry = self.requests.get(m)
+            if entry is not None and entry[1] == deadline:
+                del self.requests[m]
+                if self.copies is not None:
+                    self.copies.remove(m, entry[0])
+                expired.append(m)
+        return expired
@@ -0,0 +1,77 @@
+"""Fast-resume files: what we had of a torrent when we last stopped
+
+A resume file is a bencoded dict holding the info hash, the bitfield of
+checked pieces, the byte ranges we have of pieces that are partly on disk,
+and the size and mtime of every data file. It is only trusted if every
+file still has the size and mtime it was written with; otherwise the
+data has to be rechecked.
+
+>>> import tempfile, os
+>>> d = tempfile.mkdtemp(); paths = [d+'/a', d+'/b']
+>>> for p in paths: open(p, 'wb').write('x' * 10)
+>>> data = encode('h'*20, '\\xa0', [(3, [(0, 100), (200, 300)])], paths)
+>>> decode(data, 'h'*20, paths)
+('\\xa0', [(3, [(0, 100), (200, 300)])])
+>>> decode(data, 'i'*20, paths) is None
+True
+>>> open(paths[1], 'ab').write('more')
+>>> decode(data, 'h'*20, paths) is None
+True
+"""
+import os
+import logging
+
+from . import bencode
+
+def file_stamps(paths):
+    """[size, mtime in microseconds] of each file, or None for missing files"""
+    stamps = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            stamps.append(None)
+            continue
+        stamps.append([st.st_size, int(st.st_mtime * 1000000)])
+    return stamps
+
+def encode(info_hash, bitfield, partial, paths):
+    """bitfield is the packed bits of checked pieces; partial is a list of
+    (piece index, [(begin, end), ...]) for pieces we have only some of"""
+    return bencode.bencode({
+        'info hash': info_hash,
+        'pieces': bitfield,
+        'partial': [[index] + [x for run in runs for x in run] for index, runs in partial],
+        'files': [stamp or [] for stamp in file_stamps(paths)],
+    })
+
+def decode(data, info_hash, paths):
+    """Returns (bitfield, partial) from a resume file's contents, or None if
+    it's unreadable, for another torrent, or the files have changed since"""
+    try:
+        state = bencode.bdecode(data)
+        if state['info hash'] != info_hash:
+            logging.info('resume data is for a different torrent')
+            return None
+        if [stamp or None for stamp in state['files']] != file_stamps(paths):
+            logging.info('data files changed since resume data was written')
+            return None
+        partial = [(entry[0], zip(entry[1::2], entry[2::2])) for entry in state['partial']]
+        return state['pieces'], partial
+    except (bencode.DecodeError, KeyError, TypeError, IndexError):
+        logging.warning('ignoring unreadable resume data')
+        return None
+
+def write(filename, data):
+    """Replaces filename with data atomically, so a crash leaves the old file"""
+    temp = filename + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(data)
+    os.rename(temp, filename)
+
+def read(filename):
+    try:
+        with open(filename, 'rb') as f:
+            return f.read()
+    except IOError:
+        return None
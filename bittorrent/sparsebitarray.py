@@ -1,10 +1,8 @@
 """
 Sparse (really Frequently Contiguous) Binary Array
 
-TODO:
-Eliminate need for .normalize() by ensuring self.changes never have duplicates
-binary search to find overlapping segments
-
+sparsebitarray_bench compares SparseBitArray with the flat list of change
+points it used to be stored as.
 """
 import operator
 import bisect
@@ -325,9 +323,16 @@ class SparseObjectArray(SparseArray):
         else:
             raise ValueError("Single element assignment not allowed")
 
+CHUNK_SIZE = 256 # runs per chunk of a SparseBitArray before it's split in two
+
 class SparseBitArray(SparseArray):
-    """Sparse BitArray, in which data is represented by indices of changes
-    between runs of set and unset values
+    """Sparse BitArray, stored as the sorted runs of set bits
+
+    The runs are kept in chunks of at most 2*CHUNK_SIZE, with the first
+    start of each chunk in self._firsts, so finding the runs a slice touches
+    is two bisects and changing them only moves one or two chunks' worth
+    of entries however fragmented the array is. The number of set bits is
+    kept up to date as runs are added and removed.
 
     >>> s = SparseBitArray(20); s
     SparseBitArray('00000000000000000000')
@@ -335,13 +340,53 @@ class SparseBitArray(SparseArray):
     SparseBitArray('111000000111111000000111')
     >>> s[:] = True; all(s), any(s)
     (True, True)
+    >>> s = SparseBitArray(10000)
+    >>> for i in range(0, 10000, 4): s[i:i+2] = True
+    >>> len(s._starts) > 1, s.count(1), s[4000:4010]
+    (True, 5000, SparseBitArray('1100110011'))
+    >>> s[1:9999] = False; s.ranges(), s.count(1)
+    ([(0, 1)], 1)
     """
     def __init__(self, *args, **kwargs):
         super(SparseBitArray, self).__init__(*args, **kwargs)
 
     def _initialize_structures(self):
-        self.changes = []
-        self.cached_ones = None
+        self._starts = [] # chunks of run starts
+        self._ends = [] # chunks of run ends, parallel to self._starts
+        self._firsts = [] # first start in each chunk
+        self.ones = 0
+
+    @classmethod
+    def _from_runs(cls, length, starts, ends):
+        new = cls(length)
+        for i in range(0, len(starts), CHUNK_SIZE):
+            new._starts.append(starts[i:i+CHUNK_SIZE])
+            new._ends.append(ends[i:i+CHUNK_SIZE])
+            new._firsts.append(starts[i])
+        new.ones = sum(ends) - sum(starts)
+        return new
+
+    @property
+    def changes(self):
+        """Indices at which the array changes between runs of unset and set bits"""
+        changes = []
+        for starts, ends in zip(self._starts, self._ends):
+            for start, end in zip(starts, ends):
+                changes.append(start)
+                changes.append(end)
+        if changes and changes[-1] == len(self):
+            changes.pop()
+        return changes
+
+    @changes.setter
+    def changes(self, changes):
+        self._initialize_structures()
+        changes = list(changes)
+        if len(changes) % 2:
+            changes.append(len(self))
+        for start, end in zip(changes[::2], changes[1::2]):
+            if start < end:
+                self[start:end] = True
 
     def all(self):
         """
@@ -354,13 +399,11 @@ class SparseBitArray(SparseArray):
         >>> s[3:10].all()
         True
         """
-        self.normalize()
-        return True if self.changes == [0] else False
+        return self.ones == len(self)
     def none(self):
-        self.normalize()
-        return True if self.changes == [] else False
+        return self.ones == 0
     def normalize(self):
-        """Changes self.changes to the canonical representation
+        """Kept for compatibility; runs are always stored in canonical form
 
         >>> s = SparseBitArray(iterable='00000000000000000000')
         >>> s.changes = [0,0,0,0,20,20]
@@ -372,20 +415,6 @@ class SparseBitArray(SparseArray):
         >>> s.changes = [0, len(s)]; s.normalize(); s.changes
         [0]
         """
-        if len(set(self.changes)) == len(self.changes) and len(self) not in self.changes:
-            return
-        i = 0
-        while True:
-            if i >= len(self.changes) - 1:
-                break
-            assert 0 <= self.changes[i] <= len(self)
-            if self.changes[i] == self.changes[i+1]:
-                del self.changes[i]
-                del self.changes[i]
-            else:
-                i += 1
-        while self.changes and self.changes[-1] == len(self):
-            del self.changes[-1]
 
     def index(self, x):
         """Return index of element or raise ValueError if not found
@@ -395,20 +424,18 @@ class SparseBitArray(SparseArray):
         0
         >>> s.index(1)
         1
+        >>> s[:2] = True; s.index(0)
+        2
         """
         if x and self.none():
             raise ValueError('no set bits in array')
         if (not x) and self.all():
             raise ValueError('no unset bits in array')
-        x = bool(x)
         if x:
-            return self.changes[0]
-        else:
-            if self.changes and self.changes[0] == 0:
-                return self.changes[1]
-            else:
-                return 0
-        raise Exception('Logic Error')
+            return self._firsts[0]
+        if not self._firsts or self._firsts[0] > 0:
+            return 0
+        return self._ends[0][0]
 
     def count(self, x):
         """counts true or false values
@@ -427,26 +454,104 @@ class SparseBitArray(SparseArray):
         >>> s[:] = False; s.none()
         True
         """
-        if self.cached_ones is None:
-            ones = 0
-            last_one = None
-            for i in self.changes:
-                if last_one is None:
-                    last_one = i
-                else:
-                    ones += i - last_one
-                    last_one = None
-            self.cached_ones = ones
         if x:
-            return self.cached_ones
+            return self.ones
         else:
-            return self.length - self.cached_ones
+            return self.length - self.ones
+
+    def ranges(self):
+        """(start, end) of each run of set bits
+
+        >>> s = SparseBitArray(iterable='0110001'); s.ranges()
+        [(1, 3), (6, 7)]
+        >>> s[:] = True; s.ranges()
+        [(0, 7)]
+        """
+        ranges = []
+        for starts, ends in zip(self._starts, self._ends):
+            ranges.extend(zip(starts, ends))
+        return ranges
+
+    def __iter__(self):
+        pos = 0
+        for start, end in self.ranges():
+            for _ in xrange(start - pos):
+                yield False
+            for _ in xrange(end - start):
+                yield True
+            pos = end
+        for _ in xrange(len(self) - pos):
+            yield False
 
     def __repr__(self):
         s = ''.join(str(int(x)) for x in self)
         return 'SparseBitArray(\'%s\')' % s
 
-
+    def _last_starting_before(self, x, inclusive=True):
+        """(chunk, index) of the last run starting before x (or at x, if
+        inclusive); the index is -1 if there isn't one"""
+        find = bisect.bisect_right if inclusive else bisect.bisect_left
+        chunk = find(self._firsts, x) - 1
+        if chunk < 0:
+            return 0, -1
+        return chunk, find(self._starts[chunk], x) - 1
+
+    def _next(self, (chunk, i)):
+        if chunk < len(self._starts) and i + 1 < len(self._starts[chunk]):
+            return chunk, i + 1
+        return chunk + 1, 0
+
+    def _runs_between(self, first, last):
+        """starts and ends of the runs from first through last, (chunk, index) positions"""
+        (fc, fi), (lc, li) = first, last
+        if (lc, li) < (fc, fi):
+            return [], []
+        if fc == lc:
+            return self._starts[fc][fi:li+1], self._ends[fc][fi:li+1]
+        starts, ends = self._starts[fc][fi:], self._ends[fc][fi:]
+        for chunk in range(fc + 1, lc):
+            starts += self._starts[chunk]
+            ends += self._ends[chunk]
+        return starts + self._starts[lc][:li+1], ends + self._ends[lc][:li+1]
+
+    def _replace(self, first, last, starts, ends):
+        """Replaces the runs from first through last (none if last is before
+        first) with runs starts and ends"""
+        (fc, fi), (lc, li) = first, last
+        if not self._starts:
+            self._starts.append([])
+            self._ends.append([])
+            self._firsts.append(None)
+        if fc == len(self._starts):
+            fc, fi = fc - 1, len(self._starts[fc - 1])
+        if (lc, li) < (fc, fi):
+            lc, li = fc, fi - 1
+        if fc == lc:
+            self._starts[fc][fi:li+1] = starts
+            self._ends[fc][fi:li+1] = ends
+            touched = [fc]
+        else:
+            self._starts[fc][fi:] = starts
+            self._ends[fc][fi:] = ends
+            del self._starts[lc][:li+1]
+            del self._ends[lc][:li+1]
+            del self._starts[fc+1:lc]
+            del self._ends[fc+1:lc]
+            del self._firsts[fc+1:lc]
+            touched = [fc + 1, fc]
+        for chunk in touched:
+            if not self._starts[chunk]:
+                del self._starts[chunk]
+                del self._ends[chunk]
+                del self._firsts[chunk]
+            elif len(self._starts[chunk]) > 2 * CHUNK_SIZE:
+                self._starts[chunk+1:chunk+1] = [self._starts[chunk][CHUNK_SIZE:]]
+                self._ends[chunk+1:chunk+1] = [self._ends[chunk][CHUNK_SIZE:]]
+                del self._starts[chunk][CHUNK_SIZE:]
+                del self._ends[chunk][CHUNK_SIZE:]
+                self._firsts[chunk:chunk+1] = [self._starts[chunk][0], self._starts[chunk+1][0]]
+            else:
+                self._firsts[chunk] = self._starts[chunk][0]
 
     def __getitem__(self, key):
         """Get a slice or the value of an entry
@@ -463,23 +568,28 @@ class SparseBitArray(SparseArray):
         SparseBitArray('1111000111110001')
         >>> s[1], s[10]
         (False, True)
+        >>> s[20:], s[5:5]
+        (SparseBitArray(''), SparseBitArray(''))
         """
         if isinstance(key, slice):
             start, end = self._decode_slice(key)
-            start_index, end_index = self._indices(start, end)
-            result = SparseBitArray(end - start)
-
-            if self[start]:
-                result.changes.append(0)
-
-            result.changes.extend( change - start for change in self.changes[start_index:end_index] )
-
-            return result
+            end = min(end, len(self))
+            if start >= end:
+                return SparseBitArray(0)
+            first = self._last_starting_before(start)
+            if first[1] < 0 or self._ends[first[0]][first[1]] <= start:
+                first = self._next(first)
+            last = self._last_starting_before(end, inclusive=False)
+            starts, ends = self._runs_between(first, last)
+            if starts:
+                starts[0] = max(starts[0], start)
+                ends[-1] = min(ends[-1], end)
+            return self._from_runs(end - start, [x - start for x in starts], [x - start for x in ends])
         else:
             if key >= len(self):
                 raise IndexError(key)
-
-            return bool(bisect.bisect_right(self.changes, key) % 2)
+            chunk, i = self._last_starting_before(key)
+            return i >= 0 and self._ends[chunk][i] > key
 
     def __setitem__(self, key, value):
         """Sets item or slice to True or False
@@ -510,42 +620,57 @@ class SparseBitArray(SparseArray):
         SparseBitArray('00000000000000000000')
         >>> s[:] = True; s
         SparseBitArray('11111111111111111111')
+        >>> s[3:3] = False; s.count(1)
+        20
         """
-        self.cached_ones = None
-        value = bool(value)
-        if isinstance(key, slice):
-            start, end = self._decode_slice(key)
-            start_index, end_index = self._indices(start, end)
-
-            new_changes = self.changes[:start_index]
-
-            if bool(len(new_changes) % 2) != value:
-                new_changes.append(start)
-
-            if bool(end_index % 2) != value:
-                new_changes.append(end)
-
-            new_changes.extend(self.changes[end_index:])
-
-            self.changes = new_changes
-        else:
+        if not isinstance(key, slice):
             raise ValueError("Single element assignment not allowed")
+        start, end = self._decode_slice(key)
+        end = min(end, len(self))
+        if start >= end:
+            return
+        first = self._last_starting_before(start)
+        if value:
+            # runs touching the slice are merged with it
+            if first[1] < 0 or self._ends[first[0]][first[1]] < start:
+                first = self._next(first)
+            last = self._last_starting_before(end)
+        else:
+            if first[1] < 0 or self._ends[first[0]][first[1]] <= start:
+                first = self._next(first)
+            last = self._last_starting_before(end, inclusive=False)
+        old_starts, old_ends = self._runs_between(first, last)
+        if value:
+            if old_starts:
+                start, end = min(start, old_starts[0]), max(end, old_ends[-1])
+            new_starts, new_ends = [start], [end]
+        else:
+            new_starts, new_ends = [], []
+            if old_starts and old_starts[0] < start:
+                new_starts.append(old_starts[0])
+                new_ends.append(start)
+            if old_starts and old_ends[-1] > end:
+                new_starts.append(end)
+                new_ends.append(old_ends[-1])
+        self.ones += sum(new_ends) - sum(new_starts) - sum(old_ends) + sum(old_starts)
+        self._replace(first, last, new_starts, new_ends)
 
     def __invert__(self):
         """bitwise inverse
         >>> a = SparseBitArray(20); a[4:6] = True; a[10:16] = True;
         >>> ~a
         SparseBitArray('11110011110000001111')
+        >>> a
+        SparseBitArray('00001100001111110000')
         >>> a = SparseBitArray(20); a[:] = True
         >>> ~a
         SparseBitArray('00000000000000000000')
         """
-        new = SparseBitArray(self.length)
-        new.changes = self.changes
-        new.changes.append(self.length)
-        new.changes.insert(0, 0)
-        new.normalize()
-        return new
+        ranges = self.ranges()
+        starts = [0] + [end for _, end in ranges]
+        ends = [start for start, _ in ranges] + [len(self)]
+        kept = [i for i in range(len(starts)) if starts[i] < ends[i]]
+        return self._from_runs(len(self), [starts[i] for i in kept], [ends[i] for i in kept])
 
     def __and__(self, other):
         """
@@ -556,30 +681,20 @@ class SparseBitArray(SparseArray):
         SparseBitArray('00000111100111111100')
         SparseBitArray('00000100000111110000')
         """
-        self_index = 0
-        other_index = 0
-        new = SparseBitArray(self.length)
-        state = False
-        while True:
-            self_num = self.changes[self_index] if self_index < len(self.changes) else sys.maxint
-            other_num = other.changes[other_index] if other_index < len(other.changes) else sys.maxint
-            if self_num == other_num == sys.maxint:
-                break
-            if self_num <= other_num:
-                cur = self_num
-                self_index += 1
-                if self_num == other_num:
-                    continue
+        mine, theirs = self.ranges(), other.ranges()
+        starts, ends = [], []
+        i = j = 0
+        while i < len(mine) and j < len(theirs):
+            start = max(mine[i][0], theirs[j][0])
+            end = min(mine[i][1], theirs[j][1])
+            if start < end:
+                starts.append(start)
+                ends.append(end)
+            if mine[i][1] < theirs[j][1]:
+                i += 1
             else:
-                cur = other_num
-                other_index += 1
-            if bool(self_index % 2) and bool(other_index % 2) and not state:
-                new.changes.append(cur)
-                state = True
-            elif state and not bool(self_index % 2 or not bool(other_index % 2)):
-                new.changes.append(cur)
-                state = False
-        return new
+                j += 1
+        return self._from_runs(self.length, starts, ends)
 
 if __name__ == '__main__':
     import doctest
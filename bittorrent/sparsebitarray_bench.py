@@ -0,0 +1,217 @@
+"""Compares SparseBitArray with the flat change-list version it replaced
+
+python -m bittorrent.sparsebitarray_bench [operations] [blocks]
+
+Each workload runs the same randomized sequence of operations against both
+and checks they end up with the same runs. The arrays are byte-granular
+like ActiveTorrent.have_data and .pending, written in 16 KiB blocks in
+random order so they fragment the way they do with many peers.
+"""
+import sys
+import bisect
+import time
+import random
+
+from .sparsebitarray import SparseArray, SparseBitArray
+
+BLOCK = 2**14
+
+class LegacySparseBitArray(SparseArray):
+    def __init__(self, *args, **kwargs):
+        super(LegacySparseBitArray, self).__init__(*args, **kwargs)
+
+    def _initialize_structures(self):
+        self.changes = []
+        self.cached_ones = None
+
+    def all(self):
+        self.normalize()
+        return True if self.changes == [0] else False
+    def none(self):
+        self.normalize()
+        return True if self.changes == [] else False
+    def normalize(self):
+        if len(set(self.changes)) == len(self.changes) and len(self) not in self.changes:
+            return
+        i = 0
+        while True:
+            if i >= len(self.changes) - 1:
+                break
+            assert 0 <= self.changes[i] <= len(self)
+            if self.changes[i] == self.changes[i+1]:
+                del self.changes[i]
+                del self.changes[i]
+            else:
+                i += 1
+        while self.changes and self.changes[-1] == len(self):
+            del self.changes[-1]
+
+    def index(self, x):
+        if x and self.none():
+            raise ValueError('no set bits in array')
+        if (not x) and self.all():
+            raise ValueError('no unset bits in array')
+        x = bool(x)
+        if x:
+            return self.changes[0]
+        else:
+            if self.changes and self.changes[0] == 0:
+                return self.changes[1]
+            else:
+                return 0
+        raise Exception('Logic Error')
+
+    def count(self, x):
+        if self.cached_ones is None:
+            ones = 0
+            last_one = None
+            for i in self.changes:
+                if last_one is None:
+                    last_one = i
+                else:
+                    ones += i - last_one
+                    last_one = None
+            self.cached_ones = ones
+        if x:
+            return self.cached_ones
+        else:
+            return self.length - self.cached_ones
+
+    def ranges(self):
+        self.normalize()
+        ends = self.changes[1::2] + ([len(self)] if len(self.changes) % 2 else [])
+        return zip(self.changes[::2], ends)
+
+    def __repr__(self):
+        s = ''.join(str(int(x)) for x in self)
+        return 'SparseBitArray(\'%s\')' % s
+
+
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, end = self._decode_slice(key)
+            start_index, end_index = self._indices(start, end)
+            result = LegacySparseBitArray(end - start)
+
+            if self[start]:
+                result.changes.append(0)
+
+            result.changes.extend( change - start for change in self.changes[start_index:end_index] )
+
+            return result
+        else:
+            if key >= len(self):
+                raise IndexError(key)
+
+            return bool(bisect.bisect_right(self.changes, key) % 2)
+
+    def __setitem__(self, key, value):
+        self.cached_ones = None
+        value = bool(value)
+        if isinstance(key, slice):
+            start, end = self._decode_slice(key)
+            start_index, end_index = self._indices(start, end)
+
+            new_changes = self.changes[:start_index]
+
+            if bool(len(new_changes) % 2) != value:
+                new_changes.append(start)
+
+            if bool(end_index % 2) != value:
+                new_changes.append(end)
+
+            new_changes.extend(self.changes[end_index:])
+
+            self.changes = new_changes
+        else:
+            raise ValueError("Single element assignment not allowed")
+
+    def __invert__(self):
+        new = LegacySparseBitArray(self.length)
+        new.changes = self.changes
+        new.changes.append(self.length)
+        new.changes.insert(0, 0)
+        new.normalize()
+        return new
+
+    def __and__(self, other):
+        self_index = 0
+        other_index = 0
+        new = LegacySparseBitArray(self.length)
+        state = False
+        while True:
+            self_num = self.changes[self_index] if self_index < len(self.changes) else sys.maxint
+            other_num = other.changes[other_index] if other_index < len(other.changes) else sys.maxint
+            if self_num == other_num == sys.maxint:
+                break
+            if self_num <= other_num:
+                cur = self_num
+                self_index += 1
+                if self_num == other_num:
+                    continue
+            else:
+                cur = other_num
+                other_index += 1
+            if bool(self_index % 2) and bool(other_index % 2) and not state:
+                new.changes.append(cur)
+                state = True
+            elif state and not bool(self_index % 2 or not bool(other_index % 2)):
+                new.changes.append(cur)
+                state = False
+        return new
+
+
+def receive_blocks(cls, ops, blocks, rand):
+    """add_data: mark a random block received, count what's new, check its piece"""
+    s = cls(blocks * BLOCK)
+    for _ in xrange(ops):
+        start = rand.randrange(blocks) * BLOCK
+        s[start:start+BLOCK].count(1)
+        s[start:start+BLOCK] = True
+        piece = start - start % (16 * BLOCK)
+        s[piece:piece+16*BLOCK].all()
+        s.count(1)
+    return s
+
+def request_and_return(cls, ops, blocks, rand):
+    """get_needed_request and return_outstanding_request: find the first
+    free byte, mark requests pending, hand a few back"""
+    s = cls(blocks * BLOCK)
+    for i in xrange(blocks // 2):
+        start = rand.randrange(blocks) * BLOCK
+        s[start:start+BLOCK] = True
+    for _ in xrange(ops):
+        if rand.random() < .3:
+            start = rand.randrange(blocks) * BLOCK
+            s[start:start+BLOCK] = False
+        elif not s.all():
+            start = s.index(0)
+            s[start:start+BLOCK] = True
+    return s
+
+def slices_and_inverse(cls, ops, blocks, rand):
+    """reading slices out of, and inverting, a heavily fragmented array"""
+    s = cls(blocks * BLOCK)
+    for i in xrange(0, blocks, 2):
+        s[i*BLOCK:(i+1)*BLOCK] = True
+    for _ in xrange(ops):
+        start = rand.randrange(blocks) * BLOCK
+        s[start:start + rand.randrange(1, 64) * BLOCK].count(1)
+    return ~s # the legacy version also inverts s in place
+
+def run(workload, cls, ops, blocks):
+    start = time.time()
+    s = workload(cls, ops, blocks, random.Random(ops * blocks))
+    return time.time() - start, s.ranges()
+
+def main(ops=20000, blocks=2**15):
+    for workload in [receive_blocks, request_and_return, slices_and_inverse]:
+        old, old_ranges = run(workload, LegacySparseBitArray, ops, blocks)
+        new, new_ranges = run(workload, SparseBitArray, ops, blocks)
+        assert old_ranges == new_ranges
+        print '%-20s %6d ops, %5d runs  legacy %7.3fs  new %7.3fs  (%5.1fx)' % (
+                workload.__name__, ops, len(new_ranges), old, new, old / max(new, 1e-6))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
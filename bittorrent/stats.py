@@ -0,0 +1,85 @@
+"""Summaries of timings and sizes that are cheap to keep for the life of a torrent
+
+>>> h = Histogram()
+>>> for ms in range(1, 101): h.add(ms / 1000.)
+>>> h.count, round(h.mean(), 4), h.max
+(100, 0.0505, 0.1)
+>>> h.percentile(50), h.percentile(99), h.percentile(100)
+(0.052, 0.104, 0.104)
+>>> str(h)
+'n=100 mean=50.5ms p50=52ms p90=96ms p99=104ms max=100ms'
+>>> str(Histogram())
+'n=0'
+>>> h = Histogram(unit=1, formatter=byte_size)
+>>> for n in [2**14, 2**14, 2**20]: h.add(n)
+>>> str(h)
+'n=3 mean=352KiB p50=18KiB p90=1.12MiB p99=1.12MiB max=1MiB'
+"""
+import math
+
+def ms(seconds):
+    return '%.3gms' % (seconds * 1000)
+
+def byte_size(n):
+    for unit in ['B', 'KiB', 'MiB']:
+        if n < 1024:
+            break
+        n /= 1024.
+    else:
+        unit = 'GiB'
+    return '%.3g%s' % (n, unit)
+
+class Histogram(object):
+    """Counts of samples in logarithmic buckets, for percentiles without
+    keeping every sample
+
+    Each power of two (in units of unit) is split into subdivisions
+    buckets, so percentiles are accurate to within 1/subdivisions of their
+    power of two; they're reported as the upper edge of their bucket.
+    formatter turns values into strings for __str__.
+    """
+    def __init__(self, unit=1e-3, subdivisions=8, formatter=ms):
+        self.unit = unit
+        self.subdivisions = subdivisions
+        self.formatter = formatter
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def _bucket(self, value):
+        mantissa, exponent = math.frexp(value / self.unit)
+        return exponent * self.subdivisions + int((mantissa - .5) * 2 * self.subdivisions)
+
+    def _upper_edge(self, bucket):
+        exponent, sub = divmod(bucket, self.subdivisions)
+        return (.5 + (sub + 1) * .5 / self.subdivisions) * 2**exponent * self.unit
+
+    def add(self, value):
+        bucket = self._bucket(value)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, p):
+        """The value p percent of samples are at or below, to within a bucket"""
+        if not self.count:
+            return 0
+        seen = 0
+        needed = self.count * p / 100.
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= needed:
+                return round(self._upper_edge(bucket), 9)
+
+    def __str__(self):
+        if not self.count:
+            return 'n=0'
+        f = self.formatter
+        return 'n=%d mean=%s p50=%s p90=%s p99=%s max=%s' % (
+                self.count, f(self.mean()), f(self.percentile(50)),
+                f(self.percentile(90)), f(self.percentile(99)), f(self.max))
@@ -0,0 +1,303 @@
+"""Which pieces the connected peers have, all at once
+
+Swarm keeps every connected peer's bitfield so questions about all of
+them - how many copies of each piece are out there, which peers have
+something we still need, which pieces are rarest - are answered in one
+pass instead of a loop over peers and pieces. With NumPy the bitfields
+are rows of a packed uint8 matrix and those passes are vectorised;
+without it they're Python longs, and so are the availability counts,
+bit-sliced so that each pass is a few operations on longs.
+
+Bitfields, ours and the peers', are packed bytes as sent in a Bitfield
+message. Ours is only given when it changes, to set_have; the pieces
+it doesn't have, which interest and rarest look for, are worked out
+then rather than on every question.
+
+A swarm given a PiecePicker passes every change in how many peers have
+a piece on to it, so the picker's availability counts are kept in step
+with the swarm's without the peers updating both.
+
+>>> from .piecepicker import PiecePicker
+>>> def exercise(s):
+...     s.set_bitfield('a', '\\xff\\xc0'); s.set_bitfield('b', '\\x81\\x00'); s.have('b', 9)
+...     s.set_have('\\xff\\x40')
+...     print list(s.availability()), s.interesting(['a', 'b', 'c'])
+...     s.set_have('\\x00\\x00'); print s.rarest(3),
+...     s.set_have('\\x80\\x00'); print s.rarest(2, 'b'), s.distributed_copies()
+...     s.remove('a'); s.set_have('\\x00\\x00')
+...     print list(s.availability()), s.rarest(5), s.distributed_copies()
+...     print list(s.picker.availability) == list(s.availability())
+>>> exercise(PythonSwarm(10, PiecePicker(10)))
+[2, 1, 1, 1, 1, 1, 1, 2, 1, 2] [True, False, False]
+[1, 2, 3] [7, 9] 1.3
+[1, 0, 0, 0, 0, 0, 0, 1, 0, 1] [0, 7, 9] 0.3
+True
+>>> exercise(Swarm(10, PiecePicker(10)))
+[2, 1, 1, 1, 1, 1, 1, 2, 1, 2] [True, False, False]
+[1, 2, 3] [7, 9] 1.3
+[1, 0, 0, 0, 0, 0, 0, 1, 0, 1] [0, 7, 9] 0.3
+True
+"""
+import array
+import binascii
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class PythonSwarm(object):
+    """Peers' bitfields as Python longs, piece 0 the most significant bit
+
+    Availability counts are bit-sliced: self.slices[k] has the bit for
+    each piece set if bit k of that piece's count is, so a bitfield is
+    added to or taken from every count with a few long operations, the
+    way a ripple-carry adder works.
+
+    self.bitfields: peer -> long of the pieces it has
+    self.slices: longs holding bit k of every piece's count
+    self.needed: long of the pieces we don't have
+    self.picker: PiecePicker told of every change in the counts, or None
+    """
+    def __init__(self, num_pieces, picker=None):
+        self.num_pieces = num_pieces
+        self.num_bytes = -(-num_pieces // 8)
+        self.mask = ((1 << num_pieces) - 1) << (self.num_bytes * 8 - num_pieces)
+        self.bitfields = {}
+        self.slices = []
+        self.needed = self.mask
+        self.picker = picker
+
+    def _to_long(self, bitfield):
+        bitfield = bitfield[:self.num_bytes].ljust(self.num_bytes, '\x00')
+        return int(binascii.hexlify(bitfield), 16) & self.mask if bitfield else 0
+
+    def _pieces(self, bits):
+        """Indices of the pieces set in bits"""
+        bits = bin(bits)[2:].zfill(self.num_bytes * 8)
+        pieces = []
+        index = bits.find('1')
+        while index >= 0:
+            pieces.append(index)
+            index = bits.find('1', index + 1)
+        return pieces
+
+    def _add(self, bits):
+        if self.picker is not None and bits:
+            for index in self._pieces(bits):
+                self.picker.have(index)
+        for k, s in enumerate(self.slices):
+            self.slices[k] = s ^ bits
+            bits &= s
+            if not bits:
+                return
+        self.slices.append(bits)
+
+    def _subtract(self, bits):
+        if self.picker is not None and bits:
+            for index in self._pieces(bits):
+                self.picker.lose(index)
+        for k, s in enumerate(self.slices):
+            self.slices[k] = s ^ bits
+            bits &= ~s
+            if not bits:
+                break
+        while self.slices and not self.slices[-1]:
+            self.slices.pop()
+
+    def _least(self, candidates):
+        """The candidates whose count is the lowest among them"""
+        for s in reversed(self.slices):
+            lower = candidates & ~s
+            if lower:
+                candidates = lower
+        return candidates
+
+    def _count(self, index_bit):
+        return sum(1 << k for k, s in enumerate(self.slices) if s & index_bit)
+
+    def set_have(self, have):
+        """Sets the pieces we have, as a packed bitfield"""
+        self.needed = ~self._to_long(have) & self.mask
+
+    def set_bitfield(self, peer, bitfield):
+        """Replaces what we know peer has with bitfield"""
+        old = self.bitfields.get(peer, 0)
+        new = self._to_long(bitfield)
+        self._subtract(old & ~new)
+        self._add(new & ~old)
+        self.bitfields[peer] = new
+
+    def have(self, peer, index):
+        bit = 1 << (self.num_bytes * 8 - 1 - index)
+        old = self.bitfields.get(peer, 0)
+        if not old & bit:
+            self.bitfields[peer] = old | bit
+            self._add(bit)
+
+    def remove(self, peer):
+        self._subtract(self.bitfields.pop(peer, 0))
+
+    def availability(self):
+        """Piece-wise count of peers that have the piece"""
+        counts = array.array('l', [0]) * self.num_pieces
+        for k, s in enumerate(self.slices):
+            for index in self._pieces(s):
+                counts[index] += 1 << k
+        return counts
+
+    def distributed_copies(self):
+        """How many full copies of the torrent the peers have between them:
+        the count of the rarest piece, plus the fraction of pieces more
+        common than that"""
+        if not self.num_pieces:
+            return 0
+        least = self._least(self.mask)
+        more = self.num_pieces - bin(least).count('1')
+        return self._count(least & -least) + more / float(self.num_pieces)
+
+    def interesting(self, peers):
+        """For each of peers, whether it has a piece we don't"""
+        needed = self.needed
+        return [bool(self.bitfields.get(peer, 0) & needed) for peer in peers]
+
+    def rarest(self, n=1, peer=None):
+        """Up to n pieces we don't have and some peer does (peer, if given),
+        rarest first"""
+        candidates = self.needed & reduce(operator.or_, self.slices, 0)
+        if peer is not None:
+            candidates &= self.bitfields.get(peer, 0)
+        pieces = []
+        while candidates and len(pieces) < n:
+            least = self._least(candidates)
+            pieces.extend(self._pieces(least)[:n - len(pieces)])
+            candidates &= ~least
+        return pieces
+
+class NumpySwarm(object):
+    """Peers' bitfields as the rows of a packed uint8 matrix
+
+    self.matrix: one row per peer, as many as have ever been connected at
+      once; rows of peers that left are zeroed and reused
+    self.rows: peer -> its row in self.matrix
+    self.counts: piece-wise count of peers that have the piece, updated a
+      whole row at a time as bitfields change
+    self.needed: packed bits of the pieces we don't have, and
+      self.needed_columns the bytes of it with any set
+    self.picker: PiecePicker told of every change in the counts, or None
+    """
+    def __init__(self, num_pieces, picker=None):
+        self.num_pieces = num_pieces
+        self.num_bytes = -(-num_pieces // 8)
+        self.matrix = numpy.zeros((16, self.num_bytes), numpy.uint8)
+        self.rows = {}
+        self.free = []
+        self.used = 0
+        self.mask = numpy.packbits(numpy.ones(num_pieces, numpy.uint8))
+        self.counts = numpy.zeros(num_pieces, numpy.int32)
+        self.picker = picker
+        self.set_have('')
+
+    def _to_array(self, bitfield):
+        bitfield = bitfield[:self.num_bytes].ljust(self.num_bytes, '\x00')
+        return numpy.frombuffer(bitfield, numpy.uint8) & self.mask
+
+    def _unpack(self, row):
+        return numpy.unpackbits(row)[:self.num_pieces]
+
+    def _tell_picker(self, old, new):
+        """Passes the pieces set in row new but not old, and the other way
+        round, on to the picker"""
+        if self.picker is not None:
+            for index in numpy.flatnonzero(self._unpack(new & ~old)).tolist():
+                self.picker.have(index)
+            for index in numpy.flatnonzero(self._unpack(old & ~new)).tolist():
+                self.picker.lose(index)
+
+    def set_have(self, have):
+        """Sets the pieces we have, as a packed bitfield"""
+        self.needed = ~self._to_array(have) & self.mask
+        self.needed_columns = numpy.flatnonzero(self.needed)
+
+    def _row(self, peer):
+        row = self.rows.get(peer)
+        if row is None:
+            if self.free:
+                row = self.free.pop()
+            else:
+                if self.used == len(self.matrix):
+                    grown = numpy.zeros((2 * len(self.matrix), self.num_bytes), numpy.uint8)
+                    grown[:self.used] = self.matrix
+                    self.matrix = grown
+                row = self.used
+                self.used += 1
+            self.rows[peer] = row
+        return row
+
+    def set_bitfield(self, peer, bitfield):
+        """Replaces what we know peer has with bitfield"""
+        row = self._row(peer)
+        new = self._to_array(bitfield)
+        self._tell_picker(self.matrix[row], new)
+        self.counts += self._unpack(new)
+        self.counts -= self._unpack(self.matrix[row])
+        self.matrix[row] = new
+
+    def have(self, peer, index):
+        row = self._row(peer)
+        bit = 0x80 >> (index & 7)
+        if not self.matrix[row, index >> 3] & bit:
+            self.matrix[row, index >> 3] |= bit
+            self.counts[index] += 1
+            if self.picker is not None:
+                self.picker.have(index)
+
+    def remove(self, peer):
+        row = self.rows.pop(peer, None)
+        if row is not None:
+            self._tell_picker(self.matrix[row], numpy.zeros(self.num_bytes, numpy.uint8))
+            self.counts -= self._unpack(self.matrix[row])
+            self.matrix[row] = 0
+            self.free.append(row)
+
+    def availability(self):
+        """Piece-wise count of peers that have the piece"""
+        return self.counts
+
+    def distributed_copies(self):
+        """How many full copies of the torrent the peers have between them:
+        the count of the rarest piece, plus the fraction of pieces more
+        common than that"""
+        if not self.num_pieces:
+            return 0
+        counts = self.counts
+        least = counts.min()
+        return int(least) + numpy.count_nonzero(counts > least) / float(self.num_pieces)
+
+    def interesting(self, peers):
+        """For each of peers, whether it has a piece we don't"""
+        rows = [self.rows.get(peer, -1) for peer in peers]
+        if not rows:
+            return []
+        present = numpy.array(rows) >= 0
+        # only the bytes with pieces we need matter, usually few of them
+        columns = self.needed_columns
+        wanted = (self.matrix[numpy.ix_(rows, columns)] & self.needed[columns]).any(axis=1) & present
+        return wanted.tolist()
+
+    def rarest(self, n=1, peer=None):
+        """Up to n pieces we don't have and some peer does (peer, if given),
+        rarest first"""
+        candidates = self.needed
+        if peer is not None:
+            if peer not in self.rows:
+                return []
+            candidates = candidates & self.matrix[self.rows[peer]]
+        counts = self.counts
+        pieces = numpy.flatnonzero(self._unpack(candidates) & (counts > 0))
+        order = numpy.argsort(counts[pieces], kind='mergesort')[:n]
+        return pieces[order].tolist()
+
+BACKENDS = [PythonSwarm] + ([NumpySwarm] if numpy is not None else [])
+Swarm = BACKENDS[-1]
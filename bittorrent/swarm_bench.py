@@ -0,0 +1,95 @@
+"""Swarm-wide availability, interest and rarest-piece queries per backend
+
+python -m bittorrent.swarm_bench [peers] [pieces]
+
+Fills each Swarm backend with the same random bitfields - a tenth of the
+peers seeds, the rest holding about half the pieces - then times the
+queries ActiveTorrent makes of it. The bitstring row is the piece-by-piece
+way of answering them from Peer.peer_bitfield that Swarm replaces.
+"""
+import sys
+import time
+import random
+import binascii
+
+import bitstring
+
+from .swarm import BACKENDS
+
+def random_bitfields(peers, pieces):
+    num_bytes = -(-pieces // 8)
+    mask = ((1 << pieces) - 1) << (num_bytes * 8 - pieces)
+    bitfields = []
+    for i in range(peers):
+        bits = mask if i % 10 == 0 else random.getrandbits(num_bytes * 8) & mask
+        bitfields.append(binascii.unhexlify('%0*x' % (num_bytes * 2, bits)))
+    return bitfields
+
+def timed(f, *args):
+    start = time.time()
+    result = f(*args)
+    return time.time() - start, result
+
+class BitstringSwarm(object):
+    """Answers from a BitArray per peer, a piece at a time"""
+    def __init__(self, num_pieces):
+        self.num_pieces = num_pieces
+        self.bitfields = {}
+    def set_bitfield(self, peer, bitfield):
+        self.bitfields[peer] = bitstring.BitArray(bytes=bitfield, length=self.num_pieces)
+    def set_have(self, have):
+        self.have = bitstring.BitArray(bytes=have, length=self.num_pieces)
+    def availability(self):
+        counts = [0] * self.num_pieces
+        for bits in self.bitfields.itervalues():
+            for index in bits.findall([1]):
+                counts[index] += 1
+        return counts
+    def interesting(self, peers):
+        have = self.have
+        return [any(bits[i] and not have[i] for i in xrange(self.num_pieces))
+                for bits in (self.bitfields[peer] for peer in peers)]
+    def rarest(self, n=1, peer=None):
+        have = self.have
+        counts = self.availability()
+        return sorted((i for i in xrange(self.num_pieces) if counts[i] and not have[i]),
+                      key=lambda i: (counts[i], i))[:n]
+
+def run(cls, bitfields, have, pieces):
+    s = cls(pieces)
+    peers = range(len(bitfields))
+    t_fill, _ = timed(lambda: [s.set_bitfield(p, b) for p, b in zip(peers, bitfields)])
+    s.set_have(have)
+    t_avail, counts = timed(s.availability)
+    t_interest, interest = timed(s.interesting, peers)
+    t_rarest, rarest = timed(s.rarest, 50)
+    return (t_fill, t_avail, t_interest, t_rarest), (list(counts), interest, rarest)
+
+def main(peers=1000, pieces=100000):
+    random.seed(0)
+    bitfields = random_bitfields(peers, pieces)
+    # we're most of the way through: most pieces done, a few hundred to go
+    have = random_bitfields(1, pieces)[0]
+    have = ''.join(chr(ord(c) | 0xfe) for c in have)
+    print '%d peers x %d pieces' % (peers, pieces)
+    print '%-15s %9s %9s %9s %9s' % ('', 'fill', 'avail', 'interest', 'rarest')
+    answers = None
+    for cls in BACKENDS + [BitstringSwarm]:
+        if cls is BitstringSwarm and peers * pieces > 10**6:
+            # piece-by-piece takes minutes at this size; time a slice of the peers and scale up
+            scale = peers * pieces / 10.0**6
+            times, _ = run(cls, bitfields[:int(peers / scale)], have, pieces)
+            times = [t * scale for t in times]
+            label = cls.__name__ + '*'
+        else:
+            times, result = run(cls, bitfields, have, pieces)
+            if answers is None:
+                answers = result
+            assert result == answers, cls.__name__ + ' disagrees'
+            label = cls.__name__
+        print '%-15s %8.3fs %8.3fs %8.3fs %8.3fs' % ((label,) + tuple(times))
+    if peers * pieces > 10**6:
+        print '* measured on %d peers and scaled up' % int(peers * 10.0**6 / (peers * pieces))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,108 @@
+"""writev and sendfile for Python 2, through ctypes
+
+Python 2 sockets have no sendmsg and its os module has no sendfile, so
+they're called from libc directly: writev to send several strings or
+buffers in one system call, and sendfile to send from a file without
+reading it into Python. sendfile takes the arguments os.sendfile does in
+Python 3, and is only there on Linux and OS X, whose calls differ; each
+is None where it can't be loaded.
+
+>>> import socket
+>>> a, b = socket.socketpair()
+>>> writev(a.fileno(), ['ab', buffer('xcd', 1), bytearray('ef')])
+6
+>>> b.recv(100)
+'abcdef'
+>>> a.setblocking(False)
+>>> try:
+...     while True: _ = writev(a.fileno(), ['x' * 2**16])
+... except OSError as e:
+...     e.errno == errno.EAGAIN
+True
+
+>>> import tempfile
+>>> f = tempfile.TemporaryFile(); f.write('0123456789'); f.flush()
+>>> a, b = socket.socketpair()
+>>> sendfile(a.fileno(), f.fileno(), 2, 5)
+5
+>>> b.recv(100)
+'23456'
+"""
+import os
+import sys
+import errno
+import ctypes
+import ctypes.util
+
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+_as_read_buffer = ctypes.pythonapi.PyObject_AsReadBuffer
+_as_read_buffer.argtypes = [ctypes.py_object, ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_ssize_t)]
+
+def _address(segment):
+    """Address and length of the bytes of a string, buffer or bytearray"""
+    address = ctypes.c_void_p()
+    length = ctypes.c_ssize_t()
+    _as_read_buffer(segment, ctypes.byref(address), ctypes.byref(length))
+    return address.value, length.value
+
+def _load_libc():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+
+_libc = _load_libc()
+
+def _check(result):
+    if result < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return result
+
+def _writev(fd, segments):
+    """Writes segments (strings, buffers or bytearrays, which must stay alive
+    until it returns) to fd in one call, returns bytes written"""
+    iov = (_iovec * len(segments))()
+    for i, segment in enumerate(segments):
+        iov[i].iov_base, iov[i].iov_len = _address(segment)
+    return _check(_libc.writev(fd, iov, len(segments)))
+
+if _libc is not None and hasattr(_libc, 'writev'):
+    _libc.writev.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+    _libc.writev.restype = ctypes.c_ssize_t
+    writev = _writev
+else:
+    writev = None
+
+def _sendfile_linux(out_fd, in_fd, offset, count):
+    """Sends up to count bytes at offset in file in_fd to socket out_fd,
+    returns bytes sent"""
+    offset = ctypes.c_int64(offset)
+    return _check(_libc.sendfile64(out_fd, in_fd, ctypes.byref(offset), count))
+
+def _sendfile_darwin(out_fd, in_fd, offset, count):
+    """Like _sendfile_linux; OS X's sendfile reports what it sent through
+    its length argument, even when it fails with EAGAIN part way"""
+    length = ctypes.c_int64(count)
+    if _libc.sendfile(in_fd, out_fd, offset, ctypes.byref(length), None, 0) < 0:
+        e = ctypes.get_errno()
+        if e not in (errno.EAGAIN, errno.EINTR) or not length.value:
+            raise OSError(e, os.strerror(e))
+    return length.value
+
+sendfile = None
+if _libc is not None and sys.platform.startswith('linux') and hasattr(_libc, 'sendfile64'):
+    _libc.sendfile64.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    _libc.sendfile64.restype = ctypes.c_ssize_t
+    sendfile = _sendfile_linux
+elif _libc is not None and sys.platform == 'darwin' and hasattr(_libc, 'sendfile'):
+    _libc.sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.POINTER(ctypes.c_int64),
+                               ctypes.c_void_p, ctypes.c_int]
+    _libc.sendfile.restype = ctypes.c_int
+    sendfile = _sendfile_darwin
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,133 @@
+"""Timer queue shared by the reactors
+
+Timers are kept in a heap ordered by deadline, so scheduling costs
+O(log n) and the next deadline is always timers[0]. Cancelling only
+marks an entry dead; dead entries are dropped when they reach the top
+of the heap, or all at once when they make up most of it.
+
+>>> class Dinger(object):
+...     def __init__(self, name): self.name = name
+...     def timer_event(self): fired.append(self.name)
+>>> fired = []
+>>> q = TimerQueue()
+>>> a, b, c = Dinger('a'), Dinger('b'), Dinger('c')
+>>> h = q.start_timer(3, b, now=0); h = q.start_timer(1, a, now=0)
+>>> h = q.start_timer(2, c, now=0); len(q)
+3
+>>> q.cancel(h); len(q)
+2
+>>> q.next_deadline()
+1
+>>> q.fire_expired(now=5); fired
+2
+['a', 'b']
+>>> q.next_deadline() is None
+True
+>>> h = q.start_timer(1, a, now=0); h = q.start_timer(2, a, now=0)
+>>> q.cancel_timers(a); len(q)
+0
+"""
+
+import heapq
+import itertools
+import time
+
+class TimerHandle(object):
+    """Returned by start_timer; pass to cancel"""
+    __slots__ = ['deadline', 'seq', 'dinger', 'cancelled']
+    def __init__(self, deadline, seq, dinger):
+        self.deadline = deadline
+        self.seq = seq
+        self.dinger = dinger
+        self.cancelled = False
+    def __lt__(self, other):
+        return (self.deadline, self.seq) < (other.deadline, other.seq)
+    def __repr__(self):
+        return '<TimerHandle %r at %f%s>' % (self.dinger, self.deadline, ' cancelled' if self.cancelled else '')
+
+class TimerQueue(object):
+    def __init__(self):
+        self.heap = []
+        self.by_dinger = {}
+        self.live = 0
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return self.live
+
+    def start_timer(self, delay, dinger, now=None):
+        """Schedules dinger.timer_event() in delay seconds, returns a TimerHandle"""
+        if now is None:
+            now = time.time()
+        handle = TimerHandle(now + delay, next(self.counter), dinger)
+        heapq.heappush(self.heap, handle)
+        self.by_dinger.setdefault(id(dinger), set()).add(handle)
+        self.live += 1
+        return handle
+
+    def cancel(self, handle):
+        if handle.cancelled:
+            return
+        handle.cancelled = True
+        self.live -= 1
+        handles = self.by_dinger.get(id(handle.dinger))
+        if handles is not None:
+            handles.discard(handle)
+            if not handles:
+                del self.by_dinger[id(handle.dinger)]
+        if len(self.heap) > 64 and self.live < len(self.heap) // 2:
+            self.heap = [h for h in self.heap if not h.cancelled]
+            heapq.heapify(self.heap)
+
+    def cancel_timers(self, dinger):
+        """Takes an object which impements .timer_event()"""
+        for handle in list(self.by_dinger.get(id(dinger), ())):
+            self.cancel(handle)
+
+    def _drop_cancelled(self):
+        while self.heap and self.heap[0].cancelled:
+            heapq.heappop(self.heap)
+
+    def next_deadline(self):
+        """Time of the next live timer, or None if there isn't one"""
+        self._drop_cancelled()
+        return self.heap[0].deadline if self.heap else None
+
+    def wait_time(self, timeout=None, now=None):
+        """How long a poll may block: until the next deadline, but no longer than timeout
+
+        >>> q = TimerQueue(); q.wait_time(5) , q.wait_time() is None
+        (5, True)
+        >>> h = q.start_timer(2, object(), now=10); q.wait_time(5, now=11), q.wait_time(now=13)
+        (1, 0)
+        """
+        deadline = self.next_deadline()
+        if deadline is None:
+            return timeout
+        if now is None:
+            now = time.time()
+        until_next = max(0, deadline - now)
+        return until_next if timeout is None else min(timeout, until_next)
+
+    def fire_expired(self, now=None):
+        """Fires every timer due by now, returns how many fired
+
+        Timers started by a timer_event are left for the next call even if
+        they're already due, so a zero-delay timer can't spin forever.
+        """
+        if now is None:
+            now = time.time()
+        last_seq = next(self.counter)
+        fired = 0
+        while True:
+            self._drop_cancelled()
+            if not self.heap:
+                break
+            handle = self.heap[0]
+            if handle.deadline > now or handle.seq > last_seq:
+                break
+            heapq.heappop(self.heap)
+            self.cancel(handle)
+            handle.dinger.timer_event()
+            fired += 1
+        return fired
@@ -4,6 +4,8 @@
 Torrent('./example.torrent')
 >>> str(t) #doctest: +ELLIPSIS
 '<Torrent Object at ...; contents: Distributed by Mininova.txt; TorrentFreak BitTorrent Speed Tips 101.pdf>'
+>>> t.info_hash.encode('hex')
+'cb40ac7b298f000b2c6ae08ebc319d88a0fc91e9'
 """
 import logging
 import datetime
@@ -11,20 +13,53 @@ import time
 import sha
 import bencode
 import os
-import urllib
 import sys
-import socket
 import weakref
-import shutil
+import array
 
 import bitstring
 
-from . import sparsebitarray
 from . import msg
-
-from .diskbytearray import MultiFileDiskArray
+from . import resume
+
+from .diskbytearray import MultiFileDiskArray, MultiFileMmapArray, FileRegion
+from .assembly import PieceAssembler
+from .hashing import HashPool, HASH_WORKERS
+from .diskio import DiskIO
+from .recheck import recheck_pieces
+from .piecepicker import PiecePicker
+from .swarm import Swarm
+from .tracker import TrackerTiers
+from .blockmap import BlockMap, MISSING, REQUESTED, RECEIVED, VERIFIED
+from .stats import Histogram
+from .requesttracker import RequestCopies
 from .peer import Peer
 
+ASSEMBLY_MEMORY_LIMIT = 64*2**20 # bytes of in-flight pieces to hold in memory
+RESUME_INTERVAL = 60 # seconds between saves of the resume file
+ENDGAME_MAX_COPIES = 3 # most peers a block is requested from at once in endgame
+ENDGAME_MAX_DUPLICATE_BYTES = 2*2**20 # most bytes of duplicate requests outstanding in endgame
+
+class PieceHashes(object):
+    """Sequence of the 20 byte piece hashes in a view of a torrent's pieces string
+
+    >>> h = PieceHashes(memoryview('a'*20 + 'b'*20)); len(h), h[1], h[-2] == h[0]
+    (2, 'bbbbbbbbbbbbbbbbbbbb', True)
+    """
+    def __init__(self, view):
+        self.view = view
+    def __len__(self):
+        return len(self.view) // 20
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.view[i*20:(i+1)*20].tobytes()
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
 class Torrent(object):
     """Torrent file data
 
@@ -43,15 +78,38 @@ class Torrent(object):
     class ParsingException(Exception): pass
 
     def initialize_from_torrent_file(self):
-        self._torrent_dict = torrent_dict = bencode.bdecode(open(self.filename).read())
-        self.creation_date = datetime.datetime.fromtimestamp(torrent_dict['creation date'])
-        self.announce_url = torrent_dict['announce']
-        self.created_by = torrent_dict.get('created by', None)
-        self.encoding = torrent_dict.get('encoding', None)
-        self._info_dict = info_dict = torrent_dict['info']
-        self.info_hash = sha.new(bencode.bencode(info_dict)).digest()
+        """Reads the torrent file, decoding only the values that are used
+
+        info_hash is the hash of the info dict's bytes exactly as they appear
+        in the file, and piece_hashes reads hashes out of the file's pieces
+        string as they're asked for.
+        """
+        self._raw = raw = open(self.filename, 'rb').read()
+        spans = bencode.key_spans(raw)
+        def decoded(spans, key, default=KeyError):
+            if key not in spans:
+                if default is KeyError:
+                    raise Torrent.ParsingException('torrent file has no %r' % key)
+                return default
+            return bencode.decode(raw, spans[key][0])[0]
+        self.creation_date = datetime.datetime.fromtimestamp(decoded(spans, 'creation date'))
+        self.announce_url = decoded(spans, 'announce', None)
+        announce_list = decoded(spans, 'announce-list', None)
+        if announce_list and any(announce_list):
+            self.announce_tiers = [list(tier) for tier in announce_list if tier]
+        elif self.announce_url:
+            self.announce_tiers = [[self.announce_url]]
+        else:
+            raise Torrent.ParsingException('torrent file has no \'announce\' or \'announce-list\'')
+        self.created_by = decoded(spans, 'created by', None)
+        self.encoding = decoded(spans, 'encoding', None)
+        info_start, info_end = spans['info']
+        self.info_hash = sha.new(memoryview(raw)[info_start:info_end]).digest()
+        info_spans = bencode.key_spans(raw, info_start)
+        self._info_dict = info_dict = dict((key, decoded(info_spans, key)) for key in info_spans if key != 'pieces')
         self.piece_length = info_dict['piece length']
-        self.piece_hashes = [info_dict['pieces'][i:i+20] for i in range(0, len(info_dict['pieces']), 20)]
+        pieces_start, pieces_end = bencode.string_span(raw, info_spans['pieces'][0])
+        self.piece_hashes = PieceHashes(memoryview(raw)[pieces_start:pieces_end])
         self.private = bool(info_dict.get('private', 0))
         if 'files' in info_dict:
             self.mode = 'multi-file'
@@ -71,32 +129,83 @@ class Torrent(object):
 class ActiveTorrent(Torrent):
     """Contains torrent data and peers
 
-    self.data: access to the bytes of data from disk
-    self.have_data: byte-wise bool array for if we data
-    self.pending: byte-wise bool array for if a request has been made for data
-
-    self.piece_checked: piece-wise bool array for if hash has been checked
+    self.data: access to the bytes of data from disk, a self.storage
+      (MultiFileDiskArray, or MultiFileMmapArray to map the files into
+      memory; that preallocates them, so without a resume file they're
+      rechecked)
+    self.blocks: BlockMap of whether each block is missing, requested,
+      received or in a verified piece
+
+    self.piece_bytes: piece-wise count of bytes we have of each piece
+    self.bytes_have, self.pieces_checked: running totals of the above
+    self.assembler: memory buffers for pieces being downloaded, which are
+      hashed and written to disk once complete (set assembler.memory_limit
+      to change how much memory that may take)
+    self.hasher: HashPool that verifies completed pieces off the reactor thread
+    self.hashing: pieces currently being hashed by self.hasher
+    self.disk: DiskIO that reads and writes self.data off the reactor
+      thread; no more blocks are requested while it's congested
+    self.writes_pending: piece -> blocks of it still being written, which
+      it's hashed once there are none of
+    self.writing: pieces that checked out, being written to disk; they're
+      announced once they're on it
+    self.picker: which pieces connected peers have, and which of them
+      we still need to request
+    self.swarm: Swarm of the connected peers' bitfields, which answers
+      who we're interested in and keeps self.picker's counts up to date
+    self.endgame_started: when every block left was first pending, after
+      which blocks are requested from several peers at once; None again
+      if a block goes back to being wanted
+    self.request_copies: RequestCopies counting the peers each request is
+      outstanding with, kept up to date by their RequestTrackers
+    self.request_latency, self.endgame_latency: Histograms of seconds from
+      request to block, before and during endgame
+    self.tracker: TrackerTiers announcing to the HTTP and UDP trackers of
+      self.announce_tiers from the reactor; the peers of every response
+      end up in self.tracker_peer_addresses
 
     self.outputfolder: folder in which to put output files
+    self.resume_filename: where what we have is saved between runs, so a
+      restart doesn't have to download or recheck it again
     """
+    storage = MultiFileDiskArray
+
     def __init__(self, filename, client):
         Torrent.__init__(self, filename)
         self.client = client
-        #todo use a more efficient way to store what portions of pieces we have
         self.outputfolder = 'outputfolder'
-        if os.path.exists(self.outputfolder):
-            shutil.rmtree(self.outputfolder)
-
-        self.data = MultiFileDiskArray(self.file_sizes, [os.path.join(self.outputfolder, f) for f in self.files])
-        self.have_data = sparsebitarray.SparseBitArray(self.length)
-        self.pending = sparsebitarray.SparseBitArray(self.length)
-
-        self.piece_checked = bitstring.BitArray(len(self.piece_hashes))
+        self.resume_filename = os.path.join(self.outputfolder, self.info_hash.encode('hex') + '.resume')
+        self.data = self.storage(self.file_sizes, [os.path.join(self.outputfolder, f) for f in self.files])
+        self.blocks = BlockMap(self.length, self.piece_length)
+        self.piece_bytes = array.array('l', [0]) * len(self.piece_hashes)
+        self.bytes_have = 0
+        self.pieces_checked = 0
+        self.assembler = PieceAssembler(ASSEMBLY_MEMORY_LIMIT)
+        self.hasher = HashPool(self.client.waker)
+        self.hashing = set()
+        self.disk = DiskIO(self.client.waker, on_drain=self.disk_drained)
+        self.writes_pending = {}
+        self.writing = set()
+        self.picker = PiecePicker(len(self.piece_hashes))
+        self.swarm = Swarm(len(self.piece_hashes), self.picker)
+        self.endgame_started = None
+        self.request_copies = RequestCopies()
+        self.duplicate_requests = 0
+        self.cancels_sent = 0
+        self.wasted_bytes = 0
+        self.request_latency = Histogram()
+        self.endgame_latency = Histogram()
+        self.last_resume_save = time.time()
 
         self.last_tracker_update = 0
+        self.tracker_peer_addresses = ()
+        self.tracker = TrackerTiers(self.announce_tiers, self.client.reactor,
+                                    lambda: self.announce_query_params, self.tracker_response,
+                                    resolver=self.client.resolver)
         self.peers = []
         self.peer_history = {}
         self.strategy = lambda x: False
+        self.restore()
         self.client.reactor.start_timer(1, self)
 
     @property
@@ -106,8 +215,8 @@ class ActiveTorrent(Torrent):
             'peer_id' : self.client.client_id,
             'port' : self.client.port,
             'uploaded' : sum([x.bytes_sent for x in self.peers]),
-            'downloaded' : self.have_data.count(1),
-            'left' : self.length - self.have_data.count(1),
+            'downloaded' : self.bytes_have,
+            'left' : self.length - self.bytes_have,
             'compact' : 1, # sometimes optional
            #'no_peer_id' :  # ignored if compact enabled
             #'ip' : ip # optional
@@ -118,98 +227,270 @@ class ActiveTorrent(Torrent):
             announce_query_params['event'] = 'started'
         return announce_query_params
 
-    @property
-    def full_announce_url(self):
-        return self.announce_url + '?' + urllib.urlencode(self.announce_query_params)
-
     def tracker_update(self):
-        """Returns data from Tracker specified in torrent"""
-        logging.info('%s making request to %s', repr(self), self.full_announce_url)
-        response = urllib.urlopen(self.full_announce_url).read()
-        logging.info('response returned: %s', repr(response))
-        response_data = bencode.bdecode(response)
+        """Starts announcing to the trackers, returns whether any announce started
+
+        Responses come to tracker_response; after that each tracker is
+        announced to again every interval it asks for.
+        """
+        return self.tracker.announce()
 
+    def tracker_response(self, response_data):
+        logging.info('response returned: %s', repr(response_data))
         self.last_tracker_update = time.time()
         self.tracker_min_interval = response_data.get('min interval', None)
-        self.tracker_interval = response_data['interval']
-        self.tracker_complete = response_data['complete']
-        self.tracker_incomplete = response_data['incomplete']
-
-        peers_data = response_data['peers']
-        peer_addresses = []
-        for sixbits in [peers_data[i:i+6] for i in range(0,len(peers_data),6)]:
-            peer_addresses.append(
-                    ('.'.join(str(ord(ip_part)) for ip_part in sixbits[:4]), 256*ord(sixbits[4])+ord(sixbits[5])))
-        self.tracker_peer_addresses = tuple(peer_addresses)
-        return True
+        self.tracker_interval = response_data.get('interval')
+        self.tracker_complete = response_data.get('complete')
+        self.tracker_incomplete = response_data.get('incomplete')
+        self.tracker_peer_addresses = tuple(self.tracker.peers)
+        self.run_strategy()
 
     def get_external_addr(self):
-        s = socket.socket()
-        port = 80
-        addr = self.announce_url
-        if self.announce_url.count(':') == 2:
-            _, first, rest = self.announce_url.split(':')
-            addr = first.split('/')[-1]
-            port = rest.split('/')[0]
-            port = int(port)
-        elif 'http' in self.announce_url:
-            _, rest = self.announce_url.split(':')
-            addr = rest[2:].split('/')[0]
-        logging.info('connecting to %s:%d to determine external ip', addr, port)
-        s.connect((addr, port))
-        ip, port = s.getsockname()
-        s.close()
-        return ip
+        """Our address as of the last connection to a tracker"""
+        return self.tracker.external_ip
 
     def timer_event(self):
         self.run_strategy()
+        if time.time() - self.last_resume_save > RESUME_INTERVAL:
+            self.last_resume_save = time.time()
+            self.disk.flush(self.data, 0, None, self.write_resume, self.resume_state())
+        else:
+            self.disk.flush(self.data)
         self.client.reactor.start_timer(10, self)
 
     def run_strategy(self):
         logging.info('%s running strategy %s', self, self.strategy.__name__)
         self.strategy(self)
 
+    def piece_size(self, i):
+        return min(self.piece_length, self.length - i*self.piece_length)
+
+    def piece_to_hash(self, i):
+        """Returns (buffered, data) for complete piece i: its assembly buffer if
+        it has one, and the bytes to hash, read from disk if it wasn't buffered"""
+        buffered = self.assembler.pop(i)
+        if buffered is not None:
+            return buffered, buffered
+        start = i*self.piece_length
+        return None, self.data[start:start+self.piece_size(i)]
+
     def check_piece_hash(self, i):
-        piece_hash = self.piece_hashes[i]
-        if self.piece_checked[i]:
+        """Hashes piece i right away if it's complete, returns whether it's
+        checked, which it isn't until it has been written to disk"""
+        if self.blocks.verified(i):
             return True
+        if self.piece_bytes[i] == self.piece_size(i) and i not in self.hashing:
+            buffered, data = self.piece_to_hash(i)
+            self.piece_hashed(sha.new(data).digest(), i, buffered)
+        return self.blocks.verified(i)
+
+    def verify_piece(self, i):
+        """Hands complete piece i to the hash pool, reading it from disk first
+        if it wasn't buffered; piece_hashed gets the result"""
+        self.hashing.add(i)
+        buffered = self.assembler.pop(i)
+        if buffered is not None:
+            self.hasher.submit(buffered, self.piece_hashed, i, buffered)
+        else:
+            self.disk.read(self.data, i*self.piece_length, self.piece_size(i), self.piece_read, i)
+
+    def piece_read(self, data, i):
+        if isinstance(data, Exception):
+            logging.warning('%s couldn\'t read piece %d to check it: %s', repr(self), i, data)
+            self.hashing.discard(i)
+            self.throw_out_piece(i)
+            return
+        self.hasher.submit(data, self.piece_hashed, i, None)
+
+    def piece_hashed(self, piece_hash, i, buffered):
+        """Marks piece i checked and announces it if piece_hash is right,
+        otherwise throws the piece out; buffered is its assembly buffer if it had one"""
+        self.hashing.discard(i)
         start = i*self.piece_length
-        end = min((i+1)*(self.piece_length), self.length)
-        if self.have_data[start:end].all():
-            piece_hash = sha.new(self.data[start:end]).digest()
-            if piece_hash == self.piece_hashes[i]:
-                self.piece_checked[i] = True
-                sys.stdout.write('hashing piece %d/%d                 \r' % (i+1, len(self.piece_hashes)))
-                sys.stdout.flush()
-                for peer in self.peers:
-                    peer.send_msg(msg.Have(i))
-                return True
+        end = start + self.piece_size(i)
+        if piece_hash == self.piece_hashes[i]:
+            self.writing.add(i)
+            if buffered is not None:
+                self.disk.write(self.data, start, buffered, self.piece_cached, i)
             else:
-                logging.warning('%s hash check failed! throwing out piece %d', repr(self), i)
-                logging.info('(bytes %d up to %d)', start, end)
-                logging.info('lookup: %s', self.piece_hashes[i])
-                logging.info('calculated: %s', piece_hash)
-                self.have_data[start:end] = 0
-                self.data[start:end] = '\x00'*(end-start)
-                self.pending[start:end] = 0
-                return False
-        return False
+                self.piece_cached(None, i)
+        else:
+            logging.warning('%s hash check failed! throwing out piece %d', repr(self), i)
+            logging.info('(bytes %d up to %d)', start, end)
+            logging.info('lookup: %s', self.piece_hashes[i])
+            logging.info('calculated: %s', piece_hash)
+            # the bad bytes stay on disk until they're downloaded again; zeroing
+            # them could land after the new blocks, which are written out of order
+            self.throw_out_piece(i)
+
+    def piece_cached(self, error, i):
+        """Flushes checked piece i to disk once all of it has been written to
+        the data's cache"""
+        if error is not None:
+            logging.warning('%s couldn\'t write piece %d: %s', repr(self), i, error)
+            self.writing.discard(i)
+            self.throw_out_piece(i)
+            return
+        start = i*self.piece_length
+        self.disk.flush(self.data, start, start + self.piece_size(i), self.piece_written, i)
+
+    def piece_written(self, error, i):
+        """Marks piece i checked and announces it, now that it's on disk"""
+        self.writing.discard(i)
+        if error is not None:
+            logging.warning('%s couldn\'t write piece %d: %s', repr(self), i, error)
+            self.throw_out_piece(i)
+            return
+        self.blocks.set_piece(i, VERIFIED)
+        self.pieces_checked += 1
+        sys.stdout.write('hashing piece %d/%d                 \r' % (i+1, len(self.piece_hashes)))
+        sys.stdout.flush()
+        for peer in self.peers:
+            peer.send_msg(msg.Have(i))
+        self._verified_changed()
+        if self.pieces_checked == len(self.piece_hashes):
+            self.log_stats()
+            if hasattr(self.strategy, 'die_on_finish'):
+                sys.exit()
 
     def check_piece_hashes(self):
-        """Returns the number of piece hashes checked"""
-        checked_out = 0
-        for i in range(len(self.piece_hashes)):
-            if self.check_piece_hash(i):
-                checked_out += 1
-        return checked_out
+        """Checks every complete piece not yet checked, returns the number of pieces checked"""
+        for i, received in enumerate(self.piece_bytes):
+            if received == self.piece_size(i) and not self.blocks.verified(i):
+                self.check_piece_hash(i)
+        return self.pieces_checked
 
     def load(self, filename):
+        """Uses data already on disk - the file of a single-file torrent, or the
+        directory holding a multi-file torrent's files - and restores or rechecks it
+
+        Returns the number of pieces we have of it. The storage used until
+        now is flushed and closed.
+        """
         if os.path.isdir(filename):
-            raise Exception("loading from multiple files not yet implemented")
-        self.have_data[:] = True
-        self.data[:] = open(filename, 'rb').read()
-        assert self.have_data.count(1) == self.length
-        #assert self.check_piece_hashes() == len(self.piece_hashes)
+            paths = [os.path.join(filename, f) for f in self.files]
+        elif self.mode == 'single-file':
+            paths = [filename]
+        else:
+            raise ValueError("a multi-file torrent has to be loaded from a directory")
+        data = self.storage(self.file_sizes, paths)
+        self.data.close()
+        self.data = data
+        return self.restore()
+
+    def recheck(self, workers=HASH_WORKERS, progress=None):
+        """Hashes every piece on disk, and sets what we have from the results
+
+        Throws away anything downloaded but not yet checked. progress is
+        called as progress(pieces_done, total); the default writes it to stdout.
+        Returns the number of pieces that checked out.
+        """
+        if progress is None:
+            def progress(done, total):
+                sys.stdout.write('rechecking piece %d/%d                 \r' % (done, total))
+                sys.stdout.flush()
+        results = recheck_pieces(self.data, self.piece_length, self.piece_hashes, workers, progress)
+        self._set_checked(results)
+        logging.info('%s recheck found %d of %d pieces', repr(self), self.pieces_checked, len(self.piece_hashes))
+        return self.pieces_checked
+
+    def _set_checked(self, checked):
+        """Forgets everything we had, then marks the pieces checked says we have"""
+        self.assembler = PieceAssembler(self.assembler.memory_limit)
+        self.blocks.reset()
+        self.piece_bytes = array.array('l', [0]) * len(self.piece_hashes)
+        self.bytes_have = 0
+        self.pieces_checked = 0
+        for i, checked_out in enumerate(checked):
+            self.picker.set_wanted(i, not checked_out)
+            if checked_out:
+                self.blocks.set_piece(i, VERIFIED)
+                self.piece_bytes[i] = self.piece_size(i)
+                self.bytes_have += self.piece_bytes[i]
+                self.pieces_checked += 1
+        self._verified_changed()
+
+    def _mark_received(self, index, begin, end):
+        """Marks the blocks of piece index that lie within bytes begin to end
+        received, returns how many bytes of them we didn't have"""
+        new_bytes = 0
+        block = -(-begin // self.blocks.block_size)
+        while block < self.blocks.blocks_in_piece(index):
+            block_begin, block_length = self.blocks.block_span(index, block)
+            if block_begin + block_length > end:
+                break
+            if self.blocks.get(index, block) < RECEIVED:
+                self.blocks.set(index, block, RECEIVED)
+                new_bytes += block_length
+            block += 1
+        return new_bytes
+
+    def restore(self):
+        """Picks up where the last run left off
+
+        Trusts the resume file if the data files haven't changed since it was
+        written, otherwise rechecks whatever is on disk.
+        Returns the number of pieces we have.
+        """
+        data = resume.read(self.resume_filename)
+        state = None if data is None else resume.decode(data, self.info_hash, self.data.files)
+        if state is not None:
+            bitfield, partial = state
+            if (len(bitfield) != (len(self.piece_hashes) + 7) // 8 or
+                    any(not 0 <= i < len(self.piece_hashes) for i, _ in partial)):
+                logging.warning('%s resume file doesn\'t fit this torrent', repr(self))
+                state = None
+        if state is None:
+            if any(os.path.getsize(f) for f in self.data.files):
+                return self.recheck()
+            return self.pieces_checked
+        self._set_checked(bitstring.BitArray(bytes=bitfield, length=len(self.piece_hashes)))
+        for i, runs in partial:
+            for begin, end in runs:
+                if self.blocks.verified(i) or not 0 <= begin < end <= self.piece_size(i):
+                    continue
+                new_bytes = self._mark_received(i, begin, end)
+                self.piece_bytes[i] += new_bytes
+                self.bytes_have += new_bytes
+            self._update_wanted(i)
+            if self.piece_bytes[i] == self.piece_size(i) and not self.blocks.verified(i):
+                self.verify_piece(i)
+        logging.info('%s resumed with %d of %d pieces', repr(self), self.pieces_checked, len(self.piece_hashes))
+        return self.pieces_checked
+
+    def resume_state(self):
+        """(bitfield, partial pieces) of what we have that's in the data's
+        cache or on disk, for the resume file once that's flushed
+
+        Pieces still held in memory, or being hashed or written, aren't, so
+        they're left out and will be downloaded again.
+        """
+        partial = []
+        for i, received in enumerate(self.piece_bytes):
+            if (received and not self.blocks.verified(i) and i not in self.assembler and
+                    i not in self.hashing and i not in self.writing and i not in self.writes_pending):
+                partial.append((i, self.blocks.runs(i, RECEIVED)))
+        return self.blocks.bitfield(), partial
+
+    def write_resume(self, error, (bitfield, partial)):
+        """Writes the resume file, once the data its state was taken from has
+        been flushed"""
+        if error is not None:
+            logging.warning('%s couldn\'t flush data to save resume file: %s', repr(self), error)
+            return
+        try:
+            resume.write(self.resume_filename,
+                    resume.encode(self.info_hash, bitfield, partial, self.data.files))
+        except EnvironmentError as e:
+            logging.warning('%s couldn\'t save resume file: %s', repr(self), e)
+
+    def save_resume(self):
+        """Flushes the data and writes the resume file right away, on this
+        thread; the timer does it through the DiskIO"""
+        state = self.resume_state()
+        self.data.flush()
+        self.write_resume(None, state)
+        self.last_resume_save = time.time()
 
 
     def add_peer(self, ip, port):
@@ -226,64 +507,210 @@ class ActiveTorrent(Torrent):
         self.peers.remove(peer)
 
     def add_data(self, index, begin, block):
-        self.have_data[index*self.piece_length+begin:index*self.piece_length+begin+len(block)] = True
-        self.data[index*self.piece_length+begin:index*self.piece_length+begin+len(block)] = block
+        """Stores a received block, and checks the hash of its piece if that completed it"""
+        if begin + len(block) > self.piece_size(index):
+            logging.warning('%s got block (%d, %d, %d) past the end of its piece, ignoring it', repr(self), index, begin, len(block))
+            return
+        if begin % self.blocks.block_size:
+            logging.warning('%s got block (%d, %d, %d) not aligned to a block, ignoring it', repr(self), index, begin, len(block))
+            return
+        if self.endgame_started is not None:
+            self.cancel_duplicates(msg.Request(index, begin, len(block)))
+        start = index*self.piece_length+begin
+        end = start+len(block)
+        new_bytes = self._mark_received(index, begin, begin + len(block))
+        # the block may have been handed back and be wanted again; it isn't now
+        self._update_wanted(index)
+        if not new_bytes:
+            self.wasted_bytes += len(block)
+            return
+        # pieces are only buffered from their first block on, so a buffer holds all we have of its piece
+        buffered = False
+        if index in self.assembler or self.piece_bytes[index] == 0:
+            buffered = self.assembler.add(index, self.piece_size(index), begin, block)
+        if not buffered:
+            self.writes_pending[index] = self.writes_pending.get(index, 0) + 1
+            self.disk.write(self.data, start, bytearray(block), self.block_written, index)
+        self.piece_bytes[index] += new_bytes
+        self.bytes_have += new_bytes
         sys.stdout.write('file now %02.2f percent done\r' % self.percent())
         sys.stdout.flush()
-        #TODO check piece hash on the piece we might have finished
-        pieces_hashed = self.check_piece_hashes()
-        if hasattr(self.strategy, 'die_on_finish') and pieces_hashed == len(self.piece_hashes):
-            sys.exit()
-        # this version checks every piece for being done, which is unnecessary
-
-    def get_data_if_have(self, index, begin, length):
-        start = index*self.piece_length
-        end = index*self.piece_length+length
-        if self.have_data[start:end].all():
-            return str(self.data[start:end])
-        else:
+        if self.piece_bytes[index] == self.piece_size(index) and index not in self.writes_pending:
+            self.verify_piece(index)
+
+    def block_written(self, error, index):
+        if error is not None:
+            logging.warning('%s couldn\'t write a block of piece %d: %s', repr(self), index, error)
+            self.throw_out_piece(index)
+        self.writes_pending[index] -= 1
+        if self.writes_pending[index] == 0:
+            del self.writes_pending[index]
+            if self.piece_bytes[index] == self.piece_size(index):
+                self.verify_piece(index)
+
+    def disk_drained(self):
+        """Gets peers asking for blocks again, now the disk has caught up"""
+        for peer in list(self.peers):
+            peer.run_strategy()
+
+    def get_data_if_have(self, index, begin, length, callback, *args):
+        """If the bytes asked for are in a piece we've checked, reads them off
+        the reactor and calls callback(bytes, *args) with them, or
+        callback(exception, *args); returns whether they are"""
+        if begin + length > self.piece_size(index) or not self.blocks.verified(index):
             return False
+        start = index*self.piece_length+begin
+        self.disk.read(self.data, start, length, callback, *args)
+        return True
+
+    def get_regions_if_have(self, index, begin, length):
+        """Like get_data_if_have, but returns FileRegions to send the data from disk"""
+        if begin + length > self.piece_size(index) or not self.blocks.verified(index):
+            return False
+        start = index*self.piece_length+begin
+        # a checked piece was flushed before it was marked checked, so there's
+        # nothing to flush first, and no need to wait on a worker for the lock
+        return [FileRegion(da, s, e - s) for da, s, e in self.data.segments(start, start+length)]
 
     def done(self):
-        return self.have_data.count(1) == self.length
+        return self.bytes_have == self.length
 
     def percent(self):
-        return self.have_data.count(1) * 1.0 / self.length * 100
+        return self.bytes_have * 1.0 / self.length * 100
 
     def availability(self):
         """how many copies of the full file are available from connected peers"""
-        raise Exception("Not Yet Implemented")
+        return self.swarm.distributed_copies()
+
+    def update_interest(self, peers=None):
+        """Tells peers (default all of them) whether we're interested, which
+        we are if they have a piece we don't
+
+        Called when what peers have changes, for those peers, and when what
+        we have does, for all of them.
+        """
+        peers = self.peers if peers is None else peers
+        for peer, interesting in zip(peers, self.swarm.interesting(peers)):
+            if interesting and not peer.interested:
+                logging.info('%s sending interested', peer)
+                peer.send_msg(msg.Interested())
+                peer.interested = True
+            elif peer.interested and not interesting:
+                logging.info('%s sending not interested', peer)
+                peer.send_msg(msg.NotInterested())
+                peer.interested = False
 
     def get_needed_request(self, peer=None):
         """Returns a block to be requested, and marks it as pending
 
-        if a peer is provided, return a piece that we need that the peer has
+        Blocks come from the rarest piece we still need; if a peer is
+        provided, from the rarest one that peer has. None are handed out
+        while the disk is behind.
         """
-        try:
-            start = self.pending.index(0)
-        except ValueError:
+        if self.disk.congested:
             return False
-        suggested_length = 2**14
-        if peer:
-            #pending_pieces = []
-            #TODO cache this if it helps (or custom data structure that presents both interfaces)
-            #available = sparsebitarray.SparseBitArray(iterable=peer.peer_bitfield) & ~self.pending
-            #print peer.peer_bitfield
-            #print self.pending
-            #print available
-            suggested_length = peer.preferred_request_length
-        length = self.piece_length
-        index = start / self.piece_length
-        begin = start % self.piece_length
-        # don't ask for more in a piece than there is
-        # and cut the last piece short if necessary
-        length = min(suggested_length, self.piece_length - begin, self.length - start)
-        self.pending[start:(start+length)] = 2**length - 1
+        while True:
+            index = self.picker.pick(peer.peer_bitfield if peer else None)
+            if index is None:
+                if peer and not self.picker.num_wanted:
+                    return self.get_endgame_request(peer)
+                return False
+            block = self.blocks.find(index, MISSING)
+            if block >= 0:
+                break
+            logging.warning('%s piece %d was wanted with no blocks missing', repr(self), index)
+            self.picker.set_wanted(index, False)
+        begin, length = self.blocks.block_span(index, block)
+        self.blocks.set(index, block, REQUESTED)
+        self._update_wanted(index)
         return msg.Request(index=index, begin=begin, length=length)
 
+    def get_endgame_request(self, peer):
+        """Returns a block already requested from other peers that this peer
+        has too, or False
+
+        Blocks requested from the fewest peers, and then longest ago, go
+        first. A block is requested from at most ENDGAME_MAX_COPIES peers, and
+        at most ENDGAME_MAX_DUPLICATE_BYTES of duplicates are outstanding.
+        """
+        if self.endgame_started is None:
+            logging.info('%s entering endgame', repr(self))
+            self.endgame_started = time.time()
+        copies = self.request_copies
+        best = best_key = None
+        for m, sent in copies.sent.iteritems():
+            if (len(sent) >= ENDGAME_MAX_COPIES or m in peer.outstanding_requests or
+                    not peer.peer_bitfield[m.index_] or
+                    copies.duplicate_bytes + m.length > ENDGAME_MAX_DUPLICATE_BYTES):
+                continue
+            key = (len(sent), min(sent))
+            if best is None or key < best_key:
+                best, best_key = m, key
+        if best is None:
+            return False
+        self.duplicate_requests += 1
+        return best
+
+    def cancel_duplicates(self, m):
+        """Cancels request m with every peer it's still outstanding with"""
+        for peer in self.peers:
+            if peer.cancel_request(m):
+                self.cancels_sent += 1
+
+    def record_latency(self, seconds):
+        if self.endgame_started is None:
+            self.request_latency.add(seconds)
+        else:
+            self.endgame_latency.add(seconds)
+
+    def log_stats(self):
+        logging.info('%s block latency: %s', repr(self), self.request_latency)
+        logging.info('%s disk writes: %s; dirty bytes at flush: %s', repr(self), self.data.write_sizes, self.data.dirty_sizes)
+        for url, stats in self.tracker.stats().iteritems():
+            logging.info('%s tracker %s stats: %r', repr(self), url, stats)
+        for peer in self.peers:
+            logging.info('%s stats: %r', repr(peer), peer.stats())
+        if self.endgame_started is not None:
+            logging.info('%s endgame took %.1fs: block latency %s; %d duplicate requests, %d cancels, %d bytes received twice',
+                    repr(self), time.time() - self.endgame_started, self.endgame_latency,
+                    self.duplicate_requests, self.cancels_sent, self.wasted_bytes)
+
     def return_outstanding_request(self, m):
+        if m in self.request_copies:
+            return # still asked of another peer
         logging.info('returning %s', repr(m))
-        self.pending[m.begin:(m.begin+m.length)] = 0
+        block = m.begin // self.blocks.block_size
+        if self.blocks.get(m.index_, block) == REQUESTED:
+            self.blocks.set(m.index_, block, MISSING)
+            self.picker.set_wanted(m.index_, True)
+            self._update_endgame()
+
+    def throw_out_piece(self, i):
+        """Forgets what we have of piece i, so it's downloaded again"""
+        verified = self.blocks.verified(i)
+        self.blocks.set_piece(i, MISSING)
+        if verified:
+            self._verified_changed()
+        self.picker.set_wanted(i, True)
+        self._update_endgame()
+        self.bytes_have -= self.piece_bytes[i]
+        self.piece_bytes[i] = 0
+
+    def _verified_changed(self):
+        """Tells the swarm which pieces we have now, and peers whether we're
+        still interested"""
+        self.swarm.set_have(self.blocks.bitfield())
+        self.update_interest()
+
+    def _update_wanted(self, index):
+        self.picker.set_wanted(index, self.blocks.find(index, MISSING) >= 0)
+
+    def _update_endgame(self):
+        """Leaves endgame once there are blocks nobody has been asked for, as
+        after a failed hash check; it starts again when they're all pending"""
+        if self.endgame_started is not None and self.picker.num_wanted:
+            logging.info('%s leaving endgame', repr(self))
+            self.endgame_started = None
 
 def test():
     import doctest
@@ -0,0 +1,382 @@
+"""Drives an ActiveTorrent through requests, timeouts and arriving blocks
+
+python -m bittorrent.torrent_test
+
+Each test makes a torrent of random data in a temporary directory and
+runs a real ActiveTorrent on a real client there. Its peers are real
+Peers connected to a socket nobody reads from, so the messages they send
+just queue up; the test plays the other side by calling recv_msg and
+checks what the torrent asks for and what ends up on disk.
+"""
+import os
+import errno
+import time
+import random
+import socket
+import hashlib
+import tempfile
+import threading
+
+from . import msg
+from . import peer
+from . import peerstrategy
+from .bencode import bencode
+from .client import BittorrentClient
+from .peer import Peer
+from .assembly import PieceAssembler
+from .blockmap import MISSING, REQUESTED, RECEIVED
+
+BLOCK = 2**14
+
+class Harness(object):
+    def __init__(self, num_pieces=4, piece_length=2*BLOCK, last_piece=None):
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        length = piece_length * (num_pieces - 1) + (last_piece or piece_length)
+        self.payload = os.urandom(length)
+        pieces = ''.join(hashlib.sha1(self.payload[i:i+piece_length]).digest()
+                         for i in range(0, length, piece_length))
+        info = {'name': 'payload.bin', 'length': length, 'piece length': piece_length, 'pieces': pieces}
+        with open('test.torrent', 'wb') as f:
+            f.write(bencode({'announce': 'http://127.0.0.1:1/announce', 'creation date': int(time.time()), 'info': info}))
+        self.listen = socket.socket()
+        self.listen.bind(('127.0.0.1', 0))
+        self.listen.listen(50)
+        self.start()
+
+    def start(self):
+        self.client = BittorrentClient(0)
+        self.torrent = self.client.add_torrent('test.torrent')
+
+    def restart(self):
+        """Shuts the client down and starts another on the same files, as when
+        the program is run again"""
+        self.client.shutdown()
+        self.start()
+
+    def peer(self, pieces=None):
+        """A Peer that has pieces (default all of them), has unchoked us and
+        that we're interested in"""
+        p = Peer(self.listen.getsockname(), active_torrent=self.torrent)
+        self.torrent.peers.append(p)
+        bits = ['1' if pieces is None or i in pieces else '0' for i in range(len(self.torrent.piece_hashes))]
+        bits += ['0'] * (-len(bits) % 8)
+        p.recv_msg(msg.Bitfield(bitfield=''.join(chr(int(''.join(bits[i:i+8]), 2)) for i in range(0, len(bits), 8))))
+        p.recv_msg(msg.Unchoke())
+        p.interested = True
+        return p
+
+    def sent(self, p):
+        """Records the messages p sends from now on, in the list returned"""
+        sent = []
+        real = p.connection.send_msg
+        def send_msg(*messages):
+            sent.extend(messages)
+            real(*messages)
+        p.connection.send_msg = send_msg
+        return sent
+
+    def seed(self):
+        """Loads the whole payload, as a seeder would have it"""
+        path = os.path.join(self.dir, 'seeding.bin')
+        with open(path, 'wb') as f:
+            f.write(self.payload)
+        assert self.torrent.load(path) == len(self.torrent.piece_hashes)
+
+    def block(self, index, begin, length=BLOCK):
+        start = index * self.torrent.piece_length + begin
+        return msg.Piece(index=index, begin=begin, block=self.payload[start:start+length])
+
+    def run_until(self, condition, limit=5):
+        deadline = time.time() + limit
+        while not condition():
+            assert time.time() < deadline, 'gave up waiting'
+            self.client.reactor.poll(.05)
+
+    def close(self):
+        self.client.shutdown()
+        self.listen.close()
+
+    def on_disk(self, flush=True):
+        if flush:
+            self.torrent.data.flush()
+        with open(os.path.join(self.dir, 'outputfolder', 'payload.bin'), 'rb') as f:
+            return f.read()
+
+def test_late_block_after_timeout():
+    """A block that arrives after its request timed out and was handed back
+    must not leave its piece wanted with nothing missing"""
+    h = Harness(num_pieces=1)
+    t = h.torrent
+    p = h.peer()
+    first, second = t.get_needed_request(p), t.get_needed_request(p)
+    assert (first.index_, first.begin, second.index_, second.begin) == (0, 0, 0, BLOCK)
+    p.outstanding_requests.add(first, time.time() - 10, time.time() - 1)
+    p.outstanding_requests.add(second, time.time(), time.time() + 60)
+    p.check_outstanding_requests()
+    assert t.blocks.get(0, 0) == MISSING and t.picker.num_wanted == 1
+    p.recv_msg(h.block(0, 0)) # late, after it was handed back
+    assert t.blocks.get(0, 0) == RECEIVED and t.picker.num_wanted == 0, 'piece still wanted with nothing missing'
+    # and should the picker still offer it, it's dropped rather than asked for at block -1
+    t.picker.set_wanted(0, True)
+    assert t.get_needed_request(p) is False and t.picker.num_wanted == 0
+    p.recv_msg(h.block(0, BLOCK))
+    assert t.blocks.bitfield() == '\x00'
+    h.run_until(lambda: t.pieces_checked == 1)
+    assert t.blocks.bitfield() == '\x80', 'cached bitfield not updated when the piece was verified'
+    assert h.on_disk() == h.payload
+    h.close()
+
+def test_endgame_left_on_hash_failure():
+    """Duplicates are only asked for while every block is pending; once a
+    piece fails its check its blocks are requested once again"""
+    h = Harness(num_pieces=1)
+    t = h.torrent
+    p1, p2 = h.peer(), h.peer()
+    p1.send_msg(t.get_needed_request(p1), t.get_needed_request(p1))
+    duplicate = t.get_needed_request(p2)
+    assert t.endgame_started is not None and (duplicate.index_, duplicate.begin) == (0, 0)
+    p2.send_msg(duplicate)
+    assert len(t.request_copies.sent[duplicate]) == 2 and t.request_copies.duplicate_bytes == BLOCK
+    p1.recv_msg(msg.Piece(index=0, begin=0, block='\0' * BLOCK))
+    assert duplicate not in p2.outstanding_requests and t.cancels_sent == 1
+    assert duplicate not in t.request_copies and t.request_copies.duplicate_bytes == 0
+    p1.recv_msg(msg.Piece(index=0, begin=BLOCK, block='\0' * BLOCK))
+    h.run_until(lambda: t.blocks.get(0, 0) == MISSING)
+    assert t.endgame_started is None, 'still in endgame with the whole piece wanted again'
+    m = t.get_needed_request(p2)
+    assert (m.index_, m.begin) == (0, 0) and t.duplicate_requests == 1
+    p2.send_msg(m, t.get_needed_request(p2))
+    p2.recv_msg(h.block(0, 0))
+    p2.recv_msg(h.block(0, BLOCK))
+    assert not t.request_copies.sent
+    h.run_until(lambda: t.pieces_checked == 1)
+    assert h.on_disk() == h.payload
+    h.close()
+
+def test_timeout_returns_block():
+    """A request that times out is canceled and its block handed back, to be
+    asked of another peer"""
+    h = Harness(num_pieces=1)
+    t = h.torrent
+    slow, fast = h.peer(), h.peer()
+    sent = h.sent(slow)
+    slow.request_timeout = lambda: -1
+    first, second = t.get_needed_request(slow), t.get_needed_request(slow)
+    slow.send_msg(first, second)
+    assert t.picker.num_wanted == 0
+    slow.check_outstanding_requests()
+    assert [(m.kind, m.index_, m.begin) for m in sent if m.kind == 'cancel'] == [('cancel', 0, 0), ('cancel', 0, BLOCK)]
+    assert not slow.outstanding_requests and slow.stalls == 1
+    assert t.blocks.get(0, 0) == t.blocks.get(0, 1) == MISSING and t.picker.num_wanted == 1
+    requests = [t.get_needed_request(fast), t.get_needed_request(fast)]
+    assert [(m.index_, m.begin) for m in requests] == [(0, 0), (0, BLOCK)]
+    assert t.endgame_started is None and t.duplicate_requests == 0
+    fast.send_msg(*requests)
+    fast.recv_msg(h.block(0, 0))
+    fast.recv_msg(h.block(0, BLOCK))
+    h.run_until(lambda: t.pieces_checked == 1)
+    assert h.on_disk() == h.payload
+    h.close()
+
+def test_wanted_again_after_more_peers_came():
+    """A piece whose blocks were all requested, and that more peers have
+    announced since, is wanted again when its requests time out or it
+    fails its check"""
+    h = Harness(num_pieces=1)
+    t = h.torrent
+    first = h.peer()
+    first.request_timeout = lambda: -1
+    first.send_msg(t.get_needed_request(first), t.get_needed_request(first))
+    second = h.peer()
+    assert t.picker.num_wanted == 0 and t.picker.availability[0] == 2
+    first.check_outstanding_requests()
+    assert t.picker.num_wanted == 1 and t.picker.pick(second.peer_bitfield) == 0
+    requests = [t.get_needed_request(second), t.get_needed_request(second)]
+    third = h.peer()
+    second.send_msg(*requests)
+    assert t.picker.num_wanted == 0 and t.picker.availability[0] == 3
+    second.recv_msg(msg.Piece(index=0, begin=0, block='\0' * BLOCK))
+    second.recv_msg(msg.Piece(index=0, begin=BLOCK, block='\0' * BLOCK))
+    h.run_until(lambda: t.picker.num_wanted == 1)
+    assert t.picker.pick(third.peer_bitfield) == 0
+    third.send_msg(t.get_needed_request(third), t.get_needed_request(third))
+    third.recv_msg(h.block(0, 0))
+    third.recv_msg(h.block(0, BLOCK))
+    h.run_until(lambda: t.pieces_checked == 1)
+    assert h.on_disk() == h.payload
+    h.close()
+
+def test_interest_follows_have_and_verification():
+    """Interest is worked out when a peer says what it has and when a piece
+    is verified, not on every message; the picker counts the pieces the
+    swarm does"""
+    h = Harness(num_pieces=2)
+    t = h.torrent
+    p = Peer(h.listen.getsockname(), active_torrent=t)
+    t.peers.append(p)
+    p.strategy = peerstrategy.keep_asking_strategy
+    asked = []
+    interesting = t.swarm.interesting
+    t.swarm.interesting = lambda peers: asked.append(peers) or interesting(peers)
+    p.recv_msg(msg.Have(index=1))
+    assert p.interested and asked == [[p]]
+    assert list(t.picker.availability) == list(t.swarm.availability()) == [0, 1]
+    p.recv_msg(msg.Unchoke())
+    p.run_strategy()
+    assert len(p.outstanding_requests) == 2 and len(asked) == 1
+    p.recv_msg(h.block(1, 0))
+    p.recv_msg(h.block(1, BLOCK))
+    h.run_until(lambda: t.pieces_checked == 1)
+    assert not p.interested and asked[-1] == t.peers
+    h.close()
+
+def test_assembly_and_disk_order():
+    """Buffered pieces and pieces written block by block both reach the disk
+    before they're announced, whatever order their blocks come in"""
+    h = Harness(num_pieces=3)
+    t = h.torrent
+    t.assembler = PieceAssembler(t.piece_length) # room to buffer one piece
+    p = h.peer()
+    announced = []
+    real = p.send_msg
+    def send_msg(*messages):
+        for m in messages:
+            if m.kind == 'have':
+                start = m.index_ * t.piece_length
+                announced.append((m.index_, h.on_disk(flush=False)[start:start+t.piece_length] ==
+                                            h.payload[start:start+t.piece_length]))
+        real(*messages)
+    p.send_msg = send_msg
+    requests = [t.get_needed_request(p) for _ in range(6)]
+    assert sorted((m.index_, m.begin) for m in requests) == [(i, b) for i in range(3) for b in (0, BLOCK)]
+    real(*requests)
+    for index in (2, 1, 0):
+        p.recv_msg(h.block(index, BLOCK))
+    assert list(t.assembler.buffers) == [2] and t.assembler.memory_used == t.piece_length
+    assert set(t.writes_pending) <= set([0, 1]) and not t.pieces_checked
+    for index in (2, 1, 0):
+        p.recv_msg(h.block(index, 0))
+    h.run_until(lambda: t.pieces_checked == 3)
+    assert sorted(announced) == [(0, True), (1, True), (2, True)], announced
+    assert not t.writes_pending and not len(t.assembler) and t.assembler.memory_used == 0
+    assert h.on_disk() == h.payload
+    h.close()
+
+def test_write_failure():
+    """A block that can't be written throws its piece out, to be downloaded
+    again, rather than stopping the disk worker or the reactor"""
+    h = Harness(num_pieces=1)
+    t = h.torrent
+    t.assembler = PieceAssembler(0) # straight to disk
+    p = h.peer()
+    da = t.data.diskarrays[0]
+    def fail(start, value):
+        del da.cache # just the once
+        raise IOError(errno.ENOSPC, 'No space left on device')
+    da.cache = fail
+    p.send_msg(t.get_needed_request(p), t.get_needed_request(p))
+    p.recv_msg(h.block(0, 0))
+    h.run_until(lambda: not t.writes_pending)
+    assert t.blocks.get(0, 0) == MISSING and t.bytes_have == 0
+    p.recv_msg(h.block(0, BLOCK))
+    m = t.get_needed_request(p)
+    assert (m.index_, m.begin) == (0, 0)
+    p.send_msg(m)
+    p.recv_msg(h.block(0, 0))
+    h.run_until(lambda: t.pieces_checked == 1)
+    assert h.on_disk() == h.payload
+    h.close()
+
+def test_load_closes_old_data():
+    """Loading other files writes out what was cached for the old ones and
+    closes them"""
+    h = Harness()
+    old = h.torrent.data
+    old[:BLOCK] = h.payload[:BLOCK]
+    h.seed()
+    assert all(da.f.closed for da in old.diskarrays)
+    assert h.on_disk(flush=False)[:BLOCK] == h.payload[:BLOCK], 'cached write lost'
+    h.close()
+
+def test_upload_read_off_reactor():
+    """Without sendfile, blocks asked for are read on the DiskIO and sent
+    when the read is done, unless they were canceled meanwhile"""
+    h = Harness()
+    h.seed()
+    p = h.peer()
+    sent = []
+    p.send_piece = lambda index, begin, block: sent.append((index, begin, str(block)))
+    real = peer.sendfile
+    peer.sendfile = None
+    try:
+        p.recv_msg(msg.Interested())
+        p.recv_msg(msg.Request(1, BLOCK, BLOCK))
+        p.recv_msg(msg.Request(2, 0, BLOCK))
+        p.recv_msg(msg.Cancel(2, 0, BLOCK))
+        assert not sent, 'read on the reactor'
+        h.run_until(lambda: not p.uploads_reading)
+        assert sent == [(1, BLOCK, h.payload[3*BLOCK:4*BLOCK])], sent
+    finally:
+        peer.sendfile = real
+    h.close()
+
+def test_upload_regions_without_waiting():
+    """With sendfile, a checked piece's regions are queued without waiting
+    for a disk worker that's busy with the same file"""
+    h = Harness()
+    h.seed()
+    p = h.peer()
+    queued = []
+    p.send_piece_from_disk = lambda index, begin, regions: queued.append((index, begin, regions))
+    busy = h.torrent.data.diskarrays[0].lock
+    held, release = threading.Event(), threading.Event()
+    def worker():
+        with busy:
+            held.set()
+            release.wait(5)
+    t = threading.Thread(target=worker)
+    t.start()
+    held.wait()
+    try:
+        p.recv_msg(msg.Interested())
+        start = time.time()
+        p.recv_msg(msg.Request(1, BLOCK, BLOCK))
+        assert time.time() - start < 1, 'waited for the disk worker'
+    finally:
+        release.set()
+        t.join()
+    [(index, begin, regions)] = queued
+    assert (index, begin, [(r.offset, r.length) for r in regions]) == (1, BLOCK, [(3*BLOCK, BLOCK)])
+    h.close()
+
+def test_resume_restore():
+    """Blocks still queued for the disk at shutdown are written before the
+    resume file is, and the next run picks up the pieces and blocks it lists"""
+    h = Harness()
+    t = h.torrent
+    t.assembler = PieceAssembler(0) # straight to disk
+    p = h.peer()
+    for index, begin in [(0, 0), (0, BLOCK), (2, BLOCK)]:
+        m = msg.Request(index, begin, BLOCK)
+        t.blocks.set(index, begin // BLOCK, REQUESTED)
+        p.send_msg(m)
+        p.recv_msg(h.block(index, begin))
+    assert t.writes_pending, 'the writes were handed back before shutdown'
+    h.restart()
+    t = h.torrent
+    assert os.path.exists(t.resume_filename)
+    assert t.pieces_checked == 1 and t.blocks.verified(0)
+    assert [t.blocks.get(2, block) for block in range(2)] == [MISSING, RECEIVED]
+    assert t.bytes_have == 3 * BLOCK and t.picker.num_wanted == 3
+    data = h.on_disk()
+    assert data[:2*BLOCK] == h.payload[:2*BLOCK] and data[5*BLOCK:6*BLOCK] == h.payload[5*BLOCK:6*BLOCK]
+    h.close()
+
+if __name__ == '__main__':
+    for test in [test_late_block_after_timeout, test_endgame_left_on_hash_failure, test_timeout_returns_block,
+                 test_wanted_again_after_more_peers_came, test_interest_follows_have_and_verification,
+                 test_assembly_and_disk_order, test_write_failure, test_load_closes_old_data,
+                 test_upload_read_off_reactor, test_upload_regions_without_waiting, test_resume_restore]:
+        test()
+        print test.__name__, 'ok'
@@ -1,4 +1,3 @@
-import time
 import sys
 import logging
 
@@ -12,10 +11,9 @@ class connect_and_ask_n_peers(object):
     def get_name(self):
         return 'connect_and_ask_%d_peers' % self.max_simul_peers
     def __call__(self, torrent):
-        torrent.check_piece_hashes()
-        if time.time() - torrent.last_tracker_update > 600:
-            torrent.tracker_update()
-
+        if not torrent.last_tracker_update:
+            torrent.tracker_update() # does nothing while an announce is running
+        else:
             addresses = torrent.tracker_peer_addresses
 
             logging.info( 'got these peers from tracker: %s', repr(torrent.tracker_peer_addresses))
@@ -38,8 +36,7 @@ class connect_and_ask_n_peers(object):
 
 class quit_when_done(connect_and_ask_n_peers):
     def __call__(self, torrent):
-        pieces_hashed = torrent.check_piece_hashes()
-        if pieces_hashed == len(torrent.piece_hashes):
+        if torrent.pieces_checked == len(torrent.piece_hashes):
             sys.exit(0)
         connect_and_ask_n_peers.__call__(self, torrent)
     die_on_finish = True
@@ -0,0 +1,683 @@
+"""Announcing to HTTP and UDP trackers from the reactor
+
+An announce is a readerwriter, so a slow or dead tracker never holds up
+peer connections. Over HTTP it connects without blocking, writes the GET
+request as the socket takes it, and feeds the response body to a
+bencode.IncrementalDecoder as it arrives. Over UDP (BEP 15) it's a
+connect and an announce datagram exchange, each retransmitted on a
+timer; the connection id the tracker hands out is reused for a minute.
+
+A Tracker decides when to announce: every interval the tracker asks for,
+never sooner than its min interval, and after a failure again after a
+backoff that doubles each time. Both kinds pass on responses in the same
+form, a dictionary like a decoded HTTP response with compact peers.
+Before its first announce a Tracker looks up the tracker's host name,
+which a Resolver does on a worker thread.
+
+TrackerTiers runs the trackers of a torrent's announce-list (BEP 12),
+every tracker of a tier at once, and merges the peers they return.
+
+>>> parse_url('http://tracker.example.com:6969/announce?passkey=x')
+('tracker.example.com', 6969, '/announce?passkey=x')
+>>> parse_url('http://127.0.0.1/announce')
+('127.0.0.1', 80, '/announce')
+>>> parse_url('udp://tracker.example.com:6969/announce', 'udp')
+('tracker.example.com', 6969, '/announce')
+>>> decode_peers('\\x7f\\x00\\x00\\x01\\x1a\\xe1')
+[('127.0.0.1', 6881)]
+>>> decode_peers([{'ip': '10.0.0.2', 'port': 6882, 'peer id': 'x'*20}])
+[('10.0.0.2', 6882)]
+>>> [backoff(n) for n in range(1, 9)]
+[15, 30, 60, 120, 240, 480, 960, 1800]
+"""
+import os
+import time
+import errno
+import random
+import socket
+import struct
+import logging
+import urllib
+import urlparse
+import threading
+import Queue
+
+from . import bencode
+from .stats import Histogram
+
+ANNOUNCE_TIMEOUT = 30 # seconds for a whole announce, from connect to the last byte
+DEFAULT_INTERVAL = 30*60 # between announces, if the tracker doesn't say
+MIN_BACKOFF = 15 # before retrying after the first failure in a row
+MAX_BACKOFF = 30*60
+MAX_RESPONSE_SIZE = 2**20
+UDP_RETRANSMIT_TIMEOUT = 15 # before the first UDP retransmit; doubles with each one, as BEP 15 says
+UDP_MAX_TRANSMITS = 4 # sends of a UDP request before giving up on it
+UDP_CONNECTION_ID_LIFETIME = 60
+RESOLVER_WORKERS = 2
+
+UDP_PROTOCOL_ID = 0x41727101980
+CONNECT, ANNOUNCE, SCRAPE, ERROR = range(4)
+UDP_EVENTS = {None: 0, 'completed': 1, 'started': 2, 'stopped': 3}
+
+class TrackerError(Exception): pass
+
+def parse_url(url, scheme='http'):
+    """(host, port, path) of an announce URL"""
+    parts = urlparse.urlsplit(url)
+    if parts.scheme != scheme or not parts.hostname:
+        raise TrackerError('not an %s announce url: %r' % (scheme, url))
+    if scheme == 'udp' and not parts.port:
+        raise TrackerError('no port in udp announce url: %r' % url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    return parts.hostname, parts.port or 80, path
+
+def decode_peers(peers):
+    """(ip, port) pairs from a compact peers string or a list of peer dictionaries"""
+    if isinstance(peers, str):
+        return [(socket.inet_ntoa(peers[i:i+4]), struct.unpack('!H', peers[i+4:i+6])[0])
+                for i in range(0, len(peers) - 5, 6)]
+    return [(p['ip'], p['port']) for p in peers if isinstance(p, dict) and 'ip' in p and 'port' in p]
+
+def backoff(failures):
+    """Seconds to wait before announcing again after failures failures in a row"""
+    return min(MIN_BACKOFF * 2**(failures - 1), MAX_BACKOFF)
+
+class _Lookup(object):
+    """A host name lookup a Resolver is running; closing it drops the result"""
+    def __init__(self, host, port, callback, args):
+        self.host = host
+        self.port = port
+        self.callback = callback
+        self.args = args
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class Resolver(object):
+    """Looks up host names on worker threads
+
+    getaddrinfo blocks for as long as DNS takes, so lookups are queued to
+    workers and each address is handed back on the reactor thread through
+    a Waker, the way HashPool hands back digests.
+    """
+    def __init__(self, waker, workers=RESOLVER_WORKERS):
+        """With workers=0, lookups run right away on the calling thread"""
+        self.waker = waker
+        self.queue = Queue.Queue()
+        self.threads = []
+        for _ in range(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def resolve(self, host, port, callback, *args):
+        """Calls callback(address, *args) on the reactor thread with the IPv4
+        (ip, port) of host, or callback(error, *args) with a TrackerError.
+        Returns the lookup, whose close() drops the result, or None if it
+        has already been called back."""
+        lookup = _Lookup(host, port, callback, args)
+        if not self.threads:
+            self._done(lookup, self._lookup(host, port))
+            return None
+        self.queue.put(lookup)
+        return lookup
+
+    def _lookup(self, host, port):
+        try:
+            return socket.getaddrinfo(host, port, socket.AF_INET)[0][4]
+        except socket.error as e:
+            return TrackerError('looking up %s: %s' % (host, e))
+
+    def _work(self):
+        while True:
+            lookup = self.queue.get()
+            if lookup is None:
+                return
+            if not lookup.closed:
+                self.waker.post(self._done, lookup, self._lookup(lookup.host, lookup.port))
+
+    def _done(self, lookup, result):
+        if not lookup.closed:
+            lookup.callback(result, *lookup.args)
+
+    def close(self):
+        """Waits for the workers to finish the lookups they're on and stop;
+        lookups still queued are dropped"""
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                break
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+class HTTPAnnounce(object):
+    """One GET of an announce URL, run by the reactor
+
+    callback(response, external_ip) is called once, with the decoded
+    response dictionary or a TrackerError saying what went wrong, and the
+    address our end of the connection had (None if it never connected).
+    """
+    def __init__(self, addr, host, path, reactor, callback, timeout=ANNOUNCE_TIMEOUT):
+        self.reactor = reactor
+        self.callback = callback
+        self.request = 'GET %s HTTP/1.0\r\nHost: %s\r\nConnection: close\r\n\r\n' % (
+                path, host if addr[1] == 80 else '%s:%d' % (host, addr[1]))
+        self.header = ''
+        self.decoder = None # once the header has been read
+        self.received = 0
+        self.connected = False
+        self.done = False
+        self.error = None
+        self.external_ip = None
+
+        self.s = socket.socket()
+        self.s.setblocking(False)
+        err = self.s.connect_ex(addr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            # report it from the reactor, like any other failure
+            self.error = TrackerError('connecting to %s:%d: %s' % (addr[0], addr[1], os.strerror(err)))
+            self.reactor.start_timer(0, self)
+        else:
+            self.reactor.start_timer(timeout, self)
+        self.reactor.add_readerwriter(self.s.fileno(), self)
+        self.reactor.reg_write(self.s)
+
+    def write_event(self):
+        if self.done:
+            return
+        if not self.connected:
+            err = self.s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                return self.finish(TrackerError('connecting: %s' % os.strerror(err)))
+            self.connected = True
+            self.external_ip = self.s.getsockname()[0]
+            self.reactor.reg_read(self.s)
+        try:
+            sent = self.s.send(self.request)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            return self.finish(TrackerError('sending request: %s' % e))
+        self.request = self.request[sent:]
+        if not self.request:
+            self.reactor.unreg_write(self.s)
+
+    def read_event(self):
+        if self.done:
+            return
+        try:
+            data = self.s.recv(2**16)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            return self.finish(TrackerError('receiving response: %s' % e))
+        if not data:
+            return self.finish(TrackerError('connection closed before the whole response arrived'))
+        self.received += len(data)
+        if self.received > MAX_RESPONSE_SIZE:
+            return self.finish(TrackerError('response longer than %d bytes' % MAX_RESPONSE_SIZE))
+        if self.decoder is None:
+            self.header += data
+            end = self.header.find('\r\n\r\n')
+            if end < 0:
+                return
+            status = self.header.split('\r\n', 1)[0].split(None, 2)
+            if len(status) < 2 or status[1] != '200':
+                return self.finish(TrackerError('tracker replied %r' % self.header.split('\r\n', 1)[0]))
+            data = self.header[end+4:]
+            self.decoder = bencode.IncrementalDecoder()
+        try:
+            if not self.decoder.feed(data):
+                return
+        except bencode.DecodeError as e:
+            return self.finish(TrackerError('bad response: %s' % e))
+        if not isinstance(self.decoder.value, dict):
+            return self.finish(TrackerError('response is not a dictionary'))
+        self.finish(self.decoder.value)
+
+    def timer_event(self):
+        self.finish(self.error or TrackerError('timed out'))
+
+    def finish(self, result):
+        if self.done:
+            return
+        self.close()
+        self.callback(result, self.external_ip)
+
+    def close(self):
+        """Abandons the announce without calling back"""
+        self.done = True
+        self.reactor.remove_readerwriter(self.s.fileno())
+        self.reactor.cancel_timers(self)
+        self.s.close()
+
+class Tracker(object):
+    """Announces to one tracker on the schedule it asks for
+
+    get_params() gives the parameters of each announce, as for an HTTP
+    announce query, and on_response(response) is called with each
+    successful response, on_failure(error) (if given) with each failure.
+    The host name is looked up by resolver, or right away if there's none.
+    Subclasses start announces in _start, once self.addr is known, and
+    call _done with the result.
+
+    self.interval, self.min_interval: from the last response
+    self.failures: failed announces since the last one that worked
+    self.external_ip: our address, as seen from our end of the last connection
+    self.latency: Histogram of seconds from announce to response
+    """
+    scheme = 'http'
+
+    def __init__(self, url, reactor, get_params, on_response, timeout=ANNOUNCE_TIMEOUT, on_failure=None,
+                 resolver=None):
+        self.url = url
+        self.reactor = reactor
+        self.resolver = resolver if resolver is not None else Resolver(None, workers=0)
+        self.get_params = get_params
+        self.on_response = on_response
+        self.on_failure = on_failure
+        self.timeout = timeout
+        self.addr = None # resolved on the first announce
+        self.interval = DEFAULT_INTERVAL
+        self.min_interval = None
+        self.failures = 0
+        self.last_announce = None
+        self.next_announce = None
+        self.external_ip = None
+        self.announcing = None
+        self.timer = None
+        self.announces = 0
+        self.successes = 0
+        self.errors = 0
+        self.last_error = None
+        self.latency = Histogram()
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, self.url)
+
+    def stats(self):
+        return {
+            'announces': self.announces,
+            'successes': self.successes,
+            'errors': self.errors,
+            'failures_in_a_row': self.failures,
+            'last_error': self.last_error,
+            'latency': str(self.latency),
+            'interval': self.interval,
+            'next_announce': self.next_announce and self.next_announce - time.time(),
+        }
+
+    def announce(self, event=None):
+        """Starts an announce unless one is running, or it's sooner than the
+        tracker's min interval after the last; returns whether it started
+
+        An event ('started', 'completed' or 'stopped') is sent regardless
+        of the min interval.
+        """
+        now = time.time()
+        if self.announcing is not None:
+            return False
+        if (event is None and self.min_interval and self.last_announce is not None and
+                now - self.last_announce < self.min_interval):
+            return False
+        self._cancel_timer()
+        self.last_announce = now
+        self.announces += 1
+        params = self.get_params()
+        if event is not None:
+            params['event'] = event
+        if self.addr is not None:
+            return self._begin(params)
+        # only the first announce waits on the name lookup
+        try:
+            lookup = self._resolve(self._announce_resolved, params)
+        except TrackerError as e:
+            self._failed(e)
+            return False
+        if lookup is not None:
+            self.announcing = lookup
+        return self.announcing is not None
+
+    def _begin(self, params):
+        try:
+            self.announcing = self._start(params)
+        except (TrackerError, socket.error) as e:
+            self._failed(e)
+            return False
+        return True
+
+    def _announce_resolved(self, error, params):
+        self.announcing = None
+        if error is not None:
+            return self._failed(error)
+        self._begin(params)
+
+    def _resolve(self, then, *args):
+        """Looks up the tracker's address, then calls then(None, *args) with
+        self.addr set, or then(error, *args); returns the lookup if it's
+        still running"""
+        host, port, _ = parse_url(self.url, self.scheme)
+        return self.resolver.resolve(host, port, self._resolved, then, args)
+
+    def _resolved(self, addr, then, args):
+        if isinstance(addr, TrackerError):
+            return then(addr, *args)
+        self.addr = addr
+        then(None, *args)
+
+    def _done(self, response, external_ip):
+        self.announcing = None
+        if external_ip is not None:
+            self.external_ip = external_ip
+        if isinstance(response, TrackerError):
+            return self._failed(response)
+        if 'failure reason' in response:
+            return self._failed(TrackerError('tracker failure: %s' % response['failure reason']))
+        self.failures = 0
+        self.successes += 1
+        self.latency.add(time.time() - self.last_announce)
+        self.interval = response.get('interval', DEFAULT_INTERVAL)
+        self.min_interval = response.get('min interval')
+        if 'warning message' in response:
+            logging.warning('%r warning: %s', self, response['warning message'])
+        self._schedule(max(self.interval, self.min_interval or 0))
+        self.on_response(response)
+
+    def _failed(self, error):
+        self.failures += 1
+        self.errors += 1
+        self.last_error = str(error)
+        delay = max(backoff(self.failures), self.min_interval or 0)
+        logging.warning('%r announce failed (%d in a row), retrying in %ds: %s', self, self.failures, delay, error)
+        self._schedule(delay)
+        if self.on_failure is not None:
+            self.on_failure(error)
+
+    def _schedule(self, delay):
+        self._cancel_timer()
+        self.next_announce = time.time() + delay
+        self.timer = self.reactor.start_timer(delay, self)
+
+    def _cancel_timer(self):
+        if self.timer is not None:
+            self.reactor.cancel_timer(self.timer)
+            self.timer = None
+        self.next_announce = None
+
+    def timer_event(self):
+        self.timer = None
+        self.announce()
+
+    def close(self):
+        """Stops announcing, abandoning any announce in progress"""
+        self._cancel_timer()
+        if self.announcing is not None:
+            self.announcing.close()
+            self.announcing = None
+
+class HTTPTracker(Tracker):
+    def __init__(self, *args, **kwargs):
+        Tracker.__init__(self, *args, **kwargs)
+        self.tracker_id = None
+
+    def _start(self, params):
+        if self.tracker_id is not None:
+            params['trackerid'] = self.tracker_id
+        host, port, path = parse_url(self.url)
+        path += ('&' if '?' in path else '?') + urllib.urlencode(params)
+        logging.info('%r announcing %s', self, path)
+        return HTTPAnnounce(self.addr, host, path, self.reactor, self._done, self.timeout)
+
+    def _done(self, response, external_ip):
+        if isinstance(response, dict):
+            self.tracker_id = response.get('tracker id', self.tracker_id)
+        Tracker._done(self, response, external_ip)
+
+class UDPExchange(object):
+    """One request to a UDP tracker, run by the reactor
+
+    Sends a connect request first unless it's given a connection id
+    still fresh enough to use, then the request: action and payload,
+    the bytes after the transaction id. Each is retransmitted after
+    UDP_RETRANSMIT_TIMEOUT seconds, doubling each time, up to
+    UDP_MAX_TRANSMITS sends.
+
+    callback(result, external_ip, connection) is called once, with the
+    reply's bytes after its transaction id, or a TrackerError, and the
+    (connection id, time it was got) pair to use next time.
+    """
+    def __init__(self, addr, connection, action, payload, reactor, callback,
+                 retransmit_timeout=UDP_RETRANSMIT_TIMEOUT):
+        self.reactor = reactor
+        self.callback = callback
+        self.action = action
+        self.payload = payload
+        self.connection = connection
+        self.retransmit_timeout = retransmit_timeout
+        self.transmits = 0
+        self.done = False
+
+        self.s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.s.setblocking(False)
+        self.s.connect(addr)
+        self.external_ip = self.s.getsockname()[0]
+        self.reactor.add_readerwriter(self.s.fileno(), self)
+        self.reactor.reg_read(self.s)
+        # first send from the reactor too, so failures are always reported from it
+        self.reactor.start_timer(0, self)
+
+    def connected(self):
+        return (self.connection is not None and
+                time.time() - self.connection[1] < UDP_CONNECTION_ID_LIFETIME)
+
+    def send(self):
+        if self.transmits == UDP_MAX_TRANSMITS:
+            return self.finish(TrackerError('timed out after %d tries' % self.transmits))
+        self.transaction_id = random.getrandbits(31)
+        if self.connected():
+            packet = struct.pack('!qii', self.connection[0], self.action, self.transaction_id) + self.payload
+        else:
+            packet = struct.pack('!qii', UDP_PROTOCOL_ID, CONNECT, self.transaction_id)
+        try:
+            self.s.send(packet)
+        except socket.error as e:
+            return self.finish(TrackerError('sending: %s' % e))
+        self.reactor.cancel_timers(self)
+        self.reactor.start_timer(self.retransmit_timeout * 2**self.transmits, self)
+        self.transmits += 1
+
+    def read_event(self):
+        if self.done:
+            return
+        try:
+            data = self.s.recv(2**16)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            return self.finish(TrackerError('receiving: %s' % e))
+        if len(data) < 8:
+            return
+        action, transaction_id = struct.unpack('!ii', data[:8])
+        if transaction_id != self.transaction_id:
+            return # a reply to a request we've since resent
+        if action == ERROR:
+            return self.finish(TrackerError('tracker error: %s' % data[8:]))
+        if action == CONNECT and len(data) >= 16:
+            self.connection = (struct.unpack('!q', data[8:16])[0], time.time())
+            self.transmits = 0
+            return self.send()
+        if action == self.action:
+            return self.finish(data[8:])
+        return self.finish(TrackerError('unexpected reply with action %d' % action))
+
+    def timer_event(self):
+        self.send()
+
+    def finish(self, result):
+        if self.done:
+            return
+        self.close()
+        self.callback(result, self.external_ip, self.connection)
+
+    def close(self):
+        """Abandons the request without calling back"""
+        self.done = True
+        self.reactor.remove_readerwriter(self.s.fileno())
+        self.reactor.cancel_timers(self)
+        self.s.close()
+
+class UDPTracker(Tracker):
+    """self.connection: (connection id, when we got it) from the tracker's
+    last connect reply, used for requests within a minute of that"""
+    scheme = 'udp'
+
+    def __init__(self, url, reactor, get_params, on_response, timeout=ANNOUNCE_TIMEOUT,
+                 on_failure=None, resolver=None, retransmit_timeout=UDP_RETRANSMIT_TIMEOUT):
+        Tracker.__init__(self, url, reactor, get_params, on_response, timeout, on_failure, resolver)
+        self.retransmit_timeout = retransmit_timeout
+        self.connection = None
+        self.key = random.getrandbits(32)
+
+    def _exchange(self, action, payload, callback):
+        return UDPExchange(self.addr, self.connection, action, payload, self.reactor, callback,
+                           self.retransmit_timeout)
+
+    def _start(self, params):
+        payload = struct.pack('!20s20sqqqiIIiH', params['info_hash'], params['peer_id'],
+                              params.get('downloaded', 0), params.get('left', 0),
+                              params.get('uploaded', 0), UDP_EVENTS[params.get('event')],
+                              0, self.key, params.get('numwant', -1), params['port'])
+        logging.info('%r announcing %r', self, params)
+        return self._exchange(ANNOUNCE, payload, self._announced)
+
+    def _announced(self, reply, external_ip, connection):
+        # after an error, connect again in case it was our connection id
+        self.connection = connection if isinstance(reply, str) else None
+        if isinstance(reply, str):
+            if len(reply) < 12:
+                reply = TrackerError('announce reply too short')
+            else:
+                interval, leechers, seeders = struct.unpack('!iii', reply[:12])
+                reply = {'interval': interval, 'incomplete': leechers, 'complete': seeders,
+                         'peers': reply[12:len(reply) - (len(reply) - 12) % 6]}
+        self._done(reply, external_ip)
+
+    def scrape(self, info_hashes, callback):
+        """Asks for (seeders, completed, leechers) of each of info_hashes;
+        callback gets a list of those, or a TrackerError"""
+        def scraped(reply, external_ip, connection):
+            self.connection = connection if isinstance(reply, str) else None
+            if isinstance(reply, str):
+                if len(reply) < 12 * len(info_hashes):
+                    reply = TrackerError('scrape reply too short')
+                else:
+                    reply = [struct.unpack('!iii', reply[i:i+12]) for i in range(0, 12 * len(info_hashes), 12)]
+            callback(reply)
+        def start(error=None):
+            if error is not None:
+                return callback(error)
+            try:
+                return self._exchange(SCRAPE, ''.join(info_hashes), scraped)
+            except (TrackerError, socket.error) as e:
+                callback(TrackerError(str(e)))
+        if self.addr is not None:
+            return start()
+        try:
+            return self._resolve(start)
+        except TrackerError as e:
+            callback(e)
+
+def make_tracker(url, *args, **kwargs):
+    """A Tracker of the right kind for url"""
+    if url.startswith('udp:'):
+        return UDPTracker(url, *args, **kwargs)
+    return HTTPTracker(url, *args, **kwargs)
+
+class TrackerTiers(object):
+    """Announces to the tiers of trackers in an announce-list (BEP 12)
+
+    Every tracker in a tier is announced to at once, each then on its own
+    schedule. The next tier is started only once every tracker started so
+    far is failing. Within a tier the first tracker to respond moves to
+    the front, and stays there while it keeps working. Peers from every
+    response go into one list, each address once, in the order first seen.
+
+    Works like a single Tracker: on_response(response) is called with
+    each successful response of any of them.
+
+    self.tiers: lists of Trackers, tiers shuffled as BEP 12 says
+    self.started: how many tiers have been announced to
+    self.peers: addresses from every response
+    """
+    def __init__(self, tiers, reactor, get_params, on_response, **kwargs):
+        self.on_response = on_response
+        self.tiers = []
+        for urls in tiers:
+            urls = list(urls)
+            random.shuffle(urls)
+            self.tiers.append([make_tracker(url, reactor, get_params, self._responder(url),
+                                            on_failure=self._failed, **kwargs) for url in urls])
+        self.tiers = [tier for tier in self.tiers if tier]
+        self.started = 0
+        self.peers = []
+        self.seen = set()
+
+    def __repr__(self):
+        return '<TrackerTiers %r>' % [[t.url for t in tier] for tier in self.tiers]
+
+    def trackers(self):
+        return [t for tier in self.tiers for t in tier]
+
+    @property
+    def external_ip(self):
+        for t in self.trackers():
+            if t.external_ip is not None:
+                return t.external_ip
+        return None
+
+    def announce(self, event=None):
+        """Announces to every tracker in the tiers started so far, starting
+        the first if none are; returns whether any announce started"""
+        if not self.tiers:
+            return False
+        self.started = max(self.started, 1)
+        started = [t.announce(event) for tier in self.tiers[:self.started] for t in tier]
+        return any(started)
+
+    def _responder(self, url):
+        return lambda response: self._responded(url, response)
+
+    def _responded(self, url, response):
+        for tier in self.tiers:
+            for i, t in enumerate(tier):
+                if t.url == url and i and (tier[0].failures or not tier[0].successes):
+                    logging.info('%r promoting %s to the front of its tier', self, url)
+                    tier.insert(0, tier.pop(i))
+                    break
+        for addr in decode_peers(response.get('peers', '')):
+            if addr not in self.seen:
+                self.seen.add(addr)
+                self.peers.append(addr)
+        self.on_response(response)
+
+    def _failed(self, error):
+        if self.started < len(self.tiers) and all(t.failures for tier in self.tiers[:self.started] for t in tier):
+            logging.warning('%r every tracker in the first %d tier(s) is failing, trying the next', self, self.started)
+            self.started += 1
+            for t in self.tiers[self.started - 1]:
+                t.announce()
+
+    def stats(self):
+        return dict((t.url, t.stats()) for t in self.trackers())
+
+    def close(self):
+        for t in self.trackers():
+            t.close()
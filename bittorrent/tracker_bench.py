@@ -0,0 +1,45 @@
+"""Announce latency over HTTP and UDP against stub trackers on localhost
+
+python -m bittorrent.tracker_bench [announces] [peers]
+
+Announces one after another on a real reactor, the way ActiveTorrent
+does, and times each from announce() to the response callback. Each
+response carries peers compact peers. The first UDP announce includes the
+connect exchange; after that the connection id is reused while it's
+fresh, so a UDP announce is one round trip against HTTP's TCP handshake,
+request, response and close.
+"""
+import sys
+import time
+
+from .reactor_select import Reactor
+from .stats import Histogram
+from .tracker import HTTPTracker, UDPTracker, decode_peers
+from .tracker_test import StubTracker, StubUDPTracker, ok, run_until, udp_params
+
+def run(tracker_class, url, announces):
+    reactor = Reactor()
+    responses = []
+    t = tracker_class(url, reactor, udp_params, responses.append)
+    latency = Histogram(unit=1e-6)
+    peers = 0
+    for i in range(announces):
+        start = time.time()
+        t.announce('started' if i == 0 else 'completed')
+        run_until(reactor, lambda: len(responses) > i)
+        latency.add(time.time() - start)
+        peers += len(decode_peers(responses[-1]['peers']))
+    t.close()
+    assert peers == announces * len(decode_peers(responses[0]['peers']))
+    return latency
+
+def main(announces=2000, peers=50):
+    compact = ''.join(chr(127) + chr(0) + chr(0) + chr(1) + chr(i >> 8) + chr(i & 255) for i in range(6881, 6881 + peers))
+    http = StubTracker([ok({'interval': 1800, 'peers': compact})] * announces, chunk=None)
+    udp = StubUDPTracker(peers=compact)
+    print '%d announces, %d peers each' % (announces, peers)
+    for name, tracker_class, url in [('http', HTTPTracker, http.url), ('udp', UDPTracker, udp.url)]:
+        print '%-5s %s' % (name, run(tracker_class, url, announces))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
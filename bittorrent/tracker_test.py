@@ -0,0 +1,305 @@
+"""Runs HTTPTracker, UDPTracker and TrackerTiers against stub trackers on localhost
+
+python -m bittorrent.tracker_test
+
+The HTTP stub answers each connection with the next of its replies, a
+few bytes at a time so responses arrive in pieces, or 'hang' to accept
+the request and never answer. The UDP stub speaks BEP 15, and can be
+told to ignore some datagrams or to answer announces with an error.
+"""
+import time
+import random
+import socket
+import struct
+import threading
+
+from . import bencode
+from .reactor_select import Reactor
+from . import tracker
+from .tracker import HTTPTracker, UDPTracker, TrackerTiers, Resolver, decode_peers
+from .wakeup import Waker
+
+class StubTracker(object):
+    def __init__(self, replies, chunk=7):
+        self.replies = list(replies)
+        self.chunk = chunk
+        self.requests = [] # request lines, in the order they came
+        self.hung = []
+        self.listen = socket.socket()
+        self.listen.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen.bind(('127.0.0.1', 0))
+        self.listen.listen(5)
+        self.url = 'http://127.0.0.1:%d/announce' % self.listen.getsockname()[1]
+        t = threading.Thread(target=self.serve)
+        t.daemon = True
+        t.start()
+
+    def serve(self):
+        while True:
+            s, _ = self.listen.accept()
+            request = ''
+            while '\r\n\r\n' not in request:
+                data = s.recv(4096)
+                if not data:
+                    break
+                request += data
+            self.requests.append(request.split('\r\n')[0])
+            reply = self.replies.pop(0) if self.replies else 'hang'
+            if reply == 'hang':
+                self.hung.append(s)
+                continue
+            if self.chunk is None:
+                s.sendall(reply)
+            else:
+                for i in range(0, len(reply), self.chunk):
+                    s.sendall(reply[i:i+self.chunk])
+                    time.sleep(.001)
+            s.close()
+
+class StubUDPTracker(object):
+    """self.received: actions of the requests it answered, in order"""
+    def __init__(self, peers='\x7f\x00\x00\x01\x1a\xe1', ignore=0, error=None):
+        self.peers = peers
+        self.ignore = ignore # datagrams to drop before answering any
+        self.error = error
+        self.received = []
+        self.connection_ids = set()
+        self.s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.s.bind(('127.0.0.1', 0))
+        self.url = 'udp://127.0.0.1:%d/announce' % self.s.getsockname()[1]
+        t = threading.Thread(target=self.serve)
+        t.daemon = True
+        t.start()
+
+    def serve(self):
+        while True:
+            data, addr = self.s.recvfrom(2**16)
+            if self.ignore:
+                self.ignore -= 1
+                continue
+            connection_id, action, transaction_id = struct.unpack('!qii', data[:16])
+            self.received.append(action)
+            header = struct.pack('!ii', action, transaction_id)
+            if action == tracker.CONNECT:
+                assert connection_id == tracker.UDP_PROTOCOL_ID
+                connection_id = random.getrandbits(63)
+                self.connection_ids.add(connection_id)
+                reply = header + struct.pack('!q', connection_id)
+            elif connection_id not in self.connection_ids:
+                reply = struct.pack('!ii', tracker.ERROR, transaction_id) + 'bad connection id'
+            elif action == tracker.ANNOUNCE and self.error:
+                reply = struct.pack('!ii', tracker.ERROR, transaction_id) + self.error
+            elif action == tracker.ANNOUNCE:
+                assert len(data) == 98, len(data)
+                reply = header + struct.pack('!iii', 1800, 3, 4) + self.peers
+            elif action == tracker.SCRAPE:
+                reply = header + ''.join(struct.pack('!iii', 5, 6, 7) for _ in range(0, len(data) - 16, 20))
+            self.s.sendto(reply, addr)
+
+def ok(response):
+    return 'HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\n\r\n' + bencode.bencode(response)
+
+def run_until(reactor, condition, limit=5):
+    deadline = time.time() + limit
+    while not condition():
+        assert time.time() < deadline, 'gave up waiting'
+        reactor.poll(.05)
+
+def test_announce():
+    stub = StubTracker([ok({'interval': 1800, 'min interval': 60, 'complete': 1, 'incomplete': 0,
+                            'peers': '\x7f\x00\x00\x01\x1a\xe1'})])
+    reactor = Reactor()
+    responses = []
+    t = HTTPTracker(stub.url, reactor, lambda: {'info_hash': 'x'*20, 'port': 6881}, responses.append)
+    assert t.announce('started')
+    assert not t.announce(), 'started a second announce while one was running'
+    run_until(reactor, lambda: responses)
+    assert decode_peers(responses[0]['peers']) == [('127.0.0.1', 6881)]
+    assert 'event=started' in stub.requests[0] and 'info_hash=xxxx' in stub.requests[0], stub.requests
+    assert t.external_ip == '127.0.0.1'
+    assert t.failures == 0 and t.interval == 1800 and t.min_interval == 60
+    assert 1795 < t.next_announce - time.time() <= 1800
+    assert not reactor.fd_map, 'the finished announce is still in the reactor'
+    assert not t.announce(), 'announced again within min interval'
+    assert t.announce('completed'), 'an event should go out regardless of min interval'
+    t.close()
+    assert not reactor.fd_map, 'the abandoned announce is still in the reactor'
+
+def test_timeout_and_backoff():
+    stub = StubTracker(['hang', 'HTTP/1.0 500 Internal Server Error\r\n\r\n',
+                        ok({'failure reason': 'unregistered torrent'}), 'HTTP/1.0 200 OK\r\n\r\nd8:intervali',
+                        ok({'interval': 900, 'peers': ''})])
+    reactor = Reactor()
+    responses = []
+    t = HTTPTracker(stub.url, reactor, lambda: {}, responses.append, timeout=.2)
+    started = time.time()
+    for failures, delay in [(1, 15), (2, 30), (3, 60), (4, 120)]:
+        # announce right away instead of waiting out each backoff
+        t.announce()
+        run_until(reactor, lambda: t.failures == failures)
+        assert delay - 1 < t.next_announce - time.time() <= delay, (failures, t.next_announce - time.time())
+    assert time.time() - started < 2, 'a hung tracker held things up'
+    assert not responses
+    t.announce()
+    run_until(reactor, lambda: responses)
+    assert t.failures == 0 and 895 < t.next_announce - time.time() <= 900
+    t.close()
+
+def refused_url():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return 'http://127.0.0.1:%d/announce' % port
+
+def test_connection_refused():
+    reactor = Reactor()
+    t = HTTPTracker(refused_url(), reactor, lambda: {}, lambda response: None)
+    t.announce()
+    run_until(reactor, lambda: t.failures == 1)
+    assert t.external_ip is None
+    t.close()
+
+def udp_params():
+    return {'info_hash': 'x'*20, 'peer_id': 'y'*20, 'port': 6881, 'uploaded': 0, 'downloaded': 0,
+            'left': 100, 'compact': 1}
+
+def test_udp_announce():
+    stub = StubUDPTracker()
+    reactor = Reactor()
+    responses = []
+    t = UDPTracker(stub.url, reactor, udp_params, responses.append)
+    assert t.announce('started')
+    run_until(reactor, lambda: responses)
+    assert decode_peers(responses[0]['peers']) == [('127.0.0.1', 6881)]
+    assert (responses[0]['interval'], responses[0]['incomplete'], responses[0]['complete']) == (1800, 3, 4)
+    assert stub.received == [tracker.CONNECT, tracker.ANNOUNCE]
+    assert t.external_ip == '127.0.0.1' and 1795 < t.next_announce - time.time() <= 1800
+    # the connection id is reused within a minute, and not after
+    assert t.announce('completed')
+    run_until(reactor, lambda: len(responses) == 2)
+    assert stub.received[2:] == [tracker.ANNOUNCE]
+    t.connection = (t.connection[0], time.time() - 61)
+    assert t.announce('completed')
+    run_until(reactor, lambda: len(responses) == 3)
+    assert stub.received[3:] == [tracker.CONNECT, tracker.ANNOUNCE]
+    scrapes = []
+    t.scrape(['a'*20, 'b'*20], scrapes.append)
+    run_until(reactor, lambda: scrapes)
+    assert scrapes == [[(5, 6, 7), (5, 6, 7)]] and stub.received[5:] == [tracker.SCRAPE]
+    assert not reactor.fd_map, 'finished exchanges are still in the reactor'
+    t.close()
+
+def test_udp_retransmit():
+    stub = StubUDPTracker(ignore=2)
+    reactor = Reactor()
+    responses = []
+    t = UDPTracker(stub.url, reactor, udp_params, responses.append, retransmit_timeout=.05)
+    t.announce()
+    run_until(reactor, lambda: responses)
+    assert stub.received == [tracker.CONNECT, tracker.ANNOUNCE] and t.failures == 0
+    stub.ignore = tracker.UDP_MAX_TRANSMITS
+    t.connection = None
+    t.announce()
+    run_until(reactor, lambda: t.failures == 1)
+    assert len(responses) == 1
+    t.close()
+
+def test_udp_error():
+    stub = StubUDPTracker(error='unregistered torrent')
+    reactor = Reactor()
+    t = UDPTracker(stub.url, reactor, udp_params, lambda response: None)
+    t.announce()
+    run_until(reactor, lambda: t.failures == 1)
+    assert t.connection is None, 'kept a connection id the tracker may have rejected'
+    assert 14 < t.next_announce - time.time() <= 15
+    t.close()
+
+def compact(*ports):
+    return ''.join('\x7f\x00\x00\x01' + struct.pack('!H', port) for port in ports)
+
+def test_tiers():
+    first = StubTracker([ok({'interval': 1800, 'peers': compact(1, 2)})])
+    second = StubTracker([ok({'interval': 900, 'peers': compact(2, 3)})])
+    backup = StubUDPTracker(peers=compact(4))
+    dead = refused_url()
+    reactor = Reactor()
+    responses = []
+    tiers = TrackerTiers([[dead, first.url, second.url], [backup.url]], reactor, udp_params, responses.append)
+    assert tiers.announce()
+    run_until(reactor, lambda: len(responses) == 2)
+    assert sorted(tiers.peers) == [('127.0.0.1', port) for port in (1, 2, 3)], tiers.peers
+    assert tiers.tiers[0][0].url in (first.url, second.url), 'a tracker that responded should be first'
+    assert tiers.started == 1 and not backup.received, 'started the next tier while the first was working'
+    stats = tiers.stats()
+    assert stats[dead]['errors'] == 1 and stats[first.url]['successes'] == 1, stats
+    # each is rescheduled on its own interval
+    assert 1795 < tiers.tiers[0][[t.url for t in tiers.tiers[0]].index(first.url)].next_announce - time.time() <= 1800
+    assert 895 < tiers.tiers[0][[t.url for t in tiers.tiers[0]].index(second.url)].next_announce - time.time() <= 900
+    tiers.close()
+
+    reactor = Reactor()
+    responses = []
+    tiers = TrackerTiers([[dead], [backup.url]], reactor, udp_params, responses.append)
+    tiers.announce()
+    run_until(reactor, lambda: responses)
+    assert tiers.started == 2 and tiers.peers == [('127.0.0.1', 4)]
+    tiers.close()
+
+def test_resolve_off_reactor():
+    """The tracker's host name is looked up on the Resolver's thread while
+    the reactor carries on; a lookup that fails is a failed announce, and
+    one still running when the tracker is closed is dropped"""
+    stub = StubTracker([ok({'interval': 1800, 'peers': ''})])
+    reactor = Reactor()
+    waker = Waker(reactor)
+    resolver = Resolver(waker)
+    answer = threading.Event()
+    real = socket.getaddrinfo
+    def slow_getaddrinfo(host, port, *args):
+        answer.wait(5)
+        if host == 'unknown.test':
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        return real('127.0.0.1', port, *args)
+    socket.getaddrinfo = slow_getaddrinfo
+    try:
+        responses = []
+        t = HTTPTracker(stub.url.replace('127.0.0.1', 'tracker.test'), reactor, lambda: {},
+                        responses.append, resolver=resolver)
+        started = time.time()
+        assert t.announce()
+        assert not t.announce(), 'started a second announce during the lookup'
+        reactor.poll(.1)
+        assert time.time() - started < 1, 'the reactor waited on the lookup'
+        answer.set()
+        run_until(reactor, lambda: responses)
+        assert t.addr == ('127.0.0.1', stub.listen.getsockname()[1])
+        t.close()
+
+        unknown = HTTPTracker('http://unknown.test/announce', reactor, lambda: {}, responses.append,
+                              resolver=resolver)
+        unknown.announce()
+        run_until(reactor, lambda: unknown.failures == 1)
+        assert 'looking up unknown.test' in unknown.last_error and unknown.addr is None
+        unknown.close()
+
+        answer.clear()
+        failures = []
+        closed = HTTPTracker('http://closed.test/announce', reactor, lambda: {}, responses.append,
+                             on_failure=failures.append, resolver=resolver)
+        assert closed.announce()
+        closed.close()
+        answer.set()
+        resolver.close()
+        waker.read_event()
+        assert closed.addr is None and not failures and len(responses) == 1
+    finally:
+        socket.getaddrinfo = real
+        resolver.close()
+
+if __name__ == '__main__':
+    for test in [test_announce, test_timeout_and_backoff, test_connection_refused,
+                 test_udp_announce, test_udp_retransmit, test_udp_error, test_tiers,
+                 test_resolve_off_reactor]:
+        test()
+        print test.__name__, 'ok'
@@ -0,0 +1,55 @@
+"""Waking the reactor from other threads
+
+A Waker is a readerwriter on the read end of a pipe (the self-pipe trick).
+post() may be called from any thread: it queues a callback and writes a
+byte to the pipe, and the callback then runs on the reactor's thread the
+next time the reactor polls.
+
+>>> from .reactor_select import Reactor
+>>> import threading
+>>> r = Reactor(); w = Waker(r); ran = []
+>>> t = threading.Thread(target=w.post, args=(ran.append, 'from a thread')); t.start(); t.join()
+>>> ran
+[]
+>>> _ = r.poll(1); ran
+['from a thread']
+"""
+import os
+import fcntl
+import errno
+import collections
+
+class Waker(object):
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.read_fd, self.write_fd = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.callbacks = collections.deque() # appends and pops are thread safe
+        self.reactor.add_readerwriter(self.read_fd, self)
+        self.reactor.reg_read(self.read_fd)
+
+    def post(self, callback, *args):
+        """Has callback(*args) called on the reactor thread; safe from any thread"""
+        self.callbacks.append((callback, args))
+        try:
+            os.write(self.write_fd, 'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN: # a full pipe will wake the reactor anyway
+                raise
+
+    def read_event(self):
+        try:
+            while os.read(self.read_fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        while self.callbacks:
+            callback, args = self.callbacks.popleft()
+            callback(*args)
+
+    def close(self):
+        self.reactor.unreg_read(self.read_fd)
+        os.close(self.read_fd)
+        os.close(self.write_fd)
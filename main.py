@@ -17,10 +17,13 @@ def seed(torrentfile, datafile):
     loop(client)
 
 def loop(client):
-    while True:
-        r = client.reactor.poll(1)
-        if r is None:
-            return
+    try:
+        while True:
+            r = client.reactor.poll(1)
+            if r is None:
+                return
+    finally:
+        client.shutdown()
 
 def CLI():
 